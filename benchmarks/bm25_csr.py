@@ -0,0 +1,110 @@
+"""
+KeywordSearch 的 BM25 打分：rank_bm25.BM25Okapi（逐词 Python 循环 + 全量 list.sort）对比
+CSR 稀疏矩阵打分（bm25_index.MergedBM25 + argpartition 取 top-k）。同时校验两者分数与排序一致。
+
+用法：
+    python benchmarks/bm25_csr.py                         # 10k / 100k / 1M 个片段
+    python benchmarks/bm25_csr.py --sizes 10000 --queries 50
+    python benchmarks/bm25_csr.py --reference-limit 100000  # 超过该规模时不再运行 rank_bm25（太慢）
+
+语料为合成数据：词表服从 Zipf 分布，每个片段长度随机，已分词，因此只比较建索引与打分/排序本身的开销。
+分数差超过 --tolerance 或 top-k 排序不一致时以非零状态退出，可作为回归检查。
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qwen_agent_local.tools.search_tools.bm25_index import DocPostings, MergedBM25, rank_order  # noqa: E402
+
+
+def make_corpus(n_chunks, vocab_size, mean_len, rng):
+    lengths = rng.poisson(mean_len, size=n_chunks)
+    words = rng.zipf(1.2, size=int(lengths.sum())) % vocab_size
+    chunks, start = [], 0
+    for n in lengths:
+        chunks.append([f't{w}' for w in words[start:start + n]])
+        start += n
+    return chunks
+
+
+def make_queries(n_queries, vocab_size, rng):
+    # 查询词从较常见的词中抽取，3~8 个词
+    return [[f't{w}' for w in rng.zipf(1.3, size=rng.integers(3, 9)) % vocab_size] for _ in range(n_queries)]
+
+
+def bench(n_chunks, args, rng):
+    chunks = make_corpus(n_chunks, args.vocab_size, args.mean_len, rng)
+    queries = make_queries(args.queries, args.vocab_size, rng)
+    row = {'chunks': n_chunks}
+
+    start = time.time()
+    # 按文档切分，模拟多文档会话（每 1000 个片段一个文档）
+    docs = [DocPostings.build(chunks[i:i + 1000], tokenizer=lambda x: x) for i in range(0, n_chunks, 1000)]
+    row['postings_s'] = time.time() - start
+    start = time.time()
+    csr = MergedBM25(docs)
+    row['csr_build_s'] = time.time() - start
+
+    latencies, orders = [], []
+    for q in queries:
+        start = time.time()
+        scores = csr.get_scores(q)
+        order = rank_order(scores, args.top_k)
+        latencies.append((time.time() - start) * 1000)
+        orders.append((scores, order))
+    row['csr_p50_ms'] = float(np.percentile(latencies, 50))
+    row['csr_p95_ms'] = float(np.percentile(latencies, 95))
+
+    if n_chunks <= args.reference_limit:
+        from rank_bm25 import BM25Okapi
+        start = time.time()
+        ref = BM25Okapi(chunks)
+        row['rank_bm25_build_s'] = time.time() - start
+        latencies, max_diff, same_topk = [], 0.0, 0
+        for q, (scores, order) in zip(queries, orders):
+            start = time.time()
+            ref_scores = ref.get_scores(q)
+            ranked = sorted(range(n_chunks), key=lambda i: ref_scores[i], reverse=True)
+            latencies.append((time.time() - start) * 1000)
+            max_diff = max(max_diff, float(np.abs(ref_scores - scores).max()))
+            same_topk += int(list(order) == ranked[:args.top_k])
+        row['rank_bm25_p50_ms'] = float(np.percentile(latencies, 50))
+        row['rank_bm25_p95_ms'] = float(np.percentile(latencies, 95))
+        row['max_abs_diff'] = max_diff
+        row[f'same_top{args.top_k}'] = f'{same_topk}/{len(queries)}'
+        row['mismatch'] = max_diff > args.tolerance or same_topk != len(queries)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--top-k', type=int, default=20)
+    parser.add_argument('--vocab-size', type=int, default=200000)
+    parser.add_argument('--mean-len', type=int, default=120, help='片段平均词数')
+    parser.add_argument('--reference-limit', type=int, default=100000, help='超过该片段数时跳过 rank_bm25')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='与 rank_bm25 的分数允许的最大绝对误差')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    rows = [bench(n, args, rng) for n in args.sizes]
+    headers = list(dict.fromkeys(k for row in rows for k in row))
+    print('| ' + ' | '.join(headers) + ' |')
+    print('|' + '---|' * len(headers))
+    for row in rows:
+        cells = [row.get(h, '-') for h in headers]
+        print('| ' + ' | '.join(f'{v:.4g}' if isinstance(v, float) else str(v) for v in cells) + ' |')
+    mismatched = [row['chunks'] for row in rows if row.get('mismatch')]
+    if mismatched:
+        print(f'CSR scores differ from rank_bm25 at {mismatched} chunks', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+解析/分块缓存的读取耗时：旧格式（Storage 中的 JSON 文本，解析结果为 indent=2）对比 packed_cache 的压缩二进制格式。
+分别测量读取整个文档、只读取前 k 个片段（惰性解析/取文档开头时的用法）的耗时与文件大小，并校验读出的内容一致。
+
+用法：
+    python benchmarks/cache_load.py                    # 1k / 10k 个片段
+    python benchmarks/cache_load.py --chunks 500 5000 --front 5 --repeat 20
+
+内容为合成数据（中英文混合段落，每段约 parser_page_size 个 token）。
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qwen_agent_local.tools.packed_cache import _CODECS, DEFAULT_CODEC, PackedCache  # noqa: E402
+from qwen_agent_local.tools.storage import Storage  # noqa: E402
+
+
+def make_record(n_chunks, rng):
+    words = ['条款', '合同', '双方', 'party', 'shall', 'comply', '规定', '责任', 'provision', '期限']
+    raw = []
+    for i in range(n_chunks):
+        content = f'[page: {i // 3 + 1}]\n' + ' '.join(rng.choice(words) for _ in range(400))
+        raw.append({'content': content, 'metadata': {'source': 'bench.pdf', 'title': 'bench', 'chunk_id': i},
+                    'token': 500})
+    return {'url': 'bench.pdf', 'raw': raw, 'title': 'bench'}
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        best = min(best, time.time() - start)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--front', type=int, default=5, help='只读取前多少个片段')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'codec: {DEFAULT_CODEC} (available: {sorted(_CODECS)}; 0=none 1=zlib 2=zstd 3=lz4)')
+    rng = random.Random(0)
+    root = tempfile.mkdtemp(prefix='cache_load_bench_')
+    try:
+        storage, cache = Storage({'storage_root_path': root}), PackedCache(root)
+        rows = []
+        for n in args.chunks:
+            record = make_record(n, rng)
+            storage.put(f'json_{n}', json.dumps(record, ensure_ascii=False))
+            cache.put(f'packed_{n}', record)
+
+            json_full_ms, loaded_json = timed(lambda: json.loads(storage.get(f'json_{n}')), args.repeat)
+            packed_full_ms, loaded_packed = timed(lambda: cache.get(f'packed_{n}'), args.repeat)
+
+            def packed_front():
+                with cache.open(f'packed_{n}') as packed:
+                    return [packed[i] for i in range(min(args.front, len(packed)))]
+
+            packed_front_ms, front = timed(packed_front, args.repeat)
+            rows.append({
+                'chunks': n,
+                'json_mb': os.path.getsize(os.path.join(root, f'json_{n}')) / 2**20,
+                'packed_mb': os.path.getsize(cache.path_of(f'packed_{n}')) / 2**20,
+                'json_full_ms': json_full_ms,
+                'packed_full_ms': packed_full_ms,
+                # 旧格式读取开头几个片段同样需要读取并解析整个文件
+                f'json_front{args.front}_ms': json_full_ms,
+                f'packed_front{args.front}_ms': packed_front_ms,
+                'identical': loaded_json == loaded_packed == record and front == record['raw'][:args.front],
+            })
+
+        headers = list(rows[0].keys())
+        print('| ' + ' | '.join(headers) + ' |')
+        print('|' + '---|' * len(headers))
+        for row in rows:
+            print('| ' + ' | '.join(f'{v:.3g}' if isinstance(v, float) else str(v) for v in row.values()) + ' |')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
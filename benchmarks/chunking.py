@@ -0,0 +1,196 @@
+"""
+DocParser 分块耗时：原实现（每个句子 count_tokens 一次、超长句再 tokenize 一次切分，循环内 re.fullmatch/re.split）
+对比现在的 iter_doc_chunks（每个句子只 tokenize 一次，按 token id 切分），在代码中使用的分块大小上逐一测量，
+并校验两者产生的片段（内容、token 数、编号）完全一致。
+
+用法：
+    python benchmarks/chunking.py                          # 合成文档，分块大小 300 / 500 / 1000
+    python benchmarks/chunking.py --pages 2000 --repeat 5
+    python benchmarks/chunking.py --file /path/to/doc.pdf  # 使用 SimpleDocParser 解析已有文档
+
+合成文档为中英文混合段落，其中一部分是超过分块大小的长段落和没有句号的超长句，以覆盖按句切分与硬切分的路径。
+原实现使用当时的 tokenize / count_tokens（encode(allowed_special='all') 后逐个转回 token，没有按内容缓存）；
+每次计时前清空 count_tokens 的缓存，重复计时也不会命中上一轮的结果。
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qwen_agent_local.tools.doc_parser import DocParser  # noqa: E402
+from qwen_agent_local.tools.simple_doc_parser import PARAGRAPH_SPLIT_SYMBOL, SimpleDocParser  # noqa: E402
+from qwen_agent_local.utils.tokenization_qwen import count_tokens, tokenizer  # noqa: E402
+
+
+def reference_tokenize(text):
+    """原 tokenize：text -> token id -> token 字节串。"""
+    text = unicodedata.normalize('NFC', text)
+    ids = tokenizer.tokenizer.encode(text, allowed_special='all', disallowed_special=())
+    return [tokenizer.decoder[t] for t in ids]
+
+
+def reference_count_tokens(text):
+    """原 count_tokens：len(tokenize(text))，没有按内容缓存。"""
+    return len(reference_tokenize(text))
+
+
+def clear_count_cache():
+    tokenizer._count_cache.clear()
+
+
+def make_doc(n_pages, rng):
+    en = ['The party shall comply with the provisions', 'Payment is due within thirty days',
+          'This agreement is governed by the laws of the jurisdiction', 'Notice must be given in writing']
+    zh = ['双方应当遵守本合同的约定', '付款期限为三十日', '本协议适用相关法律', '通知应以书面形式送达']
+    doc = []
+    for p in range(n_pages):
+        content = []
+        for _ in range(rng.randint(3, 10)):
+            kind = rng.random()
+            if kind < 0.1:
+                # 超长段落：按句切分
+                text = '. '.join(rng.choice(en) for _ in range(rng.randint(60, 200))) + '. ' + \
+                       '。'.join(rng.choice(zh) for _ in range(rng.randint(20, 80)))
+            elif kind < 0.13:
+                # 没有句号的超长句：按 token 硬切分
+                text = ' '.join(rng.choice(en) for _ in range(rng.randint(200, 400)))
+            else:
+                text = '. '.join(rng.choice(en + zh) for _ in range(rng.randint(1, 8)))
+            content.append({'text': text, 'token': count_tokens(text)})
+        doc.append({'page_num': p + 1, 'content': content})
+    return doc
+
+
+def reference_chunks(doc, parser_page_size, get_last_part):
+    """原 split_doc_to_chunk 的分块逻辑，返回 (content, token) 列表。"""
+    chunks = []
+    chunk = []
+    available_token = parser_page_size
+    has_para = False
+    for page in doc:
+        page_num = page['page_num']
+        if not chunk or f'[page: {str(page_num)}]' != chunk[0]:
+            chunk.append(f'[page: {str(page_num)}]')
+        idx = 0
+        len_para = len(page['content'])
+        while idx < len_para:
+            if not chunk:
+                chunk.append(f'[page: {str(page_num)}]')
+            para = page['content'][idx]
+            txt = para.get('text', para.get('table'))
+            token = para['token']
+            if token <= available_token:
+                available_token -= token
+                chunk.append([txt, page_num])
+                has_para = True
+                idx += 1
+            else:
+                if has_para:
+                    if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
+                        chunk.pop()
+                    chunks.append((PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk]),
+                                   parser_page_size - available_token))
+                    overlap_txt = get_last_part(chunk)
+                    if overlap_txt.strip():
+                        chunk = [f'[page: {str(chunk[-1][1])}]', overlap_txt]
+                        has_para = False
+                        available_token = parser_page_size - reference_count_tokens(overlap_txt)
+                    else:
+                        chunk = []
+                        has_para = False
+                        available_token = parser_page_size
+                else:
+                    _sentences = re.split(r'\. |。', txt)
+                    sentences = []
+                    for s in _sentences:
+                        token = reference_count_tokens(s)
+                        if not s.strip() or token == 0:
+                            continue
+                        if token <= available_token:
+                            sentences.append([s, token])
+                        else:
+                            token_list = reference_tokenize(s)
+                            for si in range(0, len(token_list), available_token):
+                                ss = tokenizer.convert_tokens_to_string(
+                                    token_list[si:min(len(token_list), si + available_token)])
+                                sentences.append([ss, min(available_token, len(token_list) - si)])
+                    sent_index = 0
+                    while sent_index < len(sentences):
+                        s = sentences[sent_index][0]
+                        token = sentences[sent_index][1]
+                        if not chunk:
+                            chunk.append(f'[page: {str(page_num)}]')
+                        if token <= available_token or (not has_para):
+                            available_token -= token
+                            chunk.append([s, page_num])
+                            has_para = True
+                            sent_index += 1
+                        else:
+                            if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$',
+                                                                           chunk[-1]) is not None:
+                                chunk.pop()
+                            content = PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk])
+                            chunks.append((content, parser_page_size - available_token))
+                            overlap_txt = get_last_part(chunk)
+                            if overlap_txt.strip():
+                                chunk = [f'[page: {str(chunk[-1][1])}]', overlap_txt]
+                                has_para = False
+                                available_token = parser_page_size - reference_count_tokens(overlap_txt)
+                            else:
+                                chunk = []
+                                has_para = False
+                                available_token = parser_page_size
+                    idx += 1
+    if has_para:
+        if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
+            chunk.pop()
+        chunks.append((PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk]),
+                       parser_page_size - available_token))
+    return chunks
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        clear_count_cache()
+        start = time.time()
+        result = fn()
+        best = min(best, time.time() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file', default=None, help='已有的文档，不指定时使用合成文档')
+    parser.add_argument('--pages', type=int, default=500, help='合成文档的页数')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[300, 500, 1000], help='分块大小（token）')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.file:
+        cache_dir = tempfile.mkdtemp(prefix='chunking_bench_')
+        doc = SimpleDocParser({'path': cache_dir, 'structured_doc': True}).call({'url': args.file})
+    else:
+        doc = make_doc(args.pages, random.Random(0))
+    print(f'{len(doc)} pages, {sum(len(page["content"]) for page in doc)} paragraphs, '
+          f'{sum(para["token"] for page in doc for para in page["content"])} tokens')
+
+    doc_parser = DocParser({'path': tempfile.mkdtemp(prefix='chunking_bench_')})
+    print('| parser_page_size | chunks | reference_s | single_pass_s | speedup | identical |')
+    print('|---|---|---|---|---|---|')
+    for size in args.sizes:
+        ref_s, ref = timed(lambda: reference_chunks(doc, size, doc_parser._get_last_part), args.repeat)
+        new_s, new = timed(lambda: doc_parser.split_doc_to_chunk(doc, 'bench', parser_page_size=size), args.repeat)
+        identical = ref == [(chk.content, chk.token) for chk in new] and all(
+            chk.metadata['chunk_id'] == i for i, chk in enumerate(new))
+        print(f'| {size} | {len(new)} | {ref_s:.3f} | {new_s:.3f} | {ref_s / max(new_s, 1e-9):.2f}x | {identical} |')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+在同一语料上对比 EmbeddedMemory（SQLite FTS5 + 内存映射向量矩阵）与 ESMemory 的导入耗时、查询延迟与结果重合度。
+
+用法：
+    python benchmarks/embedded_vs_es.py --limit-docs 50 --queries 100 --top-k 5
+
+语料（原文与已有向量）取自现有 ES embedding 索引，导入 EmbeddedMemory 时复用这些向量，不再请求 embedding 服务；
+查询取自语料中随机片段的前若干字符，查询向量在计时前统一生成并缓存，延迟不含 embedding 请求。
+overlap@k 为两个后端 top-k 结果 (doc_name, chunk_id) 的重合比例。
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qwen_agent_local.memory.embedded_memory import EmbeddedMemory  # noqa: E402
+from qwen_agent_local.memory.es_memory import ESMemory  # noqa: E402
+from qwen_agent_local.memory.es_migrate import iter_doc_names, load_doc_chunks  # noqa: E402
+from qwen_agent_local.utils.embedding_utils import get_embeddings  # noqa: E402
+
+
+def time_queries(fn, queries, top_k):
+    latencies, results = [], []
+    for q in queries:
+        start = time.time()
+        results.append(fn(q, top_k=top_k))
+        latencies.append((time.time() - start) * 1000)
+    return latencies, results
+
+
+def overlap(a, b, top_k):
+    keys_a = {(r['doc_name'], r['chunk_id']) for r in a}
+    keys_b = {(r['doc_name'], r['chunk_id']) for r in b}
+    return len(keys_a & keys_b) / top_k
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--limit-docs', type=int, default=50, help='参与对比的文档数')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--query-chars', type=int, default=30, help='查询取片段的前多少个字符')
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--path', default=None, help='EmbeddedMemory 数据目录，默认使用临时目录并在结束后删除')
+    args = parser.parse_args()
+
+    es_memory = ESMemory()
+    es_memory.query_cache = None
+    path = args.path or tempfile.mkdtemp(prefix='embedded_memory_bench_')
+    embedded = EmbeddedMemory(path=path, dims=es_memory.dims)
+    embedded.query_cache = None
+
+    start = time.time()
+    doc_names, texts = [], []
+    for doc_name in iter_doc_names(es_memory.es, es_memory.embedding_index):
+        stored = load_doc_chunks(es_memory.es, es_memory.embedding_index, doc_name,
+                                 ['content', 'chunk_id', 'content_vector'])
+        chunks = [c['content'] for c in stored]
+        vectors = {idx: c['content_vector'] for idx, c in enumerate(stored) if c.get('content_vector')}
+        embedded.add_chunks_with_embedding(doc_name, chunks, known_vectors=vectors, progress_every=0)
+        doc_names.append(doc_name)
+        texts.extend(c for c in chunks if c.strip())
+        if len(doc_names) >= args.limit_docs:
+            break
+    load_seconds = time.time() - start
+    if not texts:
+        print(f'{es_memory.embedding_index} 中没有数据，请先用 docs_es.py --embedding 入库')
+        return
+    print(f'导入 {len(doc_names)} 个文档、{len(texts)} 个片段到 EmbeddedMemory，耗时 {load_seconds:.1f}s\n')
+
+    rng = np.random.default_rng(0)
+    queries = [texts[i][:args.query_chars] for i in rng.choice(len(texts), size=min(args.queries, len(texts)),
+                                                               replace=False)]
+    get_embeddings(queries, dimensions=es_memory.dims)  # 预先生成并缓存查询向量
+
+    rows = []
+    for mode in ('search', 'embedding_search', 'hybrid_search'):
+        es_lat, es_res = time_queries(lambda q, top_k: getattr(es_memory, mode)(q, top_k=top_k, doc_names=doc_names),
+                                      queries, args.top_k)
+        em_lat, em_res = time_queries(lambda q, top_k: getattr(embedded, mode)(q, top_k=top_k, doc_names=doc_names),
+                                      queries, args.top_k)
+        rows.append({
+            'mode': mode,
+            'es_p50_ms': float(np.percentile(es_lat, 50)),
+            'es_p95_ms': float(np.percentile(es_lat, 95)),
+            'embedded_p50_ms': float(np.percentile(em_lat, 50)),
+            'embedded_p95_ms': float(np.percentile(em_lat, 95)),
+            f'overlap@{args.top_k}': float(np.mean([overlap(a, b, args.top_k) for a, b in zip(es_res, em_res)])),
+        })
+
+    headers = list(rows[0].keys())
+    print('| ' + ' | '.join(headers) + ' |')
+    print('|' + '---|' * len(headers))
+    for row in rows:
+        print('| ' + ' | '.join(f'{v:.2f}' if isinstance(v, float) else str(v) for v in row.values()) + ' |')
+
+    if not args.path:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
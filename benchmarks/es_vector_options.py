@@ -0,0 +1,134 @@
+"""
+对比不同向量存储配置（float32 / int8_hnsw 量化 / HNSW 参数 / 降维）的索引大小、构建耗时、查询延迟与召回率。
+
+用法：
+    python benchmarks/es_vector_options.py --limit 20000 --queries 200
+    python benchmarks/es_vector_options.py --options my_options.json   # {"名称": {vector_options}, ...}
+
+样本向量取自现有 embedding 索引（ES_EMBEDDING_INDEX）。降维配置通过截取前 dims 维并重新归一化近似
+Matryoshka 截断，正式使用时 ESMemory 会直接按 dims 请求 embedding 服务。召回率以同一配置下的精确暴力检索为基准。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from elasticsearch import helpers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import ES_EMBEDDING_INDEX  # noqa: E402
+from qwen_agent_local.memory.es_bulk import AdaptiveBulkWriter, bulk_load  # noqa: E402
+from qwen_agent_local.memory.es_memory import ESMemory, vector_mapping  # noqa: E402
+
+DEFAULT_OPTIONS = {
+    'float32_hnsw': {},
+    'int8_hnsw': {'index_type': 'int8_hnsw'},
+    'int8_hnsw_m32_ef200': {'index_type': 'int8_hnsw', 'm': 32, 'ef_construction': 200},
+    'int8_hnsw_512d': {'index_type': 'int8_hnsw', 'dims': 512},
+    'int8_hnsw_256d': {'index_type': 'int8_hnsw', 'dims': 256},
+}
+
+
+def load_sample(es, index, limit):
+    vectors, names = [], []
+    for hit in helpers.scan(es, index=index, query={'query': {'exists': {'field': 'content_vector'}}},
+                            _source=['content_vector']):
+        vectors.append(hit['_source']['content_vector'])
+        names.append(hit['_id'])
+        if len(vectors) >= limit:
+            break
+    return names, np.asarray(vectors, dtype=np.float32)
+
+
+def truncate(vectors, dims):
+    vectors = vectors[:, :dims]
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def bench_option(name, options, base, ids, vectors, queries, top_k, num_candidates, keep):
+    index = f'bench_vec_{name.lower()}'
+    dims = options.get('dims', vectors.shape[1])
+    vecs = truncate(vectors, dims)
+    qs = truncate(queries, dims)
+    es = base.es
+    if es.indices.exists(index=index):
+        es.indices.delete(index=index)
+    es.indices.create(index=index,
+                      settings={'number_of_shards': 1, 'number_of_replicas': 0},
+                      mappings={'properties': {'content_vector': vector_mapping(dims, options)}})
+
+    start = time.time()
+    writer = AdaptiveBulkWriter(es)
+    with bulk_load(es, index, force_merge=True):
+        actions = ({'_index': index, '_id': _id, 'content_vector': v.tolist()} for _id, v in zip(ids, vecs))
+        failed = sum(1 for ok, _ in writer.write(actions) if not ok)
+    build_seconds = time.time() - start
+    size = es.indices.stats(index=index, metric='store')['indices'][index]['primaries']['store']['size_in_bytes']
+
+    latencies, recalls = [], []
+    exact = np.argsort(-(qs @ vecs.T), axis=1)[:, :top_k]
+    for q, truth in zip(qs, exact):
+        t = time.time()
+        res = es.search(index=index,
+                        knn={'field': 'content_vector', 'query_vector': q.tolist(), 'k': top_k,
+                             'num_candidates': num_candidates},
+                        size=top_k,
+                        source=False)
+        latencies.append((time.time() - t) * 1000)
+        got = {hit['_id'] for hit in res['hits']['hits']}
+        recalls.append(len(got & {ids[i] for i in truth}) / top_k)
+    if not keep:
+        es.indices.delete(index=index)
+    return {
+        'option': name,
+        'dims': dims,
+        'size_mb': size / 2**20,
+        'build_s': build_seconds,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        f'recall@{top_k}': float(np.mean(recalls)),
+        'failed': failed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source-index', default=ES_EMBEDDING_INDEX)
+    parser.add_argument('--limit', type=int, default=20000, help='样本向量数')
+    parser.add_argument('--queries', type=int, default=200, help='查询数（从样本中随机抽取）')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--num-candidates', type=int, default=100)
+    parser.add_argument('--options', default=None, help='JSON 文件，{名称: vector_options}')
+    parser.add_argument('--keep', action='store_true', help='保留测试索引')
+    args = parser.parse_args()
+
+    options = DEFAULT_OPTIONS
+    if args.options:
+        with open(args.options, 'r', encoding='utf-8') as f:
+            options = json.load(f)
+
+    base = ESMemory()
+    ids, vectors = load_sample(base.es, args.source_index, args.limit)
+    if not len(ids):
+        print(f'{args.source_index} 中没有向量，请先写入 embedding')
+        return
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(ids), size=min(args.queries, len(ids)), replace=False)]
+    print(f'样本: {len(ids)} 个向量, {vectors.shape[1]} 维; 查询: {len(queries)} 个\n')
+
+    rows = [
+        bench_option(name, opts, base, ids, vectors, queries, args.top_k, args.num_candidates, args.keep)
+        for name, opts in options.items()
+    ]
+    headers = list(rows[0].keys())
+    print('| ' + ' | '.join(headers) + ' |')
+    print('|' + '---|' * len(headers))
+    for row in rows:
+        print('| ' + ' | '.join(f'{v:.2f}' if isinstance(v, float) else str(v) for v in row.values()) + ' |')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+大 PDF 解析耗时：原 parse_pdf（逐页解析，每个 LTRect 在结果为空时都重新提取一次表格，逐个表格框判断文本是否重复）
+对比现在的逐页串行解析（iter_pdf_pages）与按页范围分片、在解析进程池中并行的 parse_pdf，并校验后两者的输出与原实现
+完全一致；另外给出惰性逐页解析（SimpleDocParser.iter_pages）拿到前几页所需的时间。
+
+用法：
+    python benchmarks/pdf_parse.py                            # 生成 500 页（含表格）的 PDF 后测试
+    python benchmarks/pdf_parse.py --pages 200 --tables-every 5
+    python benchmarks/pdf_parse.py --pdf /path/to/large.pdf   # 使用已有的 PDF
+
+并行度由 qwen_agent_local_DEFAULT_PARSER_MAX_WORKERS 控制（默认 min(4, CPU 核数)），单核机器上不会有加速。
+生成 PDF 需要 reportlab。
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qwen_agent_local.settings import DEFAULT_PARSER_MAX_WORKERS  # noqa: E402
+from qwen_agent_local.tools.simple_doc_parser import (SimpleDocParser, clean_paragraph, get_font,  # noqa: E402
+                                                      iter_pdf_pages, parse_pdf, table_converter)
+
+
+def reference_parse_pdf(pdf_path):
+    """原 parse_pdf 的逐页解析（不含 extract_image 分支）。"""
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTRect, LTTextContainer
+
+    doc = []
+    import pdfplumber
+    pdf = pdfplumber.open(pdf_path)
+    for i, page_layout in enumerate(extract_pages(pdf_path)):
+        page = {'page_num': page_layout.pageid, 'content': []}
+
+        elements = []
+        for element in page_layout:
+            elements.append(element)
+
+        table_num = 0
+        tables = []
+
+        for element in elements:
+            if isinstance(element, LTRect):
+                if not tables:
+                    tables = pdf.pages[i].extract_tables()
+                if table_num < len(tables):
+                    table_string = table_converter(tables[table_num])
+                    table_num += 1
+                    if table_string:
+                        page['content'].append({'table': table_string, 'obj': element})
+            elif isinstance(element, LTTextContainer):
+                text = element.get_text()
+                font = get_font(element)
+                if text.strip():
+                    new_content_item = {'text': text, 'obj': element}
+                    if font:
+                        new_content_item['font-size'] = round(font[1])
+                    page['content'].append(new_content_item)
+
+        page['content'] = reference_postprocess_page_content(page['content'])
+        doc.append(page)
+
+    return doc
+
+
+def reference_postprocess_page_content(page_content):
+    """原 postprocess_page_content：逐个表格框判断文本是否重复，再合并被误拆的段落。"""
+    table_obj = [p['obj'] for p in page_content if 'table' in p]
+    tmp = []
+    for p in page_content:
+        repetitive = False
+        if 'text' in p:
+            for t in table_obj:
+                if t.bbox[0] <= p['obj'].bbox[0] and p['obj'].bbox[1] <= t.bbox[1] and t.bbox[2] <= p['obj'].bbox[
+                        2] and p['obj'].bbox[3] <= t.bbox[3]:
+                    repetitive = True
+                    break
+
+        if not repetitive:
+            tmp.append(p)
+    page_content = tmp
+
+    new_page_content = []
+    for p in page_content:
+        if new_page_content and 'text' in new_page_content[-1] and 'text' in p and abs(
+                p.get('font-size', 12) -
+                new_page_content[-1].get('font-size', 12)) < 2 and p['obj'].height < p.get('font-size', 12) + 1:
+            new_page_content[-1]['text'] += f' {p["text"]}'
+            new_page_content[-1]['font-size'] = p.get('font-size', 12)
+        else:
+            p.pop('obj')
+            new_page_content.append(p)
+    for i in range(len(new_page_content)):
+        if 'text' in new_page_content[i]:
+            new_page_content[i]['text'] = clean_paragraph(new_page_content[i]['text'])
+    return new_page_content
+
+
+def make_pdf(path, pages, tables_every):
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Table, TableStyle
+
+    styles = getSampleStyleSheet()
+    story = []
+    for p in range(pages):
+        story.append(Paragraph(f'Section {p + 1}', styles['Heading2']))
+        for j in range(8):
+            story.append(Paragraph(f'Article {p + 1}.{j + 1}. ' + 'The party shall comply with the provisions. ' * 12,
+                                   styles['BodyText']))
+        if tables_every and p % tables_every == 0:
+            data = [['Item', 'Value', 'Note']] + [[f'row {r}', str(r * p), f'note {r}'] for r in range(6)]
+            table = Table(data)
+            # 表头底色会生成 LTRect，网格线供 pdfplumber 识别表格
+            table.setStyle(
+                TableStyle([('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+                            ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey)]))
+            story.append(table)
+        story.append(PageBreak())
+    SimpleDocTemplate(path, pagesize=A4).build(story)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pdf', default=None, help='已有的 PDF，不指定时生成一个')
+    parser.add_argument('--pages', type=int, default=500, help='生成的 PDF 页数')
+    parser.add_argument('--tables-every', type=int, default=10, help='每隔多少页放一个表格，0 表示不放')
+    parser.add_argument('--front-pages', type=int, default=2, help='惰性解析时读取的页数')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='pdf_parse_bench_')
+    try:
+        pdf_path = args.pdf
+        if pdf_path is None:
+            pdf_path = os.path.join(tmp_dir, 'bench.pdf')
+            start = time.time()
+            make_pdf(pdf_path, args.pages, args.tables_every)
+            print(f'生成 {pdf_path}，耗时 {time.time() - start:.1f}s')
+
+        start = time.time()
+        reference = json.dumps(reference_parse_pdf(pdf_path), ensure_ascii=False)
+        reference_s = time.time() - start
+
+        start = time.time()
+        serial = list(iter_pdf_pages(pdf_path))
+        serial_s = time.time() - start
+
+        start = time.time()
+        sharded = parse_pdf(pdf_path)
+        sharded_s = time.time() - start
+
+        parser_ = SimpleDocParser({'path': os.path.join(tmp_dir, 'cache'), 'structured_doc': True})
+        start = time.time()
+        pages = parser_.iter_pages(pdf_path)
+        for _ in zip(range(args.front_pages), pages):
+            pass
+        front_s = time.time() - start
+        pages.close()
+
+        print('| pages | workers | reference_s | serial_s | sharded_s | speedup | serial_identical | '
+              'sharded_identical | lazy_front_pages_s |')
+        print('|---|---|---|---|---|---|---|---|---|')
+        print(f'| {len(serial)} | {DEFAULT_PARSER_MAX_WORKERS} | {reference_s:.2f} | {serial_s:.2f} | '
+              f'{sharded_s:.2f} | {reference_s / max(sharded_s, 1e-9):.2f}x | '
+              f'{json.dumps(serial, ensure_ascii=False) == reference} | '
+              f'{json.dumps(sharded, ensure_ascii=False) == reference} | {front_s:.2f} |')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
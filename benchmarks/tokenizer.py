@@ -0,0 +1,80 @@
+"""
+token 计数的微基准：原 count_tokens（tiktoken.encode(allowed_special='all') 后逐个 token 转回 bytes 再取长度）
+对比现在的 count_tokens（encode_ordinary，不生成 token 字符串；长文本按内容哈希缓存），
+以及整篇文档的逐段计数对比 count_tokens_batch（共享线程池）。同时校验所有计数一致。
+
+用法：
+    python benchmarks/tokenizer.py                        # 2 万个段落
+    python benchmarks/tokenizer.py --paras 100000 --threads 1 4 8
+
+测量项：
+    short       短文本（一句话）逐个计数
+    paragraph   文档段落逐个计数
+    prompt      重复计数同一个约 4k 字符的系统提示（缓存命中）
+    batch       全部段落一次批量计数（不同线程数）
+多线程需要多核才有加速；线程数不超过共享线程池的大小 qwen_agent_local_DEFAULT_TOKENIZER_THREADS（默认 min(8, CPU 核数)）。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qwen_agent_local.utils.tokenization_qwen import tokenizer  # noqa: E402
+
+
+def reference_count(text):
+    """原实现：len(tokenize(text))。"""
+    text = unicodedata.normalize('NFC', text)
+    return len([tokenizer.decoder[t] for t in tokenizer.tokenizer.encode(text, allowed_special='all')])
+
+
+def make_paras(n, rng):
+    en = ['The party shall comply with the provisions.', 'Payment is due within thirty days.',
+          'This agreement is governed by the laws of the jurisdiction.', 'Notice must be given in writing.']
+    zh = ['双方应当遵守本合同的约定。', '付款期限为三十日。', '本协议适用相关法律。', '通知应以书面形式送达。']
+    return [' '.join(rng.choice(en + zh) for _ in range(rng.randint(1, 30))) for _ in range(n)]
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        best = min(best, time.time() - start)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paras', type=int, default=20000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    paras = make_paras(args.paras, rng)
+    shorts = [p[:40] for p in paras]
+    prompt = 'You are a helpful assistant. 你是一个乐于助人的助手。' * 100
+    prompts = [prompt] * 1000
+
+    print('| case | texts | reference_ms | current_ms | speedup | identical |')
+    print('|---|---|---|---|---|---|')
+    for name, texts in [('short', shorts), ('paragraph', paras), ('prompt', prompts)]:
+        ref_ms, ref = timed(lambda: [reference_count(t) for t in texts], args.repeat)
+        cur_ms, cur = timed(lambda: [tokenizer.count_tokens(t) for t in texts], args.repeat)
+        print(f'| {name} | {len(texts)} | {ref_ms:.1f} | {cur_ms:.1f} | '
+              f'{ref_ms / max(cur_ms, 1e-9):.2f}x | {ref == cur} |')
+
+    ref_ms, ref = timed(lambda: [reference_count(t) for t in paras], args.repeat)
+    for n in args.threads:
+        cur_ms, cur = timed(lambda: tokenizer.count_tokens_batch(paras, num_threads=n), args.repeat)
+        print(f'| batch ({n} threads) | {len(paras)} | {ref_ms:.1f} | {cur_ms:.1f} | '
+              f'{ref_ms / max(cur_ms, 1e-9):.2f}x | {ref == cur} |')
+
+
+if __name__ == '__main__':
+    main()
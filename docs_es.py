@@ -3,117 +3,76 @@ from urllib3.exceptions import InsecureRequestWarning
 # 屏蔽 InsecureRequestWarning
 warnings.filterwarnings("ignore", category=InsecureRequestWarning)
 
+import argparse
 import os
-from elasticsearch import Elasticsearch, helpers
-import fitz  # PyMuPDF
-from tqdm import tqdm
-from config import ES_HOST, ES_USERNAME, ES_PASSWORD, ES_INDEX
 
-# ========== 自动获取 docs 目录下所有文件 ==========
-DOCS_DIR = './docs'
-DOCS_FILES = []
-if os.path.exists(DOCS_DIR):
-    for file in os.listdir(DOCS_DIR):
-        file_path = os.path.join(DOCS_DIR, file)
-        if os.path.isfile(file_path):
-            DOCS_FILES.append(file_path)
+from qwen_agent_local.memory.es_ingest import Checkpoint, ingest_files
+from qwen_agent_local.memory.es_memory import ESMemory
+from qwen_agent_local.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
+from qwen_agent_local.utils.utils import get_file_type
 
-print(f"找到 {len(DOCS_FILES)} 个文件: {DOCS_FILES}")
 
-# ========== 1. 连接到 Elasticsearch ==========
-# 自动拼接端口:9200（如未指定）
-def ensure_es_port(host):
-    # 检查是否已带端口
-    host_no_proto = host.split('//', 1)[-1]
-    if ':' not in host_no_proto:
-        host += ':9200'
-    return host
+def main():
+    # ========== 0. 命令行参数 ==========
+    # 示例：python docs_es.py --docs-dir ./docs --workers 8 --embedding
+    parser = argparse.ArgumentParser(description='多进程解析 docs 目录下的文档并写入 ES（支持断点续传）')
+    parser.add_argument('--docs-dir', default='./docs', help='待入库文档目录')
+    parser.add_argument('--workers', type=int, default=None, help='解析进程数，默认为 CPU 核数')
+    parser.add_argument('--embedding', action='store_true', help='同时写入 embedding 向量索引')
+    parser.add_argument('--checkpoint', default=None, help='断点文件路径，默认为 <docs-dir>/.es_ingest_checkpoint.jsonl')
+    parser.add_argument('--restart', action='store_true', help='忽略断点，从头开始入库')
+    parser.add_argument('--force-merge', action='store_true', help='写入完成后将索引段合并为 1 段（适合入库后只读的索引）')
+    parser.add_argument('--test-query', default='中石化研学活动守则有哪些？', help='入库完成后用于验证的检索问题，传空字符串则跳过')
+    args = parser.parse_args()
 
-es_host_with_port = ensure_es_port(ES_HOST)
+    # ========== 1. 自动获取 docs 目录下所有支持的文件 ==========
+    DOCS_FILES = []
+    if os.path.exists(args.docs_dir):
+        for file in sorted(os.listdir(args.docs_dir)):
+            file_path = os.path.join(args.docs_dir, file)
+            if os.path.isfile(file_path) and get_file_type(file_path) in PARSER_SUPPORTED_FILE_TYPES:
+                DOCS_FILES.append(file_path)
 
-es = Elasticsearch(
-    es_host_with_port,
-    basic_auth=(ES_USERNAME, ES_PASSWORD),
-    verify_certs=False  # 若为自签证书可设为False
-)
+    print(f"找到 {len(DOCS_FILES)} 个文件: {DOCS_FILES}")
 
-# ========== 2. 创建索引（如已存在则跳过） ==========
-index_body = {
-    "settings": {
-        "number_of_shards": 1,
-        "number_of_replicas": 0
-    },
-    "mappings": {
-        "properties": {
-            "doc_name": {"type": "keyword"},
-            "content": {"type": "text"},
-            "chunk_id": {"type": "integer"}
-        }
-    }
-}
-if not es.indices.exists(index=ES_INDEX):
-    es.indices.create(index=ES_INDEX, body=index_body)
-    print(f"已创建索引: {ES_INDEX}")
-else:
-    print(f"索引已存在: {ES_INDEX}")
+    # ========== 2. 连接 Elasticsearch（如索引不存在则创建） ==========
+    es_memory = ESMemory()
 
-# ========== 3. 解析文档并分段 ==========
-def extract_txt(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
+    # ========== 3. 并行解析、分块并写入 ES ==========
+    # 解析在进程池中进行，分块方式与运行时 DocParser 一致；每完成一个文档记录一次断点，中断后重跑会从下一个未完成的文档继续
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.docs_dir, '.es_ingest_checkpoint.jsonl'))
+    if args.restart:
+        checkpoint.reset()
+    print("正在写入文档到ES...")
+    stats = ingest_files(DOCS_FILES,
+                         es_memory,
+                         checkpoint=checkpoint,
+                         workers=args.workers,
+                         with_embedding=args.embedding,
+                         force_merge=args.force_merge)
+    print(f"写入完成！成功 {stats['docs']} 个文档（{stats['chunks']} 个片段），失败 {stats['failed']} 个，"
+          f"跳过已完成 {stats['skipped']} 个，耗时 {stats['seconds']:.1f} 秒，{stats['chunks_per_second']:.1f} chunks/s")
 
-def extract_pdf(file_path):
-    doc = fitz.open(file_path)
-    text = ""
-    for page in doc:
-        text += page.get_text()
-    return text
+    # ========== 4. 执行搜索 ==========
+    # 为了测试一下是否转换成功 size返回最接近的前三个
+    if args.test_query:
+        search_query = args.test_query
+        rep_size = 3
+        print(f"\n搜索: {search_query}")
+        hits = es_memory.search(search_query, top_k=rep_size)
 
-def split_text(text, chunk_size=500):
-    # 按 chunk_size 字符分段
-    return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
-
-def parse_and_yield_docs():
-    for file_path in DOCS_FILES:
-        ext = os.path.splitext(file_path)[-1].lower()
-        if ext == '.txt':
-            text = extract_txt(file_path)
-        elif ext == '.pdf':
-            text = extract_pdf(file_path)
+        print("\n--- 搜索结果 ---")
+        if not hits:
+            print("没有找到匹配的文档。")
         else:
-            continue
-        doc_name = os.path.basename(file_path)
-        chunks = split_text(text)
-        for idx, chunk in enumerate(chunks):
-            yield {
-                '_op_type': 'index',
-                '_index': ES_INDEX,
-                'doc_name': doc_name,
-                'content': chunk,
-                'chunk_id': idx
-            }
-
-# ========== 4. 批量写入ES ==========
-print("正在写入文档到ES...")
-helpers.bulk(es, parse_and_yield_docs())
-print("写入完成！")
-
-# ========== 5. 执行搜索 ========== 
-# 为了测试一下是否转换成功 size返回最接近的前三个
-search_query = "中石化研学活动守则有哪些？"
-rep_size = 3
-print(f"\n搜索: {search_query}")
-response = es.search(index=ES_INDEX, query={"match": {"content": search_query}}, size=rep_size)
+            for i, hit in enumerate(hits):
+                print(f"\n--- 结果 {i+1} ---")
+                print(f"来源文件: {hit['doc_name']}")
+                print(f"相关度得分: {hit['score']:.2f}")
+                content_preview = hit['content'].strip().replace('\n', ' ')
+                print(f"内容预览: {content_preview[:200]}...")
 
-print("\n--- 搜索结果 ---")
-hits = response['hits']['hits']
-if not hits:
-    print("没有找到匹配的文档。")
-else:
-    for i, hit in enumerate(hits):
-        print(f"\n--- 结果 {i+1} ---")
-        print(f"来源文件: {hit['_source'].get('doc_name', hit['_source'].get('file_name', '未知'))}")
-        print(f"相关度得分: {hit['_score']:.2f}")
-        content_preview = hit['_source']['content'].strip().replace('\n', ' ')
-        print(f"内容预览: {content_preview[:200]}...")
 
+# 解析子进程会重新导入本模块，入口必须放在 __main__ 判断之下
+if __name__ == '__main__':
+    main()
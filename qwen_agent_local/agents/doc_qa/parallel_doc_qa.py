@@ -84,15 +84,11 @@ class ParallelDocQA(Assistant):
 
     def _parse_and_chunk_files(self, messages: List[Message]):
         valid_files = self._get_files(messages)
-        records = []
-        for file in valid_files:
-            # here to split docs, we should decide chunc size by input doc token length
-            # if a document's tokens are below this max_ref_token, it will remain unchunked.
-            _record = self.doc_parse.call(params={'url': file},
-                                          parser_page_size=PARALLEL_CHUNK_SIZE,
-                                          max_ref_token=PARALLEL_CHUNK_SIZE)
-            records.append(_record)
-        return records
+        # here to split docs, we should decide chunc size by input doc token length
+        # if a document's tokens are below this max_ref_token, it will remain unchunked.
+        return self.doc_parse.call_many(valid_files,
+                                        parser_page_size=PARALLEL_CHUNK_SIZE,
+                                        max_ref_token=PARALLEL_CHUNK_SIZE)
 
     def _retrieve_according_to_member_responses(
         self,
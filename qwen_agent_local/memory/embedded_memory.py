@@ -0,0 +1,466 @@
+"""
+单机嵌入式检索后端（Memory(memory_type='embedded')），接口与 ESMemory 一致，无需 Elasticsearch 集群：
+
+- BM25：SQLite FTS5；写入与检索前用与 KeywordSearch 相同的分词（jieba + Snowball 词干）切词，
+  FTS5 内置的 unicode61 分词器无法切分中文；
+- 向量：按行存放于内存映射的 float32 矩阵文件（写入时已归一化），NumPy 矩阵乘法 + argpartition 做余弦 top-k；
+- 所有数据保存在同一目录下：chunks.sqlite3（原文、元数据与 FTS5 索引）与 vectors.f32（向量矩阵）；
+  向量行号在 SQLite 写事务中分配（已用行数记在 meta，释放的行记在 free_rows），多个进程共用同一目录时不会互相覆盖。
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from config import EMBEDDING_DIM
+from qwen_agent_local.log import logger
+from qwen_agent_local.memory.es_memory import (RRF_RANK_CONSTANT, cached_search, chunk_doc_ids,
+                                               reciprocal_rank_fusion)
+from qwen_agent_local.memory.query_cache import QueryCache, bump_generation
+from qwen_agent_local.settings import (DEFAULT_EMBEDDED_MEMORY_PATH, DEFAULT_EMBEDDING_BATCH_SIZE,
+                                       DEFAULT_EMBEDDING_MAX_IN_FLIGHT, DEFAULT_ES_QUERY_CACHE_SIZE)
+from qwen_agent_local.utils.embedding_utils import get_embedding, get_embeddings, iter_embeddings
+
+_INITIAL_CAPACITY = 1024
+_SQL_BATCH = 500  # SQLite 单条语句的参数个数有上限，IN 查询按此大小切分
+
+
+def tokenize(text):
+    """与 KeywordSearch 一致的切词，保证 BM25 的词项与本地检索相同"""
+    from qwen_agent_local.tools.search_tools.keyword_search import split_text_into_keywords
+    return split_text_into_keywords(text)
+
+
+def _fts_query(terms):
+    # 每个词项加引号作为短语，避免词中的特殊字符被当作 FTS5 查询语法
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in dict.fromkeys(terms))
+
+
+def make_snippet(content, terms, snippet_size, snippet_count=1):
+    """截取 content 中包含查询词的窗口（最多 snippet_count 个，每个约 snippet_size 个字符），没有命中时取开头"""
+    lower = content.lower()
+    positions = sorted({pos for pos in (lower.find(term) for term in terms if term) if pos >= 0})
+    windows = []
+    for pos in positions:
+        start = max(0, pos - snippet_size // 4)
+        if windows and start < windows[-1][1]:
+            continue
+        windows.append((start, start + snippet_size))
+        if len(windows) >= snippet_count:
+            break
+    if not windows:
+        return content[:snippet_size]
+    return ' ... '.join(content[start:end] for start, end in windows)
+
+
+class EmbeddedMemory:
+    """
+    与 ESMemory 相同的写入/检索接口：add_chunks / add_chunks_with_embedding / search / embedding_search /
+    hybrid_search / multi_search / delete_doc / bulk_load。
+    原文与向量存于同一张表，add_chunks 只写原文，add_chunks_with_embedding 补齐缺少向量的片段。
+    """
+    unified = False
+
+    def __init__(self, path=DEFAULT_EMBEDDED_MEMORY_PATH, dims=EMBEDDING_DIM):
+        """
+        :param path: 数据目录
+        :param dims: 向量维度，小于 EMBEDDING_DIM 时 embedding 请求同样按该维度生成
+        """
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+        # 查询缓存与写入代数按数据目录区分
+        self.index = self.embedding_index = self.path
+        self.query_cache = QueryCache() if DEFAULT_ES_QUERY_CACHE_SIZE > 0 else None
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(self.path, 'chunks.sqlite3'), check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS chunks ('
+                           'id INTEGER PRIMARY KEY, chunk_key TEXT NOT NULL UNIQUE, doc_name TEXT NOT NULL, '
+                           'chunk_id INTEGER NOT NULL, content TEXT NOT NULL, vec_row INTEGER)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_chunks_doc_name ON chunks (doc_name)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_chunks_vec_row ON chunks (vec_row)')
+        self._conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(tokens)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)')
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'dims'").fetchone()
+        if row is None:
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('dims', ?)", (str(dims), ))
+        elif int(row[0]) != dims:
+            raise ValueError(f'{self.path} stores {row[0]}-d vectors, but dims={dims} was requested.')
+        self._conn.commit()
+        self.dims = dims
+        self._open_vectors()
+
+    # ---------- 向量矩阵 ----------
+
+    def _open_vectors(self):
+        self._vector_path = os.path.join(self.path, 'vectors.f32')
+        self._capacity = 0
+        with self._write():
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'vec_rows'").fetchone() is None:
+                # 旧版本的数据目录：由已用的行推出已分配行数与空闲行
+                used = {r for (r, ) in self._conn.execute('SELECT vec_row FROM chunks WHERE vec_row IS NOT NULL')}
+                n_rows = max(used) + 1 if used else 0
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('vec_rows', ?)", (str(n_rows), ))
+                self._conn.executemany('INSERT OR IGNORE INTO free_rows (row) VALUES (?)',
+                                       [(r, ) for r in range(n_rows) if r not in used])
+            self._load_rows()
+
+    def _load_rows(self):
+        """从 SQLite 重新读取已分配行数与在用的行；其他进程写入后调用"""
+        self._n_rows = int(self._conn.execute("SELECT value FROM meta WHERE key = 'vec_rows'").fetchone()[0])
+        size = os.path.getsize(self._vector_path) if os.path.exists(self._vector_path) else 0
+        capacity = max(_INITIAL_CAPACITY, size // (self.dims * 4), self._n_rows)
+        if capacity > self._capacity:
+            self._map_vectors(capacity)
+        self._alive = np.zeros(self._capacity, dtype=bool)
+        self._alive[[r for (r, ) in self._conn.execute('SELECT vec_row FROM chunks WHERE vec_row IS NOT NULL')]] = True
+        self._data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _sync_rows(self):
+        """其他连接（进程）提交过写入时 data_version 会变化，此时重新读取行的分配情况；需持有 self._lock"""
+        if self._conn.execute('PRAGMA data_version').fetchone()[0] != self._data_version:
+            self._load_rows()
+
+    def _map_vectors(self, capacity):
+        # 只在写事务中扩大文件（其他时候文件已足够大），避免多个进程同时 truncate
+        with open(self._vector_path, 'ab') as f:
+            if f.tell() < capacity * self.dims * 4:
+                f.truncate(capacity * self.dims * 4)
+        self._capacity = capacity
+        self._vectors = np.memmap(self._vector_path, dtype=np.float32, mode='r+', shape=(capacity, self.dims))
+
+    @contextmanager
+    def _write(self):
+        """
+        跨进程串行的写事务：BEGIN IMMEDIATE 立即取得数据库写锁，行号的分配/释放与片段的增删在同一事务中提交；
+        回滚时本进程的行状态可能已改动，下次使用前重新读取
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._capacity:
+                    self._sync_rows()
+                yield
+                self._vectors.flush()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                self._data_version = None
+                raise
+
+    def _alloc_row(self):
+        """分配一个向量行，需在 _write 事务中调用"""
+        row = self._conn.execute('SELECT row FROM free_rows LIMIT 1').fetchone()
+        if row is not None:
+            row = row[0]
+            self._conn.execute('DELETE FROM free_rows WHERE row = ?', (row, ))
+        else:
+            row = self._n_rows
+            self._n_rows += 1
+            self._conn.execute("UPDATE meta SET value = ? WHERE key = 'vec_rows'", (str(self._n_rows), ))
+        if row >= self._capacity:
+            self._vectors.flush()
+            self._map_vectors(self._capacity * 2)
+            self._alive = np.concatenate([self._alive, np.zeros(self._capacity - len(self._alive), dtype=bool)])
+        return row
+
+    def _release_rows(self, rows):
+        """释放向量行，需在 _write 事务中调用"""
+        self._conn.executemany('INSERT OR IGNORE INTO free_rows (row) VALUES (?)', [(row, ) for row in rows])
+        for row in rows:
+            self._alive[row] = False
+
+    # ---------- 写入 ----------
+
+    def _sync_doc(self, doc_name, chunks):
+        """按确定性片段 _id 对比已存片段，新增/更新 chunk_id/删除，返回统计"""
+        ids = chunk_doc_ids(doc_name, chunks)
+        with self._write():
+            existing = {
+                key: (rowid, chunk_id, vec_row)
+                for key, rowid, chunk_id, vec_row in self._conn.execute(
+                    'SELECT chunk_key, id, chunk_id, vec_row FROM chunks WHERE doc_name = ?', (doc_name, ))
+            }
+            new_keys = set(ids)
+            to_add = [idx for idx, key in enumerate(ids) if key not in existing]
+            to_update = [idx for idx, key in enumerate(ids) if key in existing and existing[key][1] != idx]
+            to_delete = [existing[key] for key in existing if key not in new_keys]
+            if to_delete:
+                rowids = [(rowid, ) for rowid, _, _ in to_delete]
+                self._conn.executemany('DELETE FROM chunks WHERE id = ?', rowids)
+                self._conn.executemany('DELETE FROM chunks_fts WHERE rowid = ?', rowids)
+                self._release_rows([vec_row for _, _, vec_row in to_delete if vec_row is not None])
+            for idx in to_add:
+                cursor = self._conn.execute(
+                    'INSERT INTO chunks (chunk_key, doc_name, chunk_id, content) VALUES (?, ?, ?, ?)',
+                    (ids[idx], doc_name, idx, chunks[idx]))
+                self._conn.execute('INSERT INTO chunks_fts (rowid, tokens) VALUES (?, ?)',
+                                   (cursor.lastrowid, ' '.join(tokenize(chunks[idx]))))
+            self._conn.executemany('UPDATE chunks SET chunk_id = ? WHERE id = ?',
+                                   [(idx, existing[ids[idx]][0]) for idx in to_update])
+        if to_add or to_update or to_delete:
+            bump_generation(self.path)
+        return {
+            'indexed': len(to_add),
+            'updated': len(to_update),
+            'deleted': len(to_delete),
+            'unchanged': len(chunks) - len(to_add) - len(to_update),
+            'failed': 0,
+        }
+
+    def add_chunks(self, doc_name, chunks):
+        """
+        增量写入文档片段（原文 + BM25 索引），文档未变化时不产生写入
+        :param doc_name: 文档名
+        :param chunks: List[str]，每个元素为一个片段
+        :return: dict，包含新增/更新/删除/未变化的片段数
+        """
+        return self._sync_doc(doc_name, chunks)
+
+    def add_chunks_with_embedding(self, doc_name, chunks, embedding_client=None,
+                                  batch_size=DEFAULT_EMBEDDING_BATCH_SIZE,
+                                  max_in_flight=DEFAULT_EMBEDDING_MAX_IN_FLIGHT,
+                                  progress_every=500,
+                                  known_vectors=None):
+        """
+        增量写入文档片段，并为尚无向量的片段生成 embedding；参数与返回值同 ESMemory.add_chunks_with_embedding
+        """
+        known_vectors = known_vectors or {}
+        start = time.time()
+        with self._lock:
+            stats = self._sync_doc(doc_name, chunks)
+            missing = self._conn.execute(
+                'SELECT id, chunk_id, content FROM chunks WHERE doc_name = ? AND vec_row IS NULL',
+                (doc_name, )).fetchall()
+        stats['embedded'] = 0
+        known = [(rowid, known_vectors[chunk_id]) for rowid, chunk_id, _ in missing if known_vectors.get(chunk_id)]
+        to_embed = [(rowid, content) for rowid, chunk_id, content in missing if not known_vectors.get(chunk_id)]
+        if known:
+            self._put_vectors(known)
+            stats['embedded'] += len(known)
+        batch = []
+        for i, embedding in iter_embeddings([content for _, content in to_embed],
+                                            client=embedding_client,
+                                            batch_size=batch_size,
+                                            max_in_flight=max_in_flight,
+                                            dimensions=self.dims):
+            if embedding:
+                batch.append((to_embed[i][0], embedding))
+            if len(batch) >= batch_size:
+                self._put_vectors(batch)
+                stats['embedded'] += len(batch)
+                batch = []
+                if progress_every and stats['embedded'] % progress_every < batch_size:
+                    elapsed = time.time() - start
+                    logger.info(f'[Embedded ingest] {doc_name}: {stats["embedded"]}/{len(missing)} chunks, '
+                                f'{stats["embedded"] / max(elapsed, 1e-6):.1f} chunks/s')
+        if batch:
+            self._put_vectors(batch)
+            stats['embedded'] += len(batch)
+        elapsed = time.time() - start
+        stats.update({'seconds': elapsed, 'chunks_per_second': stats['embedded'] / max(elapsed, 1e-6)})
+        return stats
+
+    def _put_vectors(self, items):
+        """items: List[(chunks.id, 向量)]；片段在生成 embedding 期间被删除时跳过"""
+        updates = []
+        with self._write():
+            for rowid, vector in items:
+                if self._conn.execute('SELECT 1 FROM chunks WHERE id = ? AND vec_row IS NULL',
+                                      (rowid, )).fetchone() is None:
+                    continue
+                vector = np.asarray(vector, dtype=np.float32)
+                row = self._alloc_row()
+                self._vectors[row] = vector / max(float(np.linalg.norm(vector)), 1e-12)
+                self._alive[row] = True
+                updates.append((row, rowid))
+            self._conn.executemany('UPDATE chunks SET vec_row = ? WHERE id = ?', updates)
+        if updates:
+            bump_generation(self.path)
+
+    @contextmanager
+    def bulk_load(self, force_merge=False):
+        """与 ESMemory.bulk_load 对应；force_merge 时退出后合并 FTS5 索引段"""
+        try:
+            yield self
+        finally:
+            if force_merge:
+                with self._lock:
+                    self._conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('optimize')")
+                    self._conn.commit()
+            bump_generation(self.path)
+
+    def delete_doc(self, doc_name):
+        """
+        删除指定文档的所有片段
+        """
+        with self._write():
+            rows = self._conn.execute('SELECT id, vec_row FROM chunks WHERE doc_name = ?', (doc_name, )).fetchall()
+            self._conn.executemany('DELETE FROM chunks_fts WHERE rowid = ?', [(rowid, ) for rowid, _ in rows])
+            self._conn.execute('DELETE FROM chunks WHERE doc_name = ?', (doc_name, ))
+            self._release_rows([vec_row for _, vec_row in rows if vec_row is not None])
+        bump_generation(self.path)
+
+    # ---------- 检索 ----------
+
+    @cached_search
+    def search(self, query, top_k=5, doc_names=None, snippet_size=None, snippet_count=1, return_vector=False):
+        """
+        BM25 检索最相关的文档片段，参数同 ESMemory.search
+        """
+        if doc_names is not None and not doc_names:
+            return []
+        terms = tokenize(query)
+        return self._finish(self._bm25(terms, top_k, doc_names), 'bm25', terms, snippet_size, snippet_count,
+                            return_vector)
+
+    @cached_search
+    def embedding_search(self, query, top_k=5, embedding_client=None, doc_names=None, snippet_size=None,
+                         snippet_count=1, return_vector=False):
+        """
+        embedding 向量检索最相关的文档片段（精确余弦 top-k），参数同 ESMemory.embedding_search
+        """
+        if doc_names is not None and not doc_names:
+            return []
+        query_vector = get_embedding(query, client=embedding_client, dimensions=self.dims)
+        return self._finish(self._knn(query_vector, top_k, doc_names), 'embedding', tokenize(query), snippet_size,
+                            snippet_count, return_vector)
+
+    @cached_search
+    def hybrid_search(self, query, top_k=5, embedding_client=None, window_size=None,
+                      rank_constant=RRF_RANK_CONSTANT, doc_names=None, snippet_size=None, snippet_count=1,
+                      return_vector=False):
+        """
+        BM25+embedding hybrid 检索，按排名做 RRF 融合，参数同 ESMemory.hybrid_search
+        """
+        return self._fused_search([query], [], 'hybrid', top_k, embedding_client, window_size, rank_constant,
+                                  doc_names, snippet_size, snippet_count, return_vector)
+
+    @cached_search
+    def multi_search(self, queries, top_k=5, keywords=None, mode='hybrid', embedding_client=None, window_size=None,
+                     rank_constant=RRF_RANK_CONSTANT, doc_names=None, snippet_size=None, snippet_count=1,
+                     return_vector=False):
+        """
+        多个子查询一起检索并按 RRF 融合，参数同 ESMemory.multi_search
+        """
+        return self._fused_search(queries, keywords or [], mode, top_k, embedding_client, window_size,
+                                  rank_constant, doc_names, snippet_size, snippet_count, return_vector)
+
+    def _fused_search(self, queries, keywords, mode, top_k, embedding_client, window_size, rank_constant, doc_names,
+                      snippet_size, snippet_count, return_vector):
+        if doc_names is not None and not doc_names:
+            return []
+        queries = [q for q in dict.fromkeys(queries) if q and q.strip()]
+        keywords = [k for k in dict.fromkeys(keywords) if k and k.strip()] if mode != 'embedding' else []
+        window_size = window_size or top_k * 4
+        all_terms = [t for q in queries + keywords for t in tokenize(q)]
+        result_lists = []
+        if mode in ('bm25', 'hybrid'):
+            for q in queries + keywords:
+                result_lists.append(self._finish(self._bm25(tokenize(q), window_size, doc_names), 'bm25', all_terms,
+                                                 snippet_size, snippet_count, return_vector))
+        if mode in ('embedding', 'hybrid') and queries:
+            for vector in get_embeddings(queries, client=embedding_client, dimensions=self.dims):
+                if vector:
+                    result_lists.append(self._finish(self._knn(vector, window_size, doc_names), 'embedding',
+                                                     all_terms, snippet_size, snippet_count, return_vector))
+        if len(result_lists) == 1:
+            return result_lists[0][:top_k]
+        return reciprocal_rank_fusion(result_lists, top_k=top_k, rank_constant=rank_constant)
+
+    def _doc_clauses(self, doc_names, column='doc_name'):
+        """doc_names 过滤条件，按 _SQL_BATCH 切分为多条 IN 子句（每条对应一次查询）；doc_names 为 None 时不过滤"""
+        if doc_names is None:
+            return [('', [])]
+        doc_names = list(dict.fromkeys(doc_names))
+        return [(f' AND {column} IN ({",".join("?" * len(part))})', part)
+                for part in (doc_names[start:start + _SQL_BATCH] for start in range(0, len(doc_names), _SQL_BATCH))]
+
+    def _bm25(self, terms, top_k, doc_names):
+        """:return: List[(chunks.id, score)]，FTS5 的 bm25() 越小越相关，这里取负值使分数越大越相关"""
+        if not terms:
+            return []
+        hits = []
+        with self._lock:
+            # bm25() 的词项统计是全索引的，按文档分批查询后的分数可以直接合并排序
+            for clause, args in self._doc_clauses(doc_names, 'c.doc_name'):
+                hits.extend(self._conn.execute(
+                    'SELECT c.id, bm25(chunks_fts) AS rank FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid '
+                    f'WHERE chunks_fts MATCH ?{clause} ORDER BY rank LIMIT ?', [_fts_query(terms)] + args + [top_k]))
+        hits.sort(key=lambda hit: hit[1])
+        return [(rowid, -rank) for rowid, rank in hits[:top_k]]
+
+    def _knn(self, query_vector, top_k, doc_names):
+        """:return: List[(chunks.id, cosine score)]"""
+        if not query_vector:
+            return []
+        q = np.asarray(query_vector, dtype=np.float32)
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        with self._lock:
+            self._sync_rows()
+            if doc_names is None:
+                rows = None
+                scores = self._vectors[:self._n_rows] @ q
+                scores[~self._alive[:self._n_rows]] = -np.inf
+                n_candidates = int(self._alive[:self._n_rows].sum())
+            else:
+                # 只计算会话文档的向量，代价与会话规模而非语料规模成正比
+                rows = np.array([
+                    r for clause, args in self._doc_clauses(doc_names)
+                    for (r, ) in self._conn.execute(f'SELECT vec_row FROM chunks WHERE vec_row IS NOT NULL{clause}',
+                                                    args)
+                ], dtype=np.int64)
+                scores = self._vectors[rows] @ q if len(rows) else np.zeros(0, dtype=np.float32)
+                n_candidates = len(rows)
+            k = min(top_k, n_candidates)
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            vec_rows = top if rows is None else rows[top]
+            row_scores = {int(r): float(scores[i]) for r, i in zip(vec_rows, top)}
+            found = {}
+            keys = list(row_scores)
+            for start in range(0, len(keys), _SQL_BATCH):
+                part = keys[start:start + _SQL_BATCH]
+                for rowid, vec_row in self._conn.execute(
+                        f'SELECT id, vec_row FROM chunks WHERE vec_row IN ({",".join("?" * len(part))})', part):
+                    found[vec_row] = rowid
+        return [(found[r], score) for r, score in row_scores.items() if r in found]
+
+    def _finish(self, hits, source, terms, snippet_size, snippet_count, return_vector):
+        """把 [(chunks.id, score)] 转成与 ESMemory 相同格式的结果"""
+        if not hits:
+            return []
+        rowids = [rowid for rowid, _ in hits]
+        with self._lock:
+            if return_vector:
+                self._sync_rows()
+            rows = {}
+            for start in range(0, len(rowids), _SQL_BATCH):
+                part = rowids[start:start + _SQL_BATCH]
+                for rowid, doc_name, chunk_id, content, vec_row in self._conn.execute(
+                        'SELECT id, doc_name, chunk_id, content, vec_row FROM chunks '
+                        f'WHERE id IN ({",".join("?" * len(part))})', part):
+                    rows[rowid] = (doc_name, chunk_id, content, vec_row)
+            results = []
+            for rowid, score in hits:
+                if rowid not in rows:
+                    continue
+                doc_name, chunk_id, content, vec_row = rows[rowid]
+                r = {
+                    'doc_name': doc_name,
+                    'chunk_id': chunk_id,
+                    'content': make_snippet(content, terms, snippet_size, snippet_count) if snippet_size else content,
+                    'score': score,
+                    'source': source
+                }
+                if return_vector and vec_row is not None:
+                    r['content_vector'] = self._vectors[vec_row].tolist()
+                results.append(r)
+        return results
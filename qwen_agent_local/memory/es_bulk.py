@@ -0,0 +1,148 @@
+"""
+ES 批量写入工具：
+
+- bulk_load：大批量导入期间关闭自动 refresh、去掉副本，结束后恢复设置、refresh 一次并可选 force merge；
+- AdaptiveBulkWriter：根据 bulk 请求耗时与 429 拒绝动态调整每批大小，并对被拒绝的条目退避重试。
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Tuple
+
+from elasticsearch import ApiError
+from elasticsearch.helpers import expand_action
+
+from qwen_agent_local.log import logger
+
+_loading = {}  # 正在批量导入的索引 -> 嵌套层数，嵌套使用时只在最外层修改/恢复设置
+_loading_lock = threading.Lock()
+
+
+@contextmanager
+def bulk_load(es, index: str, force_merge: bool = False, max_num_segments: int = 1, drop_replicas: bool = True):
+    """
+    批量导入模式：refresh_interval 设为 -1，可选去掉副本；退出时恢复原设置并 refresh 一次
+    :param force_merge: 退出时是否 force merge 到 max_num_segments 个段
+    """
+    with _loading_lock:
+        depth = _loading.get(index, 0)
+        _loading[index] = depth + 1
+    if depth:
+        try:
+            yield
+        finally:
+            with _loading_lock:
+                _loading[index] -= 1
+        return
+
+    settings = es.indices.get_settings(index=index, flat_settings=True)[index]['settings']
+    # 未显式设置过的项恢复为 None，即回到 ES 默认值
+    old_settings = {'index.refresh_interval': settings.get('index.refresh_interval')}
+    new_settings = {'index.refresh_interval': '-1'}
+    if drop_replicas:
+        old_settings['index.number_of_replicas'] = settings.get('index.number_of_replicas')
+        new_settings['index.number_of_replicas'] = 0
+    es.indices.put_settings(index=index, settings=new_settings)
+    logger.info(f'[ES bulk load] {index}: refresh disabled, settings to restore: {old_settings}')
+    try:
+        yield
+    finally:
+        with _loading_lock:
+            del _loading[index]
+        es.indices.put_settings(index=index, settings=old_settings)
+        es.indices.refresh(index=index)
+        if force_merge:
+            logger.info(f'[ES bulk load] {index}: force merging to {max_num_segments} segment(s)...')
+            es.options(request_timeout=3600).indices.forcemerge(index=index, max_num_segments=max_num_segments)
+        logger.info(f'[ES bulk load] {index}: settings restored.')
+
+
+class AdaptiveBulkWriter:
+    """
+    自适应 bulk 写入：请求耗时超过 target_latency 或出现 429 拒绝时每批减半，耗时明显低于目标时逐步增大；
+    被拒绝的条目按指数退避重试，最多 max_retries 次。write() 的产出格式与 helpers.streaming_bulk 一致。
+    """
+
+    def __init__(self,
+                 es,
+                 chunk_size: int = 500,
+                 min_chunk_size: int = 50,
+                 max_chunk_size: int = 5000,
+                 target_latency: float = 1.0,
+                 max_retries: int = 8,
+                 initial_backoff: float = 0.5,
+                 max_backoff: float = 30.0):
+        self.es = es
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.rejected = 0
+        self.requests = 0
+
+    def write(self, actions: Iterable[dict]) -> Iterator[Tuple[bool, dict]]:
+        batch = []
+        for action in actions:
+            batch.append(expand_action(action))
+            if len(batch) >= self.chunk_size:
+                yield from self._send(batch)
+                batch = []
+        if batch:
+            yield from self._send(batch)
+
+    def _send(self, batch: list) -> Iterator[Tuple[bool, dict]]:
+        attempt = 0
+        while batch:
+            body = []
+            for action_line, data in batch:
+                body.append(action_line)
+                if data is not None:
+                    body.append(data)
+            start = time.time()
+            try:
+                resp = self.es.bulk(operations=body)
+            except ApiError as ex:
+                if ex.meta.status != 429 or attempt >= self.max_retries:
+                    raise
+                self.rejected += len(batch)
+                self._adapt(latency=None, rejected=True)
+                self._sleep(attempt)
+                attempt += 1
+                continue
+            finally:
+                self.requests += 1
+            latency = time.time() - start
+
+            retry = []
+            for (action_line, data), item in zip(batch, resp['items']):
+                op_type, result = next(iter(item.items()))
+                status = result.get('status', 500)
+                if status == 429 and attempt < self.max_retries:
+                    retry.append((action_line, data))
+                elif 200 <= status < 300 or (op_type == 'delete' and status == 404):
+                    yield True, item
+                else:
+                    yield False, item
+            self.rejected += len(retry)
+            self._adapt(latency=latency, rejected=bool(retry))
+            if retry:
+                self._sleep(attempt)
+                attempt += 1
+            batch = retry
+
+    def _adapt(self, latency, rejected: bool) -> None:
+        old = self.chunk_size
+        if rejected or latency > self.target_latency:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+        elif latency < self.target_latency / 2:
+            self.chunk_size = min(self.max_chunk_size, int(self.chunk_size * 1.5))
+        if self.chunk_size != old:
+            logger.debug(f'[ES bulk] chunk size {old} -> {self.chunk_size} (latency={latency}, rejected={rejected})')
+
+    def _sleep(self, attempt: int) -> None:
+        backoff = min(self.max_backoff, self.initial_backoff * (2**attempt))
+        time.sleep(backoff * (0.5 + random.random() / 2))
@@ -0,0 +1,208 @@
+"""
+多进程、可断点续传的文档入库流水线：
+
+    解析（进程池，DocParser 同款按 token 分块） -> 有界队列 -> embedding + bulk 写入（ESMemory，增量写入）
+
+每完成一个文档即追加一行到 checkpoint 文件，中断后重新运行会跳过已完成且未修改（mtime/size 相同）的文档。
+"""
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from qwen_agent_local.log import logger
+from qwen_agent_local.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE
+
+_doc_parser = None
+
+# 向写线程交付结果时单次等待的秒数，超时后检查写线程是否仍存活
+_PUT_TIMEOUT = 1.0
+
+
+def _init_worker(max_ref_token: int, parser_page_size: int):
+    global _doc_parser
+    from qwen_agent_local.tools.doc_parser import DocParser
+    _doc_parser = DocParser({'max_ref_token': max_ref_token, 'parser_page_size': parser_page_size})
+
+
+def _parse_file(path: str) -> dict:
+    """在子进程中解析并分块，分块结果同时写入 DocParser 缓存，运行时检索可直接复用"""
+    start = time.time()
+    record = _doc_parser.call(params={'url': path})
+    return {
+        'path': path,
+        'chunks': [chunk['content'] for chunk in record['raw']],
+        'parse_seconds': time.time() - start,
+    }
+
+
+def file_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+class Checkpoint:
+    """JSON Lines 格式的断点文件，每行记录一个已完成文档的 path/mtime/size"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 中断时可能留下写了一半的最后一行
+                        continue
+                    self.done[item['path']] = item
+
+    def is_done(self, path: str) -> bool:
+        sig = file_signature(path)
+        item = self.done.get(sig['path'])
+        return item is not None and item['mtime'] == sig['mtime'] and item['size'] == sig['size']
+
+    def mark_done(self, path: str, **extra) -> None:
+        item = dict(file_signature(path), **extra)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done[item['path']] = item
+
+    def reset(self) -> None:
+        self.done = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def ingest_files(files: List[str],
+                 es_memory,
+                 checkpoint: Optional[Checkpoint] = None,
+                 workers: Optional[int] = None,
+                 with_embedding: bool = False,
+                 queue_size: int = 8,
+                 max_ref_token: int = DEFAULT_MAX_REF_TOKEN,
+                 parser_page_size: int = DEFAULT_PARSER_PAGE_SIZE,
+                 force_merge: bool = False) -> dict:
+    """
+    并行解析 files 并写入 ES
+    :param es_memory: ESMemory 实例
+    :param checkpoint: 断点文件，为 None 时不记录、不跳过
+    :param workers: 解析进程数，默认为 CPU 核数
+    :param with_embedding: 双索引布局下是否同时写入 embedding 索引（统一索引总会写入向量）
+    :param queue_size: 解析完成、等待写入的文档数上限；写入跟不上时解析会暂停，避免占用过多内存
+    :return: dict，包含完成/失败/跳过的文档数、片段数、耗时与吞吐
+    """
+    start = time.time()
+    todo = [f for f in files if checkpoint is None or not checkpoint.is_done(f)]
+    stats = {'docs': 0, 'failed': 0, 'skipped': len(files) - len(todo), 'chunks': 0}
+    if stats['skipped']:
+        logger.info(f'[ES ingest] Resuming: skip {stats["skipped"]} finished documents.')
+    if not todo:
+        stats.update({'seconds': 0.0, 'chunks_per_second': 0.0})
+        return stats
+
+    parsed = queue.Queue(maxsize=queue_size)
+    writer_error = []
+
+    def write_loop():
+        try:
+            _write_loop()
+        except BaseException as ex:
+            # 写线程异常退出后主线程不能再阻塞在 put 上，记录异常交由主线程抛出
+            logger.error(f'[ES ingest] Writer thread failed: {ex}')
+            writer_error.append(ex)
+
+    def hand_over(item):
+        """把解析结果交给写线程；队列满时等待，写线程退出则抛出其异常"""
+        while True:
+            if writer_error:
+                raise writer_error[0]
+            if not writer.is_alive():
+                raise RuntimeError('[ES ingest] Writer thread exited unexpectedly')
+            try:
+                parsed.put(item, timeout=_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def _write_loop():
+        while True:
+            item = parsed.get()
+            if item is None:
+                return
+            path, chunks = item['path'], item['chunks']
+            doc_name = os.path.basename(path)
+            try:
+                result = es_memory.add_chunks(doc_name, chunks)
+                if with_embedding and not es_memory.unified:
+                    emb_result = es_memory.add_chunks_with_embedding(doc_name, chunks)
+                    result['failed'] += emb_result['failed']
+            except Exception as ex:
+                logger.error(f'[ES ingest] Failed to write {path}: {ex}')
+                stats['failed'] += 1
+                continue
+            if result['failed']:
+                stats['failed'] += 1
+                continue
+            stats['docs'] += 1
+            stats['chunks'] += len(chunks)
+            if checkpoint is not None:
+                checkpoint.mark_done(path, chunks=len(chunks))
+            elapsed = time.time() - start
+            logger.info(f'[ES ingest] {stats["docs"] + stats["failed"]}/{len(todo)} docs, {doc_name}: '
+                        f'{len(chunks)} chunks (parsed in {item["parse_seconds"]:.1f}s), '
+                        f'{stats["chunks"] / max(elapsed, 1e-6):.1f} chunks/s overall')
+
+    writer = threading.Thread(target=write_loop, daemon=True)
+    workers = workers or os.cpu_count() or 1
+    parse_failed = 0
+    with es_memory.bulk_load(force_merge=force_merge):
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_worker,
+                                     initargs=(max_ref_token, parser_page_size)) as executor:
+                pending = set()
+                next_file = 0
+                while next_file < len(todo) or pending:
+                    while next_file < len(todo) and len(pending) < workers * 2:
+                        future = executor.submit(_parse_file, todo[next_file])
+                        future.path = todo[next_file]
+                        pending.add(future)
+                        next_file += 1
+                    if writer.ident is None:
+                        # fork 方式下解析进程在首次 submit 时一次性创建，写线程在此之后启动，避免子进程继承其锁状态
+                        writer.start()
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            item = future.result()
+                        except Exception as ex:
+                            logger.error(f'[ES ingest] Failed to parse {future.path}: {ex}')
+                            parse_failed += 1
+                            continue
+                        # 队列已满时在此等待，解析进程随之停止提交新任务
+                        hand_over(item)
+        finally:
+            if writer.ident is not None:
+                while writer.is_alive():
+                    try:
+                        parsed.put(None, timeout=_PUT_TIMEOUT)
+                        break
+                    except queue.Full:
+                        continue
+                writer.join()
+    if writer_error:
+        raise writer_error[0]
+
+    stats['failed'] += parse_failed
+    elapsed = time.time() - start
+    stats.update({'seconds': elapsed, 'chunks_per_second': stats['chunks'] / max(elapsed, 1e-6)})
+    return stats
@@ -0,0 +1,162 @@
+"""
+ESMemory.embedding_search 的 kNN 召回率/延迟自动调优。
+
+以索引中已存储的向量做精确暴力检索得到 ground truth，对每个目标 top_k 扫描一组 num_candidates，
+记录 recall@k 与 p50/p95 延迟，选出满足目标召回率的最小 num_candidates，
+并写入 embedding 索引 mapping 的 `_meta.knn_policy`，之后 ESMemory 检索时自动采用。
+
+用法：
+    python -m qwen_agent_local.memory.es_knn_tuner --top-k 3 5 10 20 --target-recall 0.95
+"""
+import argparse
+import time
+from typing import List, Sequence
+
+import numpy as np
+from elasticsearch import helpers
+
+from qwen_agent_local.log import logger
+from qwen_agent_local.memory.es_memory import ESMemory
+
+DEFAULT_CANDIDATE_GRID = (10, 20, 40, 60, 100, 150, 200, 300, 500, 800, 1000)
+
+
+def load_vectors(es, index):
+    """读出索引中的全部向量（按 cosine 相似度的需要做归一化）"""
+    ids, vectors = [], []
+    for hit in helpers.scan(es, index=index, query={'query': {'exists': {'field': 'content_vector'}}},
+                            _source=['content_vector']):
+        ids.append(hit['_id'])
+        vectors.append(hit['_source']['content_vector'])
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors):
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return ids, vectors
+
+
+def exact_topk(queries: np.ndarray, vectors: np.ndarray, k: int, exclude: Sequence[int], batch_size: int = 50000):
+    """
+    分批暴力计算每个查询的精确 top-k（排除查询向量自身），返回 List[set(向量下标)]
+    """
+    n_queries = len(queries)
+    best_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+    best_ids = np.full((n_queries, k), -1, dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        scores = queries @ vectors[start:start + batch_size].T
+        for qi, self_id in enumerate(exclude):
+            if start <= self_id < start + batch_size:
+                scores[qi, self_id - start] = -np.inf
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_ids = np.concatenate(
+            [best_ids, np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)], axis=1)
+        top = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(merged_scores, top, axis=1)
+        best_ids = np.take_along_axis(merged_ids, top, axis=1)
+    return [set(row[row >= 0].tolist()) for row in best_ids]
+
+
+def tune_knn(es_memory: ESMemory,
+             top_ks: Sequence[int] = (3, 5, 10, 20),
+             candidate_grid: Sequence[int] = DEFAULT_CANDIDATE_GRID,
+             target_recall: float = 0.95,
+             sample_size: int = 200,
+             seed: int = 0,
+             save: bool = True) -> dict:
+    """
+    :param top_ks: 需要调优的 top_k 列表
+    :param candidate_grid: 待扫描的 num_candidates
+    :param target_recall: 目标 recall@k，选满足该召回率的最小 num_candidates；都达不到时取召回率最高的
+    :param sample_size: 查询样本数（从已存储的向量中随机抽取，ground truth 中排除查询自身）
+    :param save: 是否把策略写入索引 mapping 的 `_meta` 并立即在 es_memory 上生效
+    :return: 策略 dict
+    """
+    es, index = es_memory.es, es_memory.embedding_index
+    ids, vectors = load_vectors(es, index)
+    if not ids:
+        raise ValueError(f'No vectors found in {index}.')
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(ids), size=min(sample_size, len(ids)), replace=False)
+    queries = vectors[sample]
+    max_k = max(top_ks)
+    logger.info(f'[kNN tune] {index}: computing exact top-{max_k} for {len(sample)} queries over {len(ids)} vectors')
+    truth_max = exact_topk(queries, vectors, max_k, exclude=sample)
+    # 同分情况下截断到 k 时取相似度最高的 k 个
+    truth_order = [sorted(t, key=lambda i, q=q: -float(vectors[i] @ q)) for t, q in zip(truth_max, queries)]
+
+    measurements: List[dict] = []
+    policy = {}
+    for k in sorted(top_ks):
+        best = None
+        for num_candidates in sorted(c for c in candidate_grid if c >= k):
+            latencies, recalls = [], []
+            for qi, q in zip(sample, queries):
+                start = time.time()
+                res = es.search(index=index,
+                                knn={
+                                    'field': 'content_vector',
+                                    'query_vector': q.tolist(),
+                                    'k': k + 1,
+                                    'num_candidates': max(num_candidates, k + 1)
+                                },
+                                size=k + 1,
+                                source=False)
+                latencies.append((time.time() - start) * 1000)
+                got = [hit['_id'] for hit in res['hits']['hits'] if hit['_id'] != ids[qi]][:k]
+                truth = {ids[i] for i in truth_order[len(recalls)][:k]}
+                recalls.append(len(set(got) & truth) / max(len(truth), 1))
+            row = {
+                'k': k,
+                'num_candidates': num_candidates,
+                'recall': float(np.mean(recalls)),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p95_ms': float(np.percentile(latencies, 95)),
+            }
+            measurements.append(row)
+            logger.info(f'[kNN tune] {row}')
+            if best is None or row['recall'] > best['recall']:
+                best = row
+            if row['recall'] >= target_recall:
+                best = row
+                break
+        policy[str(k)] = best['num_candidates']
+
+    result = {
+        'num_candidates': policy,
+        'target_recall': target_recall,
+        'vector_count': len(ids),
+        'sample_size': len(sample),
+        'measurements': measurements,
+        'tuned_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    if save:
+        meta = es.indices.get_mapping(index=index)[index]['mappings'].get('_meta', {})
+        meta['knn_policy'] = result
+        es.indices.put_mapping(index=index, meta=meta)
+        es_memory.knn_policy = result
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ESMemory kNN 参数自动调优')
+    parser.add_argument('--top-k', type=int, nargs='+', default=[3, 5, 10, 20])
+    parser.add_argument('--candidates', type=int, nargs='+', default=list(DEFAULT_CANDIDATE_GRID))
+    parser.add_argument('--target-recall', type=float, default=0.95)
+    parser.add_argument('--sample-size', type=int, default=200)
+    parser.add_argument('--dry-run', action='store_true', help='只输出结果，不写入索引')
+    args = parser.parse_args()
+
+    result = tune_knn(ESMemory(),
+                      top_ks=args.top_k,
+                      candidate_grid=args.candidates,
+                      target_recall=args.target_recall,
+                      sample_size=args.sample_size,
+                      save=not args.dry_run)
+    print('| k | num_candidates | recall | p50_ms | p95_ms |')
+    print('|---|---|---|---|---|')
+    for row in result['measurements']:
+        print(f"| {row['k']} | {row['num_candidates']} | {row['recall']:.3f} | {row['p50_ms']:.1f} | {row['p95_ms']:.1f} |")
+    print(f"\n策略（top_k -> num_candidates）: {result['num_candidates']}")
+
+
+if __name__ == '__main__':
+    main()
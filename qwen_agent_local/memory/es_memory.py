@@ -1,13 +1,186 @@
+import functools
+import inspect
+import json
 import os
-from elasticsearch import Elasticsearch, helpers
+import re
+import time
+from contextlib import ExitStack, contextmanager
+from elasticsearch import ApiError, Elasticsearch
 from config import ES_HOST, ES_USERNAME, ES_PASSWORD, ES_INDEX, ES_EMBEDDING_INDEX, EMBEDDING_DIM
-from qwen_agent_local.utils.embedding_utils import get_embedding
+from qwen_agent_local.log import logger
+from qwen_agent_local.memory.es_bulk import AdaptiveBulkWriter, bulk_load
+from qwen_agent_local.memory.query_cache import QueryCache, bump_generation, get_generation, normalize_query
+from qwen_agent_local.settings import (DEFAULT_EMBEDDING_BATCH_SIZE, DEFAULT_EMBEDDING_MAX_IN_FLIGHT,
+                                       DEFAULT_ES_QUERY_CACHE_SIZE, DEFAULT_ES_ROUTE_BY_DOC, DEFAULT_ES_UNIFIED_INDEX,
+                                       DEFAULT_ES_VECTOR_OPTIONS)
+from qwen_agent_local.utils.embedding_utils import get_embedding, get_embeddings, iter_embeddings
+from qwen_agent_local.utils.utils import hash_sha256
+
+RRF_RANK_CONSTANT = 60
+RESULT_SOURCE_FIELDS = ['doc_name', 'chunk_id', 'content']  # 检索结果默认只取回这些字段，不返回向量
+PAGE_MARK_RE = re.compile(r'^\[page: (\d+)\]')
+MAX_NUM_CANDIDATES = 10000  # ES knn 的 num_candidates 上限
+
+
+def reciprocal_rank_fusion(result_lists, top_k=5, rank_constant=RRF_RANK_CONSTANT):
+    """
+    按排名融合多路检索结果（RRF），同一片段 (doc_name, chunk_id) 的得分为各路 1 / (rank_constant + rank) 之和
+    :param result_lists: List[List[dict]]，每一路结果需已按相关度降序排列
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, r in enumerate(results, start=1):
+            key = (r['doc_name'], r['chunk_id'])
+            if key not in fused:
+                fused[key] = dict(r, score=0.0, source='hybrid')
+            fused[key]['score'] += 1.0 / (rank_constant + rank)
+    return sorted(fused.values(), key=lambda x: x['score'], reverse=True)[:top_k]
+
+
+def chunk_doc_ids(doc_name, chunks):
+    """
+    为文档片段生成确定性的 ES _id：由 (doc_name, sha256(content)) 派生，同一文档内内容相同的片段再附加出现序号
+    :return: List[str]，与 chunks 一一对应
+    """
+    ids = []
+    seen = {}
+    for chunk in chunks:
+        content_hash = hash_sha256(chunk)
+        occurrence = seen.get(content_hash, 0)
+        seen[content_hash] = occurrence + 1
+        key = f'{doc_name}\n{content_hash}' if occurrence == 0 else f'{doc_name}\n{content_hash}\n{occurrence}'
+        ids.append(hash_sha256(key))
+    return ids
+
+
+def parse_keygen_query(query):
+    """
+    拆解 keygen 策略（SplitQuery / GenKeyword 等）的输出，便于分别检索
+    :param query: 原始问题，或形如 {"text": "...", "keywords_zh": [...], "keywords_en": [...]} 的 JSON 字符串，
+        其中 text 可能是 SplitQuery 拆出的多条信息（以换行分隔）
+    :return: (sub_queries, keywords)：sub_queries 同时做 BM25 与向量检索；keywords 为各语种关键词拼成的查询，只做 BM25
+    """
+    try:
+        keygen = json.loads(query)
+    except (TypeError, ValueError):
+        keygen = None
+    if not isinstance(keygen, dict):
+        return [query], []
+    sub_queries = [line.strip() for line in str(keygen.get('text', '')).split('\n') if line.strip()]
+    keywords = []
+    for key, words in keygen.items():
+        if key.startswith('keywords') and isinstance(words, list):
+            keywords.append(' '.join(str(w) for w in words if str(w).strip()))
+    keywords = [k for k in keywords if k]
+    return list(dict.fromkeys(sub_queries)), list(dict.fromkeys(keywords))
+
+
+# 参与缓存键时做归一化的查询文本参数，其余参数（doc_names、mode 等）按原值比较
+_QUERY_TEXT_ARGS = ('query', 'queries', 'keywords')
+
+
+def _freeze(name, value):
+    """把检索参数转为可哈希的缓存键：只归一化查询文本，doc_names 与顺序无关"""
+    if name == 'doc_names' and value is not None:
+        return tuple(sorted(set(value)))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(name, v) for v in value)
+    if isinstance(value, str) and name in _QUERY_TEXT_ARGS:
+        return normalize_query(value)
+    return value
+
+
+def _error_reasons(info):
+    """收集 ES 错误响应中各层 type/reason 文本（含 root_cause、caused_by）"""
+    if isinstance(info, dict):
+        texts = [str(info[k]) for k in ('type', 'reason') if info.get(k)]
+        for value in info.values():
+            if isinstance(value, (dict, list)):
+                texts.extend(_error_reasons(value))
+        return texts
+    if isinstance(info, list):
+        return [text for item in info for text in _error_reasons(item)]
+    return []
+
+
+def _rrf_unsupported(ex):
+    """服务端 RRF 的报错是否意味着集群不支持：license 不允许，或版本过低不认识 rank 参数"""
+    reasons = ' '.join([str(ex.error)] + _error_reasons(ex.info)).lower()
+    if 'license' in reasons:
+        return True
+    return 'rank' in reasons and any(word in reasons for word in ('unknown', 'unrecognized', 'not supported'))
+
+
+def cached_search(func):
+    """
+    检索结果缓存：键为 (检索方法, 归一化后的参数, 涉及索引的写入代数)，embedding_client 不参与；
+    add_chunks*/delete_doc 写入后代数递增，旧结果不会再被返回
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.query_cache is None:
+            return func(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (func.__name__, get_generation(self.index), get_generation(self.embedding_index)) + tuple(
+            (name, _freeze(name, value)) for name, value in bound.arguments.items()
+            if name not in ('self', 'embedding_client'))
+        results = self.query_cache.get(key)
+        if results is None:
+            results = func(self, *args, **kwargs)
+            self.query_cache.put(key, results)
+        # 返回副本，调用方修改结果不影响缓存
+        return [dict(r) for r in results]
+
+    return wrapper
+
+
+def vector_mapping(dims, vector_options=None):
+    """
+    content_vector 字段的 mapping，按 vector_options 设置 HNSW 参数
+    向量以 float 写入，压缩只通过 index_type 的量化（int8_hnsw 等）在服务端完成，因此不支持 element_type
+    """
+    vector_options = vector_options or {}
+    if vector_options.get('element_type', 'float') != 'float':
+        raise ValueError(f'Unsupported element_type {vector_options["element_type"]!r}: embeddings are written as '
+                         f'floats, use a quantized index_type such as int8_hnsw instead')
+    mapping = {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": "cosine"
+    }
+    index_options = {k: vector_options[k] for k in ('m', 'ef_construction') if k in vector_options}
+    if vector_options.get('index_type') or index_options:
+        index_options['type'] = vector_options.get('index_type', 'hnsw')
+        mapping['index_options'] = index_options
+    return mapping
+
+
+def get_page_num(chunk):
+    """解析 DocParser 片段开头的 `[page: N]` 标记，没有时返回 None"""
+    match = PAGE_MARK_RE.match(chunk)
+    return int(match.group(1)) if match else None
+
 
 class ESMemory:
     """
     用于将文档片段（chunk）存储到 Elasticsearch，并支持高效检索（BM25/embedding/hybrid）。
+    默认使用两个索引（index 存原文供 BM25，embedding_index 存向量）；unified=True 时只使用 index 一个索引，
+    每条文档同时包含 content 与 content_vector，一次写入/删除即覆盖两种检索方式。
     """
-    def __init__(self, index=ES_INDEX, embedding_index=ES_EMBEDDING_INDEX):
+    def __init__(self, index=ES_INDEX, embedding_index=ES_EMBEDDING_INDEX, unified=DEFAULT_ES_UNIFIED_INDEX,
+                 vector_options=None, route_by_doc=DEFAULT_ES_ROUTE_BY_DOC):
+        """
+        :param route_by_doc: 是否按 doc_name 路由片段到分片，带 doc_names 过滤的检索只访问相关分片；
+            路由改变了片段所在分片，只能用于新建（或重建）的索引
+        :param vector_options: 可选的向量存储配置（仅在新建索引时生效），默认取 DEFAULT_ES_VECTOR_OPTIONS：
+            dims: 向量维度，小于 EMBEDDING_DIM 时 embedding 请求同样按该维度生成（Matryoshka 式截断）
+            index_type: HNSW 索引类型，如 'hnsw' / 'int8_hnsw'（标量量化，约省 75% 向量内存）/ 'int4_hnsw' / 'bbq_hnsw'
+            m, ef_construction: HNSW 图的每节点邻居数与构建时的候选数
+        """
         def ensure_es_port(host):
             if not (host.startswith('http://') or host.startswith('https://')):
                 host = 'http://' + host
@@ -21,10 +194,64 @@ class ESMemory:
             basic_auth=(ES_USERNAME, ES_PASSWORD),
             verify_certs=False
         )
+        self.vector_options = dict(DEFAULT_ES_VECTOR_OPTIONS if vector_options is None else vector_options)
+        self.dims = self.vector_options.get('dims', EMBEDDING_DIM)
+        self.unified = unified
         self.index = index
-        self.embedding_index = embedding_index
-        self.init_index()
-        self.init_embedding_index()
+        self.embedding_index = index if unified else embedding_index
+        self.manifest_index = f'{index}_manifest'
+        self.route_by_doc = route_by_doc
+        self._server_rrf = None  # 集群是否支持服务端 RRF，首次 hybrid 检索时探测
+        self._bulk_loading = 0  # 处于 bulk_load 中的层数，期间写入不逐次 refresh
+        self.bulk_writer = AdaptiveBulkWriter(self.es)
+        self.query_cache = QueryCache() if DEFAULT_ES_QUERY_CACHE_SIZE > 0 else None
+        if unified:
+            self.init_unified_index()
+        else:
+            self.init_index()
+            self.init_embedding_index()
+        self.init_manifest_index()
+        self.knn_policy = self.load_knn_policy()
+
+    def load_knn_policy(self):
+        """
+        读取 es_knn_tuner 写入 embedding 索引 mapping `_meta.knn_policy` 的调优结果；未调优时返回 None
+        """
+        mapping = self.es.indices.get_mapping(index=self.embedding_index)
+        meta = mapping[self.embedding_index]['mappings'].get('_meta', {})
+        return meta.get('knn_policy')
+
+    def num_candidates_for(self, k):
+        """
+        按调优策略为 top_k 选择 HNSW 候选数：取不小于 k 的最小已调优 top_k 对应的值；
+        超出已调优范围时按比例放大；未调优时沿用 max(100, k)。结果不超过 ES 允许的 MAX_NUM_CANDIDATES
+        """
+        if not self.knn_policy:
+            return min(max(100, k), MAX_NUM_CANDIDATES)
+        tuned = sorted((int(top_k), nc) for top_k, nc in self.knn_policy['num_candidates'].items())
+        for top_k, nc in tuned:
+            if top_k >= k:
+                return min(max(nc, k), MAX_NUM_CANDIDATES)
+        top_k, nc = tuned[-1]
+        return min(max(k, int(nc * k / top_k)), MAX_NUM_CANDIDATES)
+
+    def init_unified_index(self, index=None):
+        # 创建统一索引（如已存在则跳过）：原文、向量与页码等元数据存于同一条文档
+        index = index or self.index
+        if not self.es.indices.exists(index=index):
+            index_body = {
+                "settings": {"number_of_shards": 1, "number_of_replicas": 0},
+                "mappings": {
+                    "properties": {
+                        "doc_name": {"type": "keyword"},
+                        "content": {"type": "text"},
+                        "content_vector": vector_mapping(self.dims, self.vector_options),
+                        "chunk_id": {"type": "integer"},
+                        "page_num": {"type": "integer"}
+                    }
+                }
+            }
+            self.es.indices.create(index=index, body=index_body)
 
     def init_index(self):
         # 创建 BM25 索引（如已存在则跳过）
@@ -49,119 +276,483 @@ class ESMemory:
                     "properties": {
                         "doc_name": {"type": "keyword"},
                         "content": {"type": "text"},
-                        "content_vector": {
-                            "type": "dense_vector",
-                            "dims": EMBEDDING_DIM,
-                            "index": True,
-                            "similarity": "cosine"
-                        },
+                        "content_vector": vector_mapping(self.dims, self.vector_options),
                         "chunk_id": {"type": "integer"}
                     }
                 }
             }
             self.es.indices.create(index=self.embedding_index, body=index_body)
 
+    def init_manifest_index(self):
+        # 创建文档清单索引（如已存在则跳过）：每个 (索引, 文档) 一条，记录已写入片段的 _id -> chunk_id
+        if not self.es.indices.exists(index=self.manifest_index):
+            index_body = {
+                "settings": {"number_of_shards": 1, "number_of_replicas": 0},
+                "mappings": {
+                    "dynamic": False,
+                    "properties": {
+                        "doc_name": {"type": "keyword"},
+                        "index": {"type": "keyword"}
+                    }
+                }
+            }
+            self.es.indices.create(index=self.manifest_index, body=index_body)
+
+    def _manifest_id(self, index, doc_name):
+        return hash_sha256(f'{index}\n{doc_name}')
+
+    def _get_manifest(self, index, doc_name):
+        """返回 {_id: chunk_id}；文档从未以清单方式写入过时返回 None"""
+        res = self.es.options(ignore_status=404).get(index=self.manifest_index, id=self._manifest_id(index, doc_name))
+        if not res.get('found'):
+            return None
+        return res['_source']['chunks']
+
+    def _put_manifest(self, index, doc_name, chunks):
+        self.es.index(index=self.manifest_index,
+                      id=self._manifest_id(index, doc_name),
+                      document={'index': index, 'doc_name': doc_name, 'chunks': chunks})
+
+    def _diff_chunks(self, index, doc_name, chunks):
+        """
+        对比清单与本次片段，得出需要新增、更新 chunk_id 及删除的 _id
+        :return: (ids, new_manifest, to_add, to_update, to_delete)
+        """
+        ids = chunk_doc_ids(doc_name, chunks)
+        new_manifest = {_id: idx for idx, _id in enumerate(ids)}
+        old_manifest = self._get_manifest(index, doc_name)
+        if old_manifest is None:
+            # 首次按清单写入：清理旧版本以随机 _id 写入的同名文档片段，避免重复
+            self.es.delete_by_query(index=index, body={"query": {"term": {"doc_name": doc_name}}}, conflicts='proceed')
+            old_manifest = {}
+        to_add = [idx for idx, _id in enumerate(ids) if _id not in old_manifest]
+        to_update = [idx for idx, _id in enumerate(ids) if _id in old_manifest and old_manifest[_id] != idx]
+        to_delete = [_id for _id in old_manifest if _id not in new_manifest]
+        return ids, new_manifest, to_add, to_update, to_delete
+
+    def _update_and_delete_actions(self, index, doc_name, ids, to_update, to_delete):
+        routing = self._write_routing(doc_name)
+        for idx in to_update:
+            yield dict({'_op_type': 'update', '_index': index, '_id': ids[idx], 'doc': {'chunk_id': idx}}, **routing)
+        for _id in to_delete:
+            yield dict({'_op_type': 'delete', '_index': index, '_id': _id}, **routing)
+
+    @contextmanager
+    def bulk_load(self, force_merge=False):
+        """
+        大批量写入时使用：期间关闭 refresh 并去掉副本，退出时恢复设置、refresh 一次，可选 force merge
+            with es_memory.bulk_load(force_merge=True):
+                for doc_name, chunks in docs:
+                    es_memory.add_chunks(doc_name, chunks)
+        """
+        with ExitStack() as stack:
+            # 导入期间关闭了 refresh，期间缓存的结果看不到新数据，退出（refresh 之后）时统一失效；
+            # ExitStack 逆序退出，所以先注册
+            stack.callback(bump_generation, self.index, self.embedding_index)
+            for index in dict.fromkeys([self.index, self.embedding_index]):
+                stack.enter_context(bulk_load(self.es, index, force_merge=force_merge))
+            self._bulk_loading += 1
+            try:
+                yield self
+            finally:
+                self._bulk_loading -= 1
+
+    def _publish(self, *indices):
+        """
+        写入后先 refresh 再递增代数：否则紧接着的检索可能还看不到新片段，而这次未命中的结果会以新代数缓存到 TTL 过期。
+        bulk_load 期间不逐次 refresh，由退出时的 refresh 与代数递增统一处理
+        """
+        if not self._bulk_loading:
+            self.es.indices.refresh(index=','.join(dict.fromkeys(indices)))
+        bump_generation(*indices)
+
     def add_chunks(self, doc_name, chunks):
         """
-        批量写入文档片段到 BM25 索引
+        增量写入文档片段到 BM25 索引：只写入新增片段、修正位置变化的 chunk_id、删除已消失的片段，
+        文档未变化时不产生任何 bulk 写入
         :param doc_name: 文档名
         :param chunks: List[str]，每个元素为一个片段
+        :return: dict，包含新增/更新/删除/未变化的片段数
         """
+        if self.unified:
+            # 统一索引中每条文档都带向量，写入原文即需同时写入 embedding
+            return self.add_chunks_with_embedding(doc_name, chunks)
+        ids, new_manifest, to_add, to_update, to_delete = self._diff_chunks(self.index, doc_name, chunks)
+        stats = {
+            'indexed': len(to_add),
+            'updated': len(to_update),
+            'deleted': len(to_delete),
+            'unchanged': len(chunks) - len(to_add) - len(to_update),
+            'failed': 0,
+        }
+        if not (to_add or to_update or to_delete):
+            return stats
         actions = [
-            {
+            dict({
                 '_op_type': 'index',
                 '_index': self.index,
+                '_id': ids[idx],
                 'doc_name': doc_name,
-                'content': chunk,
+                'content': chunks[idx],
                 'chunk_id': idx
-            }
-            for idx, chunk in enumerate(chunks)
+            }, **self._write_routing(doc_name))
+            for idx in to_add
         ]
-        helpers.bulk(self.es, actions)
+        actions.extend(self._update_and_delete_actions(self.index, doc_name, ids, to_update, to_delete))
+        for ok, item in self.bulk_writer.write(actions):
+            if not ok:
+                stats['failed'] += 1
+                logger.warning(f'Failed to index chunk of {doc_name}: {item}')
+        self._publish(self.index)
+        if not stats['failed']:
+            # 有失败时不更新清单，下次写入会重新比对并补写
+            self._put_manifest(self.index, doc_name, new_manifest)
+        return stats
 
-    def add_chunks_with_embedding(self, doc_name, chunks, embedding_client=None):
+    def add_chunks_with_embedding(self, doc_name, chunks, embedding_client=None,
+                                  batch_size=DEFAULT_EMBEDDING_BATCH_SIZE,
+                                  max_in_flight=DEFAULT_EMBEDDING_MAX_IN_FLIGHT,
+                                  progress_every=500,
+                                  known_vectors=None):
         """
-        批量写入文档片段到 embedding 向量索引
+        增量写入文档片段到 embedding 向量索引，只为新增片段生成 embedding；
+        embedding 按批并发请求，每批完成后立即经 streaming_bulk 写入 ES，无需等全部向量生成完毕
         :param doc_name: 文档名
         :param chunks: List[str]，每个元素为一个片段
+        :param batch_size: 每个 embedding 请求携带的片段数
+        :param max_in_flight: 同时在途的 embedding 请求数上限
+        :param progress_every: 每写入多少个片段打印一次进度与吞吐
+        :param known_vectors: 可选，{片段下标: 向量}，已有向量的片段不再请求 embedding（用于索引迁移）
+        :return: dict，包含新增/更新/删除/未变化/失败的片段数、耗时(秒)与吞吐(chunks/s)
         """
-        actions = []
-        for idx, chunk in enumerate(chunks):
-            embedding = get_embedding(chunk, client=embedding_client)
-            actions.append({
+        known_vectors = known_vectors or {}
+        start = time.time()
+        ids, new_manifest, to_add, to_update, to_delete = self._diff_chunks(self.embedding_index, doc_name, chunks)
+        total = len(to_add) + len(to_update) + len(to_delete)
+        stats = {
+            'indexed': 0,
+            'updated': len(to_update),
+            'deleted': len(to_delete),
+            'unchanged': len(chunks) - len(to_add) - len(to_update),
+            'failed': 0,
+        }
+        if not total:
+            stats.update({'seconds': time.time() - start, 'chunks_per_second': 0.0})
+            return stats
+
+        def make_action(idx, embedding):
+            action = {
                 '_op_type': 'index',
                 '_index': self.embedding_index,
+                '_id': ids[idx],
                 'doc_name': doc_name,
-                'content': chunk,
-                'content_vector': embedding,
+                'content': chunks[idx],
                 'chunk_id': idx
-            })
-        helpers.bulk(self.es, actions)
+            }
+            action.update(self._write_routing(doc_name))
+            if embedding:
+                # 空文本没有向量，只写入原文
+                action['content_vector'] = embedding
+            if self.unified:
+                page_num = get_page_num(chunks[idx])
+                if page_num is not None:
+                    action['page_num'] = page_num
+            return action
+
+        def gen_actions():
+            to_embed = []
+            for idx in to_add:
+                if known_vectors.get(idx):
+                    yield make_action(idx, known_vectors[idx])
+                else:
+                    to_embed.append(idx)
+            for i, embedding in iter_embeddings([chunks[idx] for idx in to_embed],
+                                                client=embedding_client,
+                                                batch_size=batch_size,
+                                                max_in_flight=max_in_flight,
+                                                dimensions=self.dims):
+                yield make_action(to_embed[i], embedding)
+            yield from self._update_and_delete_actions(self.embedding_index, doc_name, ids, to_update, to_delete)
+
+        done = 0
+        for ok, item in self.bulk_writer.write(gen_actions()):
+            done += 1
+            if ok:
+                if 'index' in item:
+                    stats['indexed'] += 1
+            else:
+                stats['failed'] += 1
+                logger.warning(f'Failed to index chunk of {doc_name}: {item}')
+            if progress_every and (done % progress_every == 0 or done == total):
+                elapsed = time.time() - start
+                logger.info(f'[ES ingest] {doc_name}: {done}/{total} chunks, '
+                            f'{done / max(elapsed, 1e-6):.1f} chunks/s')
+        self._publish(self.embedding_index)
+        if not stats['failed']:
+            # 有失败时不更新清单，下次写入会重新比对并补写
+            self._put_manifest(self.embedding_index, doc_name, new_manifest)
+        elapsed = time.time() - start
+        stats.update({'seconds': elapsed, 'chunks_per_second': stats['indexed'] / max(elapsed, 1e-6)})
+        return stats
 
-    def search(self, query, top_k=5):
+    @cached_search
+    def search(self, query, top_k=5, doc_names=None, snippet_size=None, snippet_count=1, return_vector=False):
         """
         BM25 检索最相关的文档片段
+        :param doc_names: 可选，只在这些文档中检索（如当前会话的文件），为 None 时检索全部文档
+        :param snippet_size: 可选，摘要模式：每个片段只返回与 query 匹配的窗口（ES highlight），每个窗口约 snippet_size 个字符
+        :param snippet_count: 摘要模式下每个片段最多返回的窗口数
+        :param return_vector: 是否在结果中返回 content_vector，默认不返回
         """
-        res = self.es.search(index=self.index, query={"match": {"content": query}}, size=top_k)
-        return [
-            {
-                'doc_name': hit['_source']['doc_name'],
-                'chunk_id': hit['_source']['chunk_id'],
-                'content': hit['_source']['content'],
-                'score': hit['_score'],
-                'source': 'bm25'
-            }
-            for hit in res['hits']['hits']
-        ]
+        if doc_names is not None and not doc_names:
+            return []
+        projection = self._projection(query, snippet_size, snippet_count, return_vector)
+        res = self.es.search(index=self.index,
+                             query=self._match_query(query, doc_names),
+                             size=top_k,
+                             source=projection['_source'],
+                             highlight=projection.get('highlight'),
+                             routing=self._search_routing(doc_names))
+        return self._to_results(res['hits']['hits'], 'bm25')
 
-    def embedding_search(self, query, top_k=5, embedding_client=None):
+    @cached_search
+    def embedding_search(self, query, top_k=5, embedding_client=None, doc_names=None, snippet_size=None,
+                         snippet_count=1, return_vector=False):
         """
         embedding 向量检索最相关的文档片段
+        :param doc_names: 可选，只在这些文档中检索；过滤在 HNSW 搜索过程中生效，不会因先取 top_k 再过滤而丢失结果
+        :param snippet_size, snippet_count, return_vector: 同 search
         """
-        query_vector = get_embedding(query, client=embedding_client)
+        if doc_names is not None and not doc_names:
+            return []
+        query_vector = get_embedding(query, client=embedding_client, dimensions=self.dims)
+        projection = self._projection(query, snippet_size, snippet_count, return_vector)
         res = self.es.search(
             index=self.embedding_index,
-            knn={
-                "field": "content_vector",
-                "query_vector": query_vector,
-                "k": top_k,
-                "num_candidates": 100
-            },
-            size=top_k
+            knn=self._knn_clause(query_vector, top_k, doc_names),
+            size=top_k,
+            source=projection['_source'],
+            routing=self._search_routing(doc_names)
         )
-        return [
-            {
+        return self._to_results(res['hits']['hits'], 'embedding')
+
+    @cached_search
+    def hybrid_search(self, query, top_k=5, embedding_client=None, window_size=None,
+                      rank_constant=RRF_RANK_CONSTANT, doc_names=None, snippet_size=None, snippet_count=1,
+                      return_vector=False):
+        """
+        BM25+embedding hybrid 检索，按排名做 RRF 融合（BM25 与余弦分数量纲不同，不能直接比较）
+        只发起一次 ES 请求：BM25 与 embedding 位于同一索引时由 ES 服务端做 RRF；
+        否则（或集群不支持 RRF、需要 highlight 片段时）用一次 _msearch 同时执行两路检索，在客户端融合
+        :param window_size: 每一路参与融合的候选数，默认 top_k 的 4 倍，不小于 top_k
+        :param rank_constant: RRF 公式 1 / (rank_constant + rank) 中的常数
+        :param doc_names: 可选，只在这些文档中检索，两路检索均带相同的过滤
+        :param snippet_size, snippet_count, return_vector: 同 search
+        """
+        if doc_names is not None and not doc_names:
+            return []
+        window_size = max(window_size or top_k * 4, top_k)
+        query_vector = get_embedding(query, client=embedding_client, dimensions=self.dims)
+        projection = self._projection(query, snippet_size, snippet_count, return_vector)
+        if not query_vector:
+            return self.search(query, top_k=top_k, doc_names=doc_names, snippet_size=snippet_size,
+                               snippet_count=snippet_count, return_vector=return_vector)
+        # ES 的 rank(RRF) 不支持与 highlight 同时使用，需要片段时走客户端融合
+        if self.index == self.embedding_index and self._server_rrf is not False and 'highlight' not in projection:
+            try:
+                return self._server_rrf_search(query, query_vector, top_k, window_size, rank_constant, doc_names,
+                                               projection)
+            except ApiError as ex:
+                logger.warning(f'Server-side RRF failed, falling back to client-side fusion: {ex}')
+                if _rrf_unsupported(ex):
+                    # 未开通 RRF 的 license 或集群版本不认识 rank，后续都改为客户端融合；其余错误只影响本次
+                    self._server_rrf = False
+        routing = self._search_routing(doc_names)
+        bm25_hits, knn_hits = self._msearch([
+            (self.index, dict(projection, query=self._match_query(query, doc_names), size=window_size), routing),
+            (self.embedding_index,
+             dict(projection, knn=self._knn_clause(query_vector, window_size, doc_names), size=window_size), routing),
+        ])
+        return reciprocal_rank_fusion(
+            [self._to_results(bm25_hits, 'bm25'), self._to_results(knn_hits, 'embedding')],
+            top_k=top_k,
+            rank_constant=rank_constant)
+
+    @cached_search
+    def multi_search(self, queries, top_k=5, keywords=None, mode='hybrid', embedding_client=None, window_size=None,
+                     rank_constant=RRF_RANK_CONSTANT, doc_names=None, snippet_size=None, snippet_count=1,
+                     return_vector=False):
+        """
+        多个子查询一起检索：所有子查询的 embedding 一次批量生成，所有 BM25 与 kNN 检索合并为一次 _msearch，
+        各路结果按排名做 RRF 融合
+        :param queries: List[str]，子查询（如 SplitQuery 拆出的各条信息），按 mode 做 BM25 和/或向量检索
+        :param keywords: 可选，List[str]，关键词查询，只做 BM25（关键词列表做向量检索意义不大）
+        :param mode: 'bm25' / 'embedding' / 'hybrid'
+        :param window_size: 每一路参与融合的候选数，默认 top_k 的 4 倍，不小于 top_k
+        其余参数同 hybrid_search
+        """
+        if doc_names is not None and not doc_names:
+            return []
+        queries = [q for q in dict.fromkeys(queries) if q and q.strip()]
+        keywords = [k for k in dict.fromkeys(keywords or []) if k and k.strip()]
+        if mode == 'embedding':
+            keywords = []
+        window_size = max(window_size or top_k * 4, top_k)
+        routing = self._search_routing(doc_names)
+        highlight_text = ' '.join(queries + keywords)
+        projection = self._projection(highlight_text, snippet_size, snippet_count, return_vector)
+
+        searches, sources = [], []
+        if mode in ('bm25', 'hybrid'):
+            for q in queries + keywords:
+                searches.append(
+                    (self.index, dict(projection, query=self._match_query(q, doc_names), size=window_size), routing))
+                sources.append('bm25')
+        if mode in ('embedding', 'hybrid') and queries:
+            vectors = get_embeddings(queries, client=embedding_client, dimensions=self.dims)
+            for vector in vectors:
+                if not vector:
+                    continue
+                searches.append((self.embedding_index,
+                                 dict(projection, knn=self._knn_clause(vector, window_size, doc_names),
+                                      size=window_size), routing))
+                sources.append('embedding')
+        if not searches:
+            return []
+        result_lists = [self._to_results(hits, source) for hits, source in zip(self._msearch(searches), sources)]
+        if len(result_lists) == 1:
+            return result_lists[0][:top_k]
+        return reciprocal_rank_fusion(result_lists, top_k=top_k, rank_constant=rank_constant)
+
+    def _server_rrf_search(self, query, query_vector, top_k, window_size, rank_constant, doc_names=None,
+                           projection=None):
+        projection = projection or self._projection(query)
+        res = self.es.search(
+            index=self.index,
+            query=self._match_query(query, doc_names),
+            knn=self._knn_clause(query_vector, window_size, doc_names),
+            rank={'rrf': {'rank_window_size': window_size, 'rank_constant': rank_constant}},
+            size=top_k,
+            source=projection['_source'],
+            routing=self._search_routing(doc_names)
+        )
+        self._server_rrf = True
+        results = self._to_results(res['hits']['hits'], 'hybrid')
+        for r, hit in zip(results, res['hits']['hits']):
+            if hit.get('_rank'):
+                r['score'] = 1.0 / (rank_constant + hit['_rank'])
+        return results
+
+    def _msearch(self, searches):
+        """
+        用一次 _msearch 请求执行多个检索，ES 会并行执行这些检索
+        :param searches: List[(index, body)] 或 List[(index, body, routing)]
+        :return: 与 searches 一一对应的 hits 列表
+        """
+        body = []
+        for index, search_body, *routing in searches:
+            header = {'index': index}
+            if routing and routing[0]:
+                header['routing'] = routing[0]
+            body.append(header)
+            body.append(search_body)
+        res = self.es.msearch(searches=body)
+        hits_list = []
+        for response in res['responses']:
+            if 'error' in response:
+                logger.warning(f'ES msearch leg failed: {response["error"]}')
+                hits_list.append([])
+            else:
+                hits_list.append(response['hits']['hits'])
+        return hits_list
+
+    @staticmethod
+    def _projection(query, snippet_size=None, snippet_count=1, return_vector=False):
+        """
+        检索请求的返回字段：默认只取 doc_name/chunk_id/content；摘要模式下不取 content 全文，改由 highlight 返回匹配窗口
+        :return: 可直接并入检索请求体的 dict（_source 与可选的 highlight）
+        """
+        fields = list(RESULT_SOURCE_FIELDS)
+        if return_vector:
+            fields.append('content_vector')
+        if not snippet_size:
+            return {'_source': fields}
+        fields.remove('content')
+        return {
+            '_source': fields,
+            'highlight': {
+                'fields': {
+                    'content': {
+                        'fragment_size': snippet_size,
+                        'number_of_fragments': snippet_count,
+                        # 没有命中词（如纯向量召回的片段）时返回开头的 snippet_size 个字符
+                        'no_match_size': snippet_size,
+                    }
+                },
+                # 向量检索没有查询词，统一按原始 query 计算匹配窗口
+                'highlight_query': {'match': {'content': query}},
+                'pre_tags': [''],
+                'post_tags': [''],
+            }
+        }
+
+    @staticmethod
+    def _doc_filter(doc_names):
+        return {"terms": {"doc_name": list(doc_names)}}
+
+    @classmethod
+    def _match_query(cls, query, doc_names=None):
+        if doc_names is None:
+            return {"match": {"content": query}}
+        return {"bool": {"must": {"match": {"content": query}}, "filter": cls._doc_filter(doc_names)}}
+
+    def _knn_clause(self, query_vector, k, doc_names=None):
+        clause = {
+            "field": "content_vector",
+            "query_vector": query_vector,
+            "k": k,
+            "num_candidates": self.num_candidates_for(k)
+        }
+        if doc_names is not None:
+            clause["filter"] = self._doc_filter(doc_names)
+        return clause
+
+    @staticmethod
+    def _routing_key(doc_name):
+        # doc_name 可能包含逗号（检索时多个 routing 以逗号分隔），因此用其摘要作为路由值
+        return hash_sha256(doc_name)[:16]
+
+    def _write_routing(self, doc_name):
+        return {'_routing': self._routing_key(doc_name)} if self.route_by_doc else {}
+
+    def _search_routing(self, doc_names):
+        if not self.route_by_doc or not doc_names:
+            return None
+        return ','.join(sorted({self._routing_key(doc_name) for doc_name in doc_names}))
+
+    @staticmethod
+    def _to_results(hits, source):
+        results = []
+        for hit in hits:
+            highlight = hit.get('highlight', {}).get('content')
+            r = {
                 'doc_name': hit['_source']['doc_name'],
                 'chunk_id': hit['_source']['chunk_id'],
-                'content': hit['_source']['content'],
+                'content': ' ... '.join(highlight) if highlight else hit['_source'].get('content', ''),
                 'score': hit['_score'],
-                'source': 'embedding'
+                'source': source
             }
-            for hit in res['hits']['hits']
-        ]
-
-    def hybrid_search(self, query, top_k=5, embedding_client=None):
-        """
-        BM25+embedding hybrid 检索，合并去重
-        """
-        bm25_results = self.search(query, top_k=top_k)
-        embedding_results = self.embedding_search(query, top_k=top_k, embedding_client=embedding_client)
-        # 合并去重，按分数降序
-        all_results = bm25_results + embedding_results
-        seen = set()
-        merged = []
-        for r in sorted(all_results, key=lambda x: x['score'], reverse=True):
-            key = (r['doc_name'], r['chunk_id'])
-            if key not in seen:
-                merged.append(r)
-                seen.add(key)
-            if len(merged) >= top_k:
-                break
-        return merged
+            if 'content_vector' in hit['_source']:
+                r['content_vector'] = hit['_source']['content_vector']
+            results.append(r)
+        return results
 
     def delete_doc(self, doc_name):
         """
         删除指定文档的所有片段
         """
         self.es.delete_by_query(index=self.index, body={"query": {"term": {"doc_name": doc_name}}})
-        self.es.delete_by_query(index=self.embedding_index, body={"query": {"term": {"doc_name": doc_name}}}) 
\ No newline at end of file
+        if not self.unified:
+            self.es.delete_by_query(index=self.embedding_index, body={"query": {"term": {"doc_name": doc_name}}})
+        self.es.delete_by_query(index=self.manifest_index, body={"query": {"term": {"doc_name": doc_name}}})
+        self._publish(self.index, self.embedding_index) 
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+将 ESMemory 的双索引布局（ES_INDEX 存原文 + ES_EMBEDDING_INDEX 存向量）迁移为统一索引。
+
+用法：
+    python -m qwen_agent_local.memory.es_migrate --target-index qwen_agent_rag_unified [--delete-source]
+
+迁移后设置环境变量 qwen_agent_local_DEFAULT_ES_UNIFIED_INDEX=true，并把 config.py 中的 ES_INDEX 指向目标索引。
+"""
+import argparse
+import time
+
+from elasticsearch import helpers
+
+from config import ES_EMBEDDING_INDEX, ES_INDEX
+from qwen_agent_local.log import logger
+from qwen_agent_local.memory.es_memory import ESMemory
+from qwen_agent_local.utils.utils import hash_sha256
+
+
+def iter_doc_names(es, index, page_size=1000):
+    """用 composite 聚合分页遍历索引中的全部 doc_name"""
+    if not es.indices.exists(index=index):
+        return
+    after_key = None
+    while True:
+        composite = {'size': page_size, 'sources': [{'doc_name': {'terms': {'field': 'doc_name'}}}]}
+        if after_key:
+            composite['after'] = after_key
+        res = es.search(index=index, size=0, aggs={'docs': {'composite': composite}})
+        buckets = res['aggregations']['docs']['buckets']
+        for bucket in buckets:
+            yield bucket['key']['doc_name']
+        after_key = res['aggregations']['docs'].get('after_key')
+        if not buckets or not after_key:
+            return
+
+
+def load_doc_chunks(es, index, doc_name, fields):
+    """按 chunk_id 顺序读出一个文档的全部片段；旧数据中重复写入的同一 chunk_id 只保留一条"""
+    if not es.indices.exists(index=index):
+        return []
+    by_chunk_id = {}
+    for hit in helpers.scan(es, index=index, query={'query': {'term': {'doc_name': doc_name}}}, _source=fields):
+        source = hit['_source']
+        by_chunk_id.setdefault(source.get('chunk_id', 0), source)
+    return [by_chunk_id[k] for k in sorted(by_chunk_id)]
+
+
+def migrate_to_unified(source: ESMemory, target: ESMemory, delete_source: bool = False) -> dict:
+    """
+    把 source 双索引中的文档逐个写入 target 统一索引；embedding 索引里已有的向量直接复用，缺失的才重新生成
+    :return: dict，包含迁移的文档数、片段数、复用的向量数与耗时(秒)
+    """
+    assert not source.unified and target.unified
+    start = time.time()
+    doc_names = list(dict.fromkeys(list(iter_doc_names(source.es, source.index)) +
+                                   list(iter_doc_names(source.es, source.embedding_index))))
+    stats = {'docs': 0, 'chunks': 0, 'reused_vectors': 0}
+    for doc_name in doc_names:
+        text_chunks = load_doc_chunks(source.es, source.index, doc_name, ['content', 'chunk_id'])
+        vector_chunks = load_doc_chunks(source.es, source.embedding_index, doc_name,
+                                        ['content', 'chunk_id', 'content_vector'])
+        contents = [c['content'] for c in (text_chunks or vector_chunks)]
+        vectors_by_hash = {
+            hash_sha256(c['content']): c['content_vector'] for c in vector_chunks if c.get('content_vector')
+        }
+        known_vectors = {}
+        for idx, content in enumerate(contents):
+            vector = vectors_by_hash.get(hash_sha256(content))
+            if vector:
+                known_vectors[idx] = vector
+        result = target.add_chunks_with_embedding(doc_name, contents, known_vectors=known_vectors)
+        if result['failed']:
+            logger.warning(f'[ES migrate] {doc_name}: {result["failed"]} chunks failed, source is kept.')
+            continue
+        stats['docs'] += 1
+        stats['chunks'] += len(contents)
+        stats['reused_vectors'] += len(known_vectors)
+        logger.info(f'[ES migrate] {doc_name}: {len(contents)} chunks, {len(known_vectors)} vectors reused.')
+        if delete_source:
+            source.delete_doc(doc_name)
+    target.es.indices.refresh(index=target.index)
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='迁移 ESMemory 双索引到统一索引')
+    parser.add_argument('--source-index', default=ES_INDEX, help='原 BM25 索引')
+    parser.add_argument('--source-embedding-index', default=ES_EMBEDDING_INDEX, help='原 embedding 索引')
+    parser.add_argument('--target-index', required=True, help='目标统一索引')
+    parser.add_argument('--delete-source', action='store_true', help='迁移成功后删除源索引中的对应文档')
+    args = parser.parse_args()
+
+    if args.target_index in (args.source_index, args.source_embedding_index):
+        parser.error('--target-index must differ from the source indices')
+    source = ESMemory(index=args.source_index, embedding_index=args.source_embedding_index, unified=False)
+    target = ESMemory(index=args.target_index, unified=True)
+    stats = migrate_to_unified(source, target, delete_source=args.delete_source)
+    print(f"迁移完成：{stats['docs']} 个文档，{stats['chunks']} 个片段，"
+          f"复用向量 {stats['reused_vectors']} 个，耗时 {stats['seconds']:.1f} 秒")
+
+
+if __name__ == '__main__':
+    main()
@@ -54,7 +54,8 @@ class Memory(Agent):
                 'rag_searchers': ['keyword_search', 'front_page_search']
               }
               And the above is the default settings.
-            memory_type: 'local'（默认，原有逻辑）或 'es'（用ESMemory）
+            memory_type: 'local'（默认，原有逻辑）、'es'（用ESMemory）或 'embedded'（用EmbeddedMemory，
+              SQLite FTS5 + 内存映射向量矩阵，接口同 ESMemory，无需 ES 集群）
         """
         self.cfg = rag_cfg or {}
         self.max_ref_token: int = self.cfg.get('max_ref_token', DEFAULT_MAX_REF_TOKEN)
@@ -81,8 +82,17 @@ class Memory(Agent):
 
         self.system_files = files or []
         self.memory_type = memory_type
-        if self.memory_type == 'es':
-            self.es_memory = ESMemory()
+        if self.memory_type in ('es', 'embedded'):
+            if self.memory_type == 'es':
+                self.es_memory = ESMemory()
+            else:
+                from qwen_agent_local.memory.embedded_memory import EmbeddedMemory
+                self.es_memory = EmbeddedMemory()
+            # 解析工具写入检索后端，检索工具按会话文件过滤检索
+            retrieval = self.function_map['retrieval']
+            for tool in (retrieval, retrieval.doc_parse, self.function_map['doc_parser']):
+                tool.es_memory = self.es_memory
+                tool.memory_type = self.memory_type
         else:
             self.es_memory = None
 
@@ -0,0 +1,76 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from qwen_agent_local.settings import DEFAULT_ES_QUERY_CACHE_SIZE, DEFAULT_ES_QUERY_CACHE_TTL
+
+# 索引名 -> 写入代数；进程内任一 ESMemory 实例写入或删除文档后递增，缓存键中带有代数，旧结果因此不再命中
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+def get_generation(index: str) -> int:
+    return _generations.get(index, 0)
+
+
+def bump_generation(*indices: str) -> None:
+    with _generations_lock:
+        for index in indices:
+            _generations[index] = _generations.get(index, 0) + 1
+
+
+def normalize_query(query: str) -> str:
+    """全角/半角统一（NFKC）并合并空白，使只有格式差异的相同问题命中同一缓存"""
+    return ' '.join(unicodedata.normalize('NFKC', query).split())
+
+
+class QueryCache:
+    """
+    进程内检索结果缓存，超过 max_entries 条时按 LRU 淘汰，超过 ttl 秒的结果视为过期。
+    ttl 同时兜底其他进程（如 docs_es.py 入库）写入的情况：这类写入不会使本进程的代数递增。
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_ES_QUERY_CACHE_SIZE, ttl: float = DEFAULT_ES_QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (写入时间, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl and time.time() - item[0] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -14,7 +14,7 @@
 
 import ast
 import os
-from typing import List, Literal
+from typing import Dict, List, Literal
 
 # Settings for LLMs
 DEFAULT_MAX_INPUT_TOKENS: int = int(os.getenv(
@@ -25,15 +25,57 @@ MAX_LLM_CALL_PER_RUN: int = int(os.getenv('qwen_agent_local_MAX_LLM_CALL_PER_RUN
 
 # Settings for tools
 DEFAULT_WORKSPACE: str = os.getenv('qwen_agent_local_DEFAULT_WORKSPACE', 'workspace')
+DEFAULT_STORAGE_BACKEND: Literal['file', 'sqlite'] = os.getenv(
+    'qwen_agent_local_DEFAULT_STORAGE_BACKEND', 'file')  # Storage tool: one file per key, or one SQLite db per root
+DEFAULT_URL_REVALIDATE_INTERVAL: float = float(os.getenv(
+    'qwen_agent_local_DEFAULT_URL_REVALIDATE_INTERVAL', 300))  # Seconds a remote doc is trusted before revalidating
 
 # Settings for RAG
 DEFAULT_MAX_REF_TOKEN: int = int(os.getenv('qwen_agent_local_DEFAULT_MAX_REF_TOKEN',
                                            20000))  # The window size reserved for RAG materials
 DEFAULT_PARSER_PAGE_SIZE: int = int(os.getenv('qwen_agent_local_DEFAULT_PARSER_PAGE_SIZE',
                                               500))  # Max tokens per chunk when doing RAG
+DEFAULT_PARSER_MAX_WORKERS: int = int(os.getenv('qwen_agent_local_DEFAULT_PARSER_MAX_WORKERS', min(
+    4, os.cpu_count() or 1)))  # Processes shared by all DocParsers for multi-file parsing; <= 1 parses serially
+DEFAULT_TOKENIZER_THREADS: int = int(os.getenv('qwen_agent_local_DEFAULT_TOKENIZER_THREADS', min(
+    8, os.cpu_count() or 1)))  # Threads for batch token counting, e.g. all paragraphs of a parsed doc
 DEFAULT_RAG_KEYGEN_STRATEGY: Literal['None', 'GenKeyword', 'SplitQueryThenGenKeyword', 'GenKeywordWithKnowledge',
                                      'SplitQueryThenGenKeywordWithKnowledge'] = os.getenv(
                                          'qwen_agent_local_DEFAULT_RAG_KEYGEN_STRATEGY', 'GenKeyword')
 DEFAULT_RAG_SEARCHERS: List[str] = ast.literal_eval(
     os.getenv('qwen_agent_local_DEFAULT_RAG_SEARCHERS',
               "['keyword_search', 'front_page_search']"))  # Sub-searchers for hybrid retrieval
+DEFAULT_RAG_SEARCHER_TIMEOUT: float = float(os.getenv('qwen_agent_local_DEFAULT_RAG_SEARCHER_TIMEOUT',
+                                                   30))  # Seconds HybridSearch waits for each sub-searcher
+DEFAULT_RAG_SEARCHER_THREADS: int = int(os.getenv('qwen_agent_local_DEFAULT_RAG_SEARCHER_THREADS',
+                                                  16))  # Threads shared by the sub-searchers of all HybridSearches
+DEFAULT_VECTOR_SEARCH_BACKEND: str = os.getenv(
+    'qwen_agent_local_DEFAULT_VECTOR_SEARCH_BACKEND',
+    'store')  # 'store': cached chunk embeddings of config.EMBEDDING_MODEL; 'langchain': DashScope v1 + FAISS per query
+
+# Settings for embedding
+DEFAULT_EMBEDDING_BATCH_SIZE: int = int(os.getenv('qwen_agent_local_DEFAULT_EMBEDDING_BATCH_SIZE',
+                                                  10))  # Max inputs per embedding request (DashScope allows 10)
+DEFAULT_EMBEDDING_MAX_IN_FLIGHT: int = int(os.getenv('qwen_agent_local_DEFAULT_EMBEDDING_MAX_IN_FLIGHT',
+                                                     4))  # Max concurrent embedding requests during ingestion
+DEFAULT_EMBEDDING_CACHE_PATH: str = os.getenv('qwen_agent_local_DEFAULT_EMBEDDING_CACHE_PATH',
+                                              os.path.join(DEFAULT_WORKSPACE, 'embedding_cache', 'embeddings.sqlite3'))
+DEFAULT_EMBEDDING_CACHE_SIZE: int = int(os.getenv('qwen_agent_local_DEFAULT_EMBEDDING_CACHE_SIZE',
+                                                  500000))  # Max cached vectors (LRU evicted); 0 disables the cache
+
+# Settings for ES memory
+DEFAULT_ES_UNIFIED_INDEX: bool = os.getenv('qwen_agent_local_DEFAULT_ES_UNIFIED_INDEX', 'false').strip().lower() in (
+    '1', 'true')  # Store text and vectors in one ES index instead of ES_INDEX + ES_EMBEDDING_INDEX
+DEFAULT_ES_VECTOR_OPTIONS: Dict = ast.literal_eval(
+    os.getenv('qwen_agent_local_DEFAULT_ES_VECTOR_OPTIONS',
+              '{}'))  # e.g. "{'dims': 512, 'index_type': 'int8_hnsw', 'm': 16, 'ef_construction': 100}"
+DEFAULT_ES_ROUTE_BY_DOC: bool = os.getenv('qwen_agent_local_DEFAULT_ES_ROUTE_BY_DOC', 'false').strip().lower() in (
+    '1', 'true')  # Route chunks to shards by doc_name so doc-filtered queries only hit those shards (new indices only)
+DEFAULT_ES_QUERY_CACHE_SIZE: int = int(os.getenv('qwen_agent_local_DEFAULT_ES_QUERY_CACHE_SIZE',
+                                                 1024))  # Max cached ESMemory search results (LRU); 0 disables
+DEFAULT_ES_QUERY_CACHE_TTL: float = float(os.getenv('qwen_agent_local_DEFAULT_ES_QUERY_CACHE_TTL',
+                                                    300))  # Seconds before a cached search result expires
+
+# Settings for the embedded (ES-free) memory backend, memory_type='embedded'
+DEFAULT_EMBEDDED_MEMORY_PATH: str = os.getenv('qwen_agent_local_DEFAULT_EMBEDDED_MEMORY_PATH',
+                                              os.path.join(DEFAULT_WORKSPACE, 'embedded_memory'))
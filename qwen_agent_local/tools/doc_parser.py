@@ -12,21 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import json
 import os
 import re
 import time
-from typing import Dict, List, Optional, Union
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
 from pydantic import BaseModel
 
 from qwen_agent_local.log import logger
 from qwen_agent_local.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_WORKSPACE
 from qwen_agent_local.tools.base import BaseTool, register_tool
-from qwen_agent_local.tools.simple_doc_parser import PARAGRAPH_SPLIT_SYMBOL, SimpleDocParser, get_plain_doc
-from qwen_agent_local.tools.storage import KeyNotExistsError, Storage
+from qwen_agent_local.tools.simple_doc_parser import (PARAGRAPH_SPLIT_SYMBOL, DocParserError, SimpleDocParser,
+                                                      get_plain_doc)
+from qwen_agent_local.tools.packed_cache import PackedCache
+from qwen_agent_local.utils.doc_source import DocSource
+from qwen_agent_local.utils.parallel_executor import get_parse_pool, reset_parse_pool
 from qwen_agent_local.utils.tokenization_qwen import count_tokens, tokenizer
-from qwen_agent_local.utils.utils import get_basename_from_url, hash_sha256
+from qwen_agent_local.utils.utils import get_basename_from_url
+
+
+_PAGE_MARK = re.compile(r'^\[page: \d+\]$')
+_SENTENCE_SPLIT = re.compile(r'\. |。')
 
 
 class Chunk(BaseModel):
@@ -45,12 +54,18 @@ class Record(BaseModel):
     url: str
     raw: List[Chunk]
     title: str
+    # The DocParser cache name of these chunks (doc version and chunk size), which search indexes are keyed by.
+    # None when the chunks are not a whole parsed doc, e.g. the leading chunks only
+    cache_key: Optional[str] = None
 
-    def __init__(self, url: str, raw: List[Chunk], title: str):
-        super().__init__(url=url, raw=raw, title=title)
+    def __init__(self, url: str, raw: List[Chunk], title: str, cache_key: Optional[str] = None):
+        super().__init__(url=url, raw=raw, title=title, cache_key=cache_key)
 
     def to_dict(self) -> dict:
-        return {'url': self.url, 'raw': [x.to_dict() for x in self.raw], 'title': self.title}
+        record = {'url': self.url, 'raw': [x.to_dict() for x in self.raw], 'title': self.title}
+        if self.cache_key is not None:
+            record['cache_key'] = self.cache_key
+        return record
 
 
 @register_tool('doc_parser')
@@ -69,7 +84,7 @@ class DocParser(BaseTool):
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
 
         self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
-        self.db = Storage({'storage_root_path': self.data_root})
+        self.cache = PackedCache(self.data_root)
 
         self.doc_extractor = SimpleDocParser({'structured_doc': True})
 
@@ -99,22 +114,14 @@ class DocParser(BaseTool):
 
         url = params['url']
 
-        cached_name_chunking = f'{hash_sha256(url)}_{str(parser_page_size)}'
-        try:
-            # Directly load the chunked doc
-            record = self.db.get(cached_name_chunking)
-            record = json.loads(record)
+        # Resolved once: a URL revalidated during the parse must not have its chunks cached under another version
+        source = self.doc_extractor.resolve(url)
+        record = self._load_cached(source, parser_page_size)
+        if record is not None:
             logger.info(f'Read chunked {url} from cache.')
-            # 新增：如有 es_memory，自动写入 es
-            es_memory = getattr(self, 'es_memory', None)
-            memory_type = getattr(self, 'memory_type', 'local')
-            if memory_type == 'es' and es_memory is not None:
-                doc_name = os.path.basename(url)
-                chunks = [chunk['content'] for chunk in record['raw']]
-                es_memory.add_chunks(doc_name, chunks)
+            self._sync_memory(url, [chunk['content'] for chunk in record['raw']])
             return record
-        except KeyNotExistsError:
-            doc = self.doc_extractor.call({'url': url})
+        doc = self.doc_extractor.call({'url': url}, source=source)
 
         total_token = 0
         for page in doc:
@@ -139,148 +146,255 @@ class DocParser(BaseTool):
                       },
                       token=total_token)
             ]
-            cached_name_chunking = f'{hash_sha256(url)}_without_chunking'
+            cached_name_chunking = f'{source.key}_without_chunking'
         else:
+            cached_name_chunking = f'{source.key}_{str(parser_page_size)}'
             content = self.split_doc_to_chunk(doc, url, title=title, parser_page_size=parser_page_size)
 
         time2 = time.time()
         logger.info(f'Finished chunking {url} ({title}). Time spent: {time2 - time1} seconds.')
 
         # save the document data
-        new_record = Record(url=url, raw=content, title=title).to_dict()
-        new_record_str = json.dumps(new_record, ensure_ascii=False)
-        self.db.put(cached_name_chunking, new_record_str)
-        # 新增：如有 es_memory，自动写入 es
+        new_record = Record(url=url, raw=content, title=title, cache_key=cached_name_chunking).to_dict()
+        self.cache.put(cached_name_chunking, new_record)
+        self._sync_memory(url, [chunk.content for chunk in content])
+        return new_record
+
+    def call_many(self, urls: List[str], **kwargs) -> List[dict]:
+        """Parse and chunk several files, returning the records in the order of `urls`.
+
+        Files whose chunks are already cached are read directly. The others are parsed concurrently in the process
+        pool shared by all parsing of this process (see `get_parse_pool`), so its size caps the total parse work no
+        matter how many sessions ask at once. A single uncached file is parsed here instead, where a long PDF is
+        split into page ranges over that same pool. The first failure, in input order, is raised after all files
+        have finished.
+        """
+        max_ref_token = kwargs.get('max_ref_token', self.max_ref_token)
+        parser_page_size = kwargs.get('parser_page_size', self.parser_page_size)
+        records: List[Optional[dict]] = [None] * len(urls)
+        misses = []
+        for i, url in enumerate(urls):
+            record = self._load_cached(self.doc_extractor.resolve(url), parser_page_size)
+            if record is None:
+                misses.append(i)
+            else:
+                logger.info(f'Read chunked {url} from cache.')
+                self._sync_memory(url, [chunk['content'] for chunk in record['raw']])
+                records[i] = record
+
+        pool = get_parse_pool() if len(set(urls[i] for i in misses)) > 1 else None
+        if pool is None:
+            for i in misses:
+                records[i] = self.call({'url': urls[i]}, max_ref_token=max_ref_token, parser_page_size=parser_page_size)
+            return records
+
+        futures = {}
+        try:
+            for i in misses:
+                if urls[i] not in futures:
+                    futures[urls[i]] = pool.submit(_parse_in_worker, self.cfg, urls[i], max_ref_token,
+                                                   parser_page_size)
+        except (BrokenProcessPool, RuntimeError):
+            reset_parse_pool()
+        error = None
+        for i in misses:
+            try:
+                record = futures[urls[i]].result() if urls[i] in futures else None
+            except BrokenProcessPool:
+                reset_parse_pool()
+                record = None
+            except Exception as ex:
+                error = error or ex
+                continue
+            try:
+                if record is None:
+                    logger.warning(f'The parse worker pool is broken, parse {urls[i]} in the current process.')
+                    record = self.call({'url': urls[i]},
+                                       max_ref_token=max_ref_token,
+                                       parser_page_size=parser_page_size)
+                elif 'error' in record:
+                    raise DocParserError(code=record['error']['code'], message=record['error']['message'])
+                else:
+                    # The worker has no retrieval backend attached, so the chunks are written from this process
+                    self._sync_memory(urls[i], [chunk['content'] for chunk in record['raw']])
+            except Exception as ex:
+                error = error or ex
+                continue
+            records[i] = record
+        if error is not None:
+            raise error
+        return records
+
+    def iter_chunks(self, url: str, **kwargs) -> Iterator[Chunk]:
+        """Lazily yield the chunks that `call` returns for `url`, so a consumer needing only the front of a doc
+        can stop early.
+
+        Pages are parsed only as far as the chunks taken need (see `SimpleDocParser.iter_pages`); the rest of the
+        doc is parsed and cached in the background. Nothing is written to the retrieval backend.
+        """
+        max_ref_token = kwargs.get('max_ref_token', self.max_ref_token)
+        parser_page_size = kwargs.get('parser_page_size', self.parser_page_size)
+        packed = self.cache.open(f'{self.doc_extractor.resolve(url).key}_{str(parser_page_size)}')
+        if packed is not None:
+            with packed:
+                # Chunks are decompressed one at a time, as they are consumed
+                for chunk in packed:
+                    yield Chunk(**chunk)
+            return
+
+        pages = self.doc_extractor.iter_pages(url)
+        # Read just enough pages to know whether the whole doc fits into one chunk, as `call` decides
+        head, total_token = [], 0
+        for page in pages:
+            head.append(page)
+            total_token += sum(para['token'] for para in page['content'])
+            if total_token > max_ref_token:
+                break
+        if head and 'title' in head[0]:
+            title = head[0]['title']
+        else:
+            title = get_basename_from_url(url)
+        if total_token <= max_ref_token:
+            yield Chunk(content=get_plain_doc(head),
+                        metadata={
+                            'source': url,
+                            'title': title,
+                            'chunk_id': 0
+                        },
+                        token=total_token)
+            return
+        yield from self.iter_doc_chunks(itertools.chain(head, pages),
+                                        url,
+                                        title=title,
+                                        parser_page_size=parser_page_size)
+
+    def _load_cached(self, source: DocSource, parser_page_size: int) -> Optional[dict]:
+        # Keyed by the doc's version (see `resolve_doc`), so a changed file or URL is chunked again
+        cache_key = f'{source.key}_{str(parser_page_size)}'
+        record = self.cache.get(cache_key)
+        if record is not None:
+            # Also set on records cached before the field existed
+            record['cache_key'] = cache_key
+        return record
+
+    def _sync_memory(self, url: str, chunks: List[str]):
+        # 新增：如有 es_memory，自动写入 es（按片段内容增量写入，文档未变化时不产生 bulk 写入）
+        # 默认的 hybrid/embedding 检索需要向量，所以原文与 embedding 都要写入；写入后立即可检索
         es_memory = getattr(self, 'es_memory', None)
         memory_type = getattr(self, 'memory_type', 'local')
-        if memory_type == 'es' and es_memory is not None:
+        if memory_type != 'local' and es_memory is not None:
             doc_name = os.path.basename(url)
-            chunks = [chunk.content for chunk in content]
-            es_memory.add_chunks(doc_name, chunks)
-        return new_record
+            if not es_memory.unified:
+                # 两个索引时原文单独写入 BM25 索引；统一索引由 add_chunks_with_embedding 一并写入原文
+                es_memory.add_chunks(doc_name, chunks)
+            try:
+                es_memory.add_chunks_with_embedding(doc_name, chunks)
+            except Exception as ex:
+                # embedding 服务不可用时不影响已写入的原文（hybrid 检索仍有 BM25 一路），下次同步时补写向量
+                logger.warning(f'Failed to embed the chunks of {doc_name}: {ex}')
 
     def split_doc_to_chunk(self,
                            doc: List[dict],
                            path: str,
                            title: str = '',
                            parser_page_size: int = DEFAULT_PARSER_PAGE_SIZE) -> List[Chunk]:
-        res = []
+        return list(self.iter_doc_chunks(doc, path, title=title, parser_page_size=parser_page_size))
+
+    def iter_doc_chunks(self,
+                        doc: Iterable[dict],
+                        path: str,
+                        title: str = '',
+                        parser_page_size: int = DEFAULT_PARSER_PAGE_SIZE) -> Iterator[Chunk]:
+        """Same chunks as `split_doc_to_chunk`, each yielded as soon as it is complete.
+
+        A chunk only depends on the pages before it, so a consumer that stops early has read no more pages than
+        the chunks it took need.
+        """
+        num_chunks = 0
         chunk = []
         available_token = parser_page_size
         has_para = False
+
+        def record_chunk() -> Chunk:
+            if isinstance(chunk[-1], str) and _PAGE_MARK.fullmatch(chunk[-1]) is not None:
+                chunk.pop()  # Redundant page information
+            return Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk]),
+                         metadata={
+                             'source': path,
+                             'title': title,
+                             'chunk_id': num_chunks
+                         },
+                         token=parser_page_size - available_token)
+
+        def next_chunk() -> tuple:
+            # Define new chunk, starting with the overlap taken from the end of the recorded one
+            overlap_txt = self._get_last_part(chunk)
+            if overlap_txt.strip():
+                return [f'[page: {str(chunk[-1][1])}]', overlap_txt], parser_page_size - count_tokens(overlap_txt)
+            return [], parser_page_size
+
         for page in doc:
             page_num = page['page_num']
             if not chunk or f'[page: {str(page_num)}]' != chunk[0]:
                 chunk.append(f'[page: {str(page_num)}]')
-            idx = 0
-            len_para = len(page['content'])
-            while idx < len_para:
+            for para in page['content']:
                 if not chunk:
                     chunk.append(f'[page: {str(page_num)}]')
-                para = page['content'][idx]
                 txt = para.get('text', para.get('table'))
                 token = para['token']
                 if token <= available_token:
                     available_token -= token
                     chunk.append([txt, page_num])
                     has_para = True
-                    idx += 1
-                else:
-                    if has_para:
-                        # Record one chunk
-                        if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
-                            chunk.pop()  # Redundant page information
-                        res.append(
-                            Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
-                                [x if isinstance(x, str) else x[0] for x in chunk]),
-                                  metadata={
-                                      'source': path,
-                                      'title': title,
-                                      'chunk_id': len(res)
-                                  },
-                                  token=parser_page_size - available_token))
-
-                        # Define new chunk
-                        overlap_txt = self._get_last_part(chunk)
-                        if overlap_txt.strip():
-                            chunk = [f'[page: {str(chunk[-1][1])}]', overlap_txt]
-                            has_para = False
-                            available_token = parser_page_size - count_tokens(overlap_txt)
-                        else:
-                            chunk = []
-                            has_para = False
-                            available_token = parser_page_size
+                    continue
+                if has_para:
+                    # Record one chunk; the paragraph is retried against the next one
+                    yield record_chunk()
+                    num_chunks += 1
+                    chunk, available_token = next_chunk()
+                    has_para = False
+                    if not chunk:
+                        chunk.append(f'[page: {str(page_num)}]')
+                    if token <= available_token:
+                        available_token -= token
+                        chunk.append([txt, page_num])
+                        has_para = True
+                        continue
+
+                # There are excessively long paragraphs present
+                # Split paragraph to sentences, tokenizing each sentence once for both its length and any hard split
+                sentences = []
+                for s in _SENTENCE_SPLIT.split(txt):
+                    if not s.strip():
+                        continue
+                    token_ids = tokenizer.encode(s)
+                    token = len(token_ids)
+                    if token <= available_token:
+                        sentences.append([s, token])
                     else:
-                        # There are excessively long paragraphs present
-                        # Split paragraph to sentences
-                        _sentences = re.split(r'\. |。', txt)
-                        sentences = []
-                        for s in _sentences:
-                            token = count_tokens(s)
-                            if not s.strip() or token == 0:
-                                continue
-                            if token <= available_token:
-                                sentences.append([s, token])
-                            else:
-                                # Limit the length of a sentence to chunk size
-                                token_list = tokenizer.tokenize(s)
-                                for si in range(0, len(token_list), available_token):
-                                    ss = tokenizer.convert_tokens_to_string(
-                                        token_list[si:min(len(token_list), si + available_token)])
-                                    sentences.append([ss, min(available_token, len(token_list) - si)])
-                        sent_index = 0
-                        while sent_index < len(sentences):
-                            s = sentences[sent_index][0]
-                            token = sentences[sent_index][1]
-                            if not chunk:
-                                chunk.append(f'[page: {str(page_num)}]')
-
-                            if token <= available_token or (not has_para):
-                                # Be sure to add at least one sentence
-                                # (not has_para) is a patch of the previous sentence splitting
-                                available_token -= token
-                                chunk.append([s, page_num])
-                                has_para = True
-                                sent_index += 1
-                            else:
-                                assert has_para
-                                if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$',
-                                                                               chunk[-1]) is not None:
-                                    chunk.pop()  # Redundant page information
-                                res.append(
-                                    Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
-                                        [x if isinstance(x, str) else x[0] for x in chunk]),
-                                          metadata={
-                                              'source': path,
-                                              'title': title,
-                                              'chunk_id': len(res)
-                                          },
-                                          token=parser_page_size - available_token))
-
-                                overlap_txt = self._get_last_part(chunk)
-                                if overlap_txt.strip():
-                                    chunk = [f'[page: {str(chunk[-1][1])}]', overlap_txt]
-                                    has_para = False
-                                    available_token = parser_page_size - count_tokens(overlap_txt)
-                                else:
-                                    chunk = []
-                                    has_para = False
-                                    available_token = parser_page_size
-                        # Has split this paragraph by sentence
-                        idx += 1
+                        # Limit the length of a sentence to chunk size
+                        for si in range(0, token, available_token):
+                            sentences.append([
+                                tokenizer.convert_ids_to_string(token_ids[si:si + available_token]),
+                                min(available_token, token - si)
+                            ])
+                for s, token in sentences:
+                    if not chunk:
+                        chunk.append(f'[page: {str(page_num)}]')
+                    if not (token <= available_token or (not has_para)):
+                        yield record_chunk()
+                        num_chunks += 1
+                        chunk, available_token = next_chunk()
+                        has_para = False
+                        if not chunk:
+                            chunk.append(f'[page: {str(page_num)}]')
+                    # Be sure to add at least one sentence
+                    # (not has_para) is a patch of the previous sentence splitting
+                    available_token -= token
+                    chunk.append([s, page_num])
+                    has_para = True
         if has_para:
-            if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
-                chunk.pop()  # Redundant page information
-            res.append(
-                Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk]),
-                      metadata={
-                          'source': path,
-                          'title': title,
-                          'chunk_id': len(res)
-                      },
-                      token=parser_page_size - available_token))
-
-        return res
+            yield record_chunk()
 
     def _get_last_part(self, chunk: list) -> str:
         overlap = ''
@@ -302,7 +416,7 @@ class DocParser(BaseTool):
             sentence_split_symbol = '. '
             if '。' in para:
                 sentence_split_symbol = '。'
-            sentences = re.split(r'\. |。', para)
+            sentences = _SENTENCE_SPLIT.split(para)
             sentences = [sentence.strip() for sentence in sentences if sentence]
             for j in range(len(sentences) - 1, -1, -1):
                 sent = sentences[j]
@@ -317,3 +431,20 @@ class DocParser(BaseTool):
                 else:
                     return overlap
         return overlap
+
+
+_worker_doc_parsers: Dict[str, DocParser] = {}
+
+
+def _parse_in_worker(cfg: dict, url: str, max_ref_token: int, parser_page_size: int) -> dict:
+    """Runs DocParser.call in a pool process; the record is also written to the shared chunk cache."""
+    key = json.dumps(cfg, sort_keys=True, default=str)
+    if key not in _worker_doc_parsers:
+        _worker_doc_parsers[key] = DocParser(cfg)
+    try:
+        return _worker_doc_parsers[key].call({'url': url},
+                                            max_ref_token=max_ref_token,
+                                            parser_page_size=parser_page_size)
+    except DocParserError as ex:
+        # Sent back as data: the exception's keyword-only fields do not survive pickling
+        return {'error': {'code': ex.code, 'message': ex.message}}
@@ -0,0 +1,204 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A compact binary cache for parsed documents (pages) and chunk records (chunks).
+
+Layout of one `<key>.qpk` file, all integers little-endian:
+
+    header   magic b'QPK2', codec (u8), item count n (u32), frame count m (u32)
+    table    m + 1 entries of (offset u64, stored length u32, raw length u32, first item u32);
+             entry 0 is the meta frame
+    frames   the meta dict, then the items packed into frames of about FRAME_SIZE bytes, each a compressed JSON list
+
+The file is memory-mapped and only the frames holding the requested items are decompressed. zstd or lz4 are used
+when installed, otherwise zlib.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+from qwen_agent_local.log import logger
+
+PACKED_SUFFIX = '.qpk'
+MAGIC = b'QPK2'
+FRAME_SIZE = 64 * 1024
+_HEADER = struct.Struct('<4sBII')
+_ENTRY = struct.Struct('<QIII')
+
+CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD, CODEC_LZ4 = 0, 1, 2, 3
+
+
+def _available_codecs() -> dict:
+    codecs = {
+        CODEC_NONE: (bytes, lambda data, raw_len: bytes(data)),
+        CODEC_ZLIB: (lambda data: zlib.compress(data, 1), lambda data, raw_len: zlib.decompress(data)),
+    }
+    try:
+        import zstandard
+        compressor, decompressor = zstandard.ZstdCompressor(level=3), zstandard.ZstdDecompressor()
+        codecs[CODEC_ZSTD] = (compressor.compress,
+                              lambda data, raw_len: decompressor.decompress(data, max_output_size=raw_len))
+    except ImportError:
+        pass
+    try:
+        import lz4.block
+        codecs[CODEC_LZ4] = (lambda data: lz4.block.compress(data, store_size=False),
+                             lambda data, raw_len: lz4.block.decompress(data, uncompressed_size=raw_len))
+    except ImportError:
+        pass
+    return codecs
+
+
+_CODECS = _available_codecs()
+DEFAULT_CODEC = next(c for c in (CODEC_ZSTD, CODEC_LZ4, CODEC_ZLIB) if c in _CODECS)
+
+
+def write_packed(path: str, items: List[Any], meta: Optional[dict] = None, codec: int = DEFAULT_CODEC):
+    """Write items (JSON-serializable) and a meta dict to `path` atomically."""
+    compress = _CODECS[codec][0]
+    frames = [(json.dumps(meta or {}, ensure_ascii=False), 0)]
+    encoded, size, first = [], 0, 0
+    for i, obj in enumerate(items):
+        encoded.append(json.dumps(obj, ensure_ascii=False))
+        size += len(encoded[-1])
+        if size >= FRAME_SIZE or i == len(items) - 1:
+            frames.append(('[' + ','.join(encoded) + ']', first))
+            encoded, size, first = [], 0, i + 1
+
+    blocks = []
+    for text, first_item in frames:
+        raw = text.encode('utf-8')
+        blocks.append((compress(raw), len(raw), first_item))
+    offset = _HEADER.size + _ENTRY.size * len(blocks)
+    table = []
+    for data, raw_len, first_item in blocks:
+        table.append(_ENTRY.pack(offset, len(data), raw_len, first_item))
+        offset += len(data)
+
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, codec, len(items), len(blocks) - 1))
+        f.write(b''.join(table))
+        for data, _, _ in blocks:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class PackedDoc:
+    """A memory-mapped packed file: `meta`, `len()`, and items decoded on access, one frame at a time."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, codec, self._n, m = _HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a packed cache file')
+            if codec not in _CODECS:
+                raise ValueError(f'{path} is compressed with codec {codec}, which is not installed')
+            self._decompress = _CODECS[codec][1]
+            self._table = [_ENTRY.unpack_from(self._mm, _HEADER.size + _ENTRY.size * i) for i in range(m + 1)]
+            self._firsts = [entry[3] for entry in self._table[1:]]
+            self._frame: Tuple[int, list] = (-1, [])
+            self.meta: dict = self._decode(0)
+        except Exception:
+            self._mm.close()
+            raise
+
+    def _decode(self, frame: int) -> Any:
+        offset, length, raw_len, _ = self._table[frame]
+        return json.loads(self._decompress(self._mm[offset:offset + length], raw_len))
+
+    def _items_of(self, frame: int) -> list:
+        # The last decoded frame is kept, so reading consecutive items decompresses each frame once
+        if self._frame[0] != frame:
+            self._frame = (frame, self._decode(frame + 1))
+        return self._frame[1]
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __getitem__(self, i: int) -> Any:
+        if not -self._n <= i < self._n:
+            raise IndexError(i)
+        i %= self._n
+        frame = bisect.bisect_right(self._firsts, i) - 1
+        return self._items_of(frame)[i - self._firsts[frame]]
+
+    def __iter__(self) -> Iterator[Any]:
+        for frame in range(len(self._firsts)):
+            yield from self._items_of(frame)
+
+    def load(self) -> Union[list, dict]:
+        """The whole cached object, as it was given to `PackedCache.put`."""
+        items = []
+        for frame in range(len(self._firsts)):
+            items.extend(self._decode(frame + 1))
+        if 'items_key' not in self.meta:
+            return items
+        obj = dict(self.meta['fields'])
+        obj[self.meta['items_key']] = items
+        return obj
+
+    def close(self):
+        self._frame = (-1, [])
+        self._mm.close()
+
+    def __enter__(self) -> 'PackedDoc':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PackedCache:
+    """Packed cache files in a directory, one per key."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_of(self, key: str) -> str:
+        return os.path.join(self.root, key + PACKED_SUFFIX)
+
+    def put(self, key: str, obj: Union[list, dict], items_key: str = 'raw'):
+        """Cache a list of items, or a dict whose `items_key` field is the list of items."""
+        if isinstance(obj, list):
+            write_packed(self.path_of(key), obj)
+        else:
+            fields = {k: v for k, v in obj.items() if k != items_key}
+            write_packed(self.path_of(key), obj[items_key], meta={'items_key': items_key, 'fields': fields})
+
+    def open(self, key: str) -> Optional[PackedDoc]:
+        """The packed file of `key`, or None on a cache miss. Close it after use."""
+        path = self.path_of(key)
+        try:
+            return PackedDoc(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as ex:
+            logger.warning(f'Ignore unreadable cache {path}: {ex}')
+            return None
+
+    def get(self, key: str) -> Optional[Union[list, dict]]:
+        packed = self.open(key)
+        if packed is None:
+            return None
+        with packed:
+            return packed.load()
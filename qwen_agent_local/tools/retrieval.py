@@ -12,7 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict, Optional, Union
+import os
+from typing import Dict, List, Optional, Union
 
 import json5
 
@@ -63,11 +64,12 @@ class Retrieval(BaseTool):
         self.doc_parse = DocParser({'max_ref_token': self.max_ref_token, 'parser_page_size': self.parser_page_size})
 
         self.rag_searchers = self.cfg.get('rag_searchers', DEFAULT_RAG_SEARCHERS)
+        search_cfg = {'max_ref_token': self.max_ref_token, 'bm25_cache_root': self.doc_parse.data_root}
         if len(self.rag_searchers) == 1:
-            self.search = TOOL_REGISTRY[self.rag_searchers[0]]({'max_ref_token': self.max_ref_token})
+            self.search = TOOL_REGISTRY[self.rag_searchers[0]](search_cfg)
         else:
             from qwen_agent_local.tools.search_tools.hybrid_search import HybridSearch
-            self.search = HybridSearch({'max_ref_token': self.max_ref_token, 'rag_searchers': self.rag_searchers})
+            self.search = HybridSearch(dict(search_cfg, rag_searchers=self.rag_searchers))
 
     def call(self, params: Union[str, dict], **kwargs) -> list:
         """RAG tool.
@@ -94,20 +96,55 @@ class Retrieval(BaseTool):
         # 如有 es_memory，优先用 es 检索
         es_memory = getattr(self, 'es_memory', None)
         memory_type = getattr(self, 'memory_type', 'local')
-        if memory_type == 'es' and es_memory is not None:
+        if memory_type != 'local' and es_memory is not None:
+            from qwen_agent_local.memory.es_memory import parse_keygen_query
+            # 先确保会话文件已入库（已解析且未变化的文件只读缓存，不产生写入），再只在这些文件中检索
+            self.doc_parse.call_many(files, **kwargs)
+            doc_names = [os.path.basename(file) for file in files] if files else None
+            # snippet_size 非空时只返回片段中与问题匹配的窗口，减少注入 prompt 的 token
+            snippet = {
+                'snippet_size': params.get('snippet_size', self.cfg.get('snippet_size')),
+                'snippet_count': params.get('snippet_count', self.cfg.get('snippet_count', 1)),
+            }
+            sub_queries, keywords = parse_keygen_query(query)
+            if keywords or len(sub_queries) > 1:
+                # keygen 生成的多条信息/关键词一次 _msearch 检索后融合，而不是拼成一个查询
+                return es_memory.multi_search(sub_queries,
+                                              top_k=top_k,
+                                              keywords=keywords,
+                                              mode=search_type,
+                                              doc_names=doc_names,
+                                              **snippet)
+            # 只有一条信息时用解析出的文本检索，而不是 keygen 的原始 JSON
+            query = sub_queries[0] if sub_queries else query
             if search_type == 'bm25':
-                return es_memory.search(query, top_k=top_k)
+                return es_memory.search(query, top_k=top_k, doc_names=doc_names, **snippet)
             elif search_type == 'embedding':
-                return es_memory.embedding_search(query, top_k=top_k)
+                return es_memory.embedding_search(query, top_k=top_k, doc_names=doc_names, **snippet)
             else:  # 默认 hybrid
-                return es_memory.hybrid_search(query, top_k=top_k)
+                return es_memory.hybrid_search(query, top_k=top_k, doc_names=doc_names, **snippet)
 
-        records = []
-        for file in files:
-            _record = self.doc_parse.call(params={'url': file}, **kwargs)
-            records.append(_record)
+        if files and not query:
+            # 没有问题时只返回各文档开头的部分（BaseSearch._get_the_front_part），逐页解析够用即停，其余页面在后台解析并缓存
+            return self.search.call(params={'query': query}, docs=self._front_records(files, **kwargs), **kwargs)
 
+        # 多个文件在进程池中并行解析，已缓存的文件直接读取，结果保持 files 的顺序
+        records = self.doc_parse.call_many(files, **kwargs)
         if records:
             return self.search.call(params={'query': query}, docs=[Record(**rec) for rec in records], **kwargs)
         else:
             return []
+
+    def _front_records(self, files: List[str], **kwargs) -> List[Record]:
+        """The leading chunks of each file, as many as the per-doc share of max_ref_token needs"""
+        budget = int(kwargs.get('max_ref_token', self.max_ref_token) / len(files))
+        records = []
+        for file in files:
+            raw, token = [], 0
+            for chunk in self.doc_parse.iter_chunks(file, **kwargs):
+                raw.append(chunk)
+                token += chunk.token
+                if token >= budget:
+                    break
+            records.append(Record(url=file, raw=raw, title=raw[0].metadata.get('title', '') if raw else ''))
+        return records
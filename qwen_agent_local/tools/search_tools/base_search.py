@@ -21,7 +21,7 @@ from qwen_agent_local.log import logger
 from qwen_agent_local.settings import DEFAULT_MAX_REF_TOKEN
 from qwen_agent_local.tools.base import BaseTool
 from qwen_agent_local.tools.doc_parser import DocParser, Record
-from qwen_agent_local.utils.tokenization_qwen import count_tokens, tokenizer
+from qwen_agent_local.utils.tokenization_qwen import count_tokens_batch, tokenizer
 
 
 class RefMaterialOutput(BaseModel):
@@ -132,8 +132,8 @@ class BaseSearch(BaseTool):
         def format_input_doc(doc: List[str], url: str = '') -> Record:
             new_doc = []
             parser = DocParser()
-            for i, x in enumerate(doc):
-                page = {'page_num': i, 'content': [{'text': x, 'token': count_tokens(x)}]}
+            for i, (x, token) in enumerate(zip(doc, count_tokens_batch(doc))):
+                page = {'page_num': i, 'content': [{'text': x, 'token': token}]}
                 new_doc.append(page)
             content = parser.split_doc_to_chunk(new_doc, path=url)
             return Record(url=url, raw=content, title='')
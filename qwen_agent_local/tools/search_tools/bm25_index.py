@@ -0,0 +1,235 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent per-document BM25 postings and a sparse-matrix BM25 scorer for KeywordSearch.
+
+Each document is tokenized once per chunking (keyed by a digest of its chunk contents) and its postings are saved
+next to the DocParser chunk cache. At query time the postings of the session's documents are merged into a CSR
+weight matrix whose scores match `rank_bm25.BM25Okapi` built over the concatenation of all chunks.
+"""
+
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from qwen_agent_local.log import logger
+from qwen_agent_local.settings import DEFAULT_WORKSPACE
+from qwen_agent_local.tools.doc_parser import Record
+from qwen_agent_local.tools.storage import KeyNotExistsError, Storage
+from qwen_agent_local.utils.utils import hash_sha256
+
+BM25_INDEX_VERSION = 1
+DEFAULT_BM25_CACHE_ROOT = os.path.join(DEFAULT_WORKSPACE, 'tools', 'doc_parser')  # The default DocParser data_root
+
+
+class DocPostings:
+    """The tokenized form of one document: chunk lengths and term -> (chunk indexes, term frequencies)."""
+
+    def __init__(self, doc_len: List[int], postings: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.doc_len = doc_len
+        # Terms keep their first-occurrence order, which the merged idf average depends on
+        self.postings = postings
+
+    @classmethod
+    def build(cls, contents: Sequence[str], tokenizer: Callable[[str], List[str]]) -> 'DocPostings':
+        doc_len = []
+        postings: Dict[str, Tuple[list, list]] = {}
+        for idx, content in enumerate(contents):
+            words = tokenizer(content)
+            doc_len.append(len(words))
+            frequencies = {}
+            for word in words:
+                frequencies[word] = frequencies.get(word, 0) + 1
+            for word, freq in frequencies.items():
+                ids, tfs = postings.setdefault(word, ([], []))
+                ids.append(idx)
+                tfs.append(freq)
+        return cls(doc_len, {
+            word: (np.asarray(ids, dtype=np.int64), np.asarray(tfs, dtype=np.float64))
+            for word, (ids, tfs) in postings.items()
+        })
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                'version': BM25_INDEX_VERSION,
+                'doc_len': self.doc_len,
+                'postings': [[word, ids.tolist(), tfs.astype(np.int64).tolist()]
+                             for word, (ids, tfs) in self.postings.items()],
+            },
+            ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text: str) -> Optional['DocPostings']:
+        data = json.loads(text)
+        if data.get('version') != BM25_INDEX_VERSION:
+            return None
+        return cls(data['doc_len'], {
+            word: (np.asarray(ids, dtype=np.int64), np.asarray(tfs, dtype=np.float64))
+            for word, ids, tfs in data['postings']
+        })
+
+
+class MergedBM25:
+    """BM25Okapi over the concatenated chunks of several documents, as a CSR term-document weight matrix.
+
+    Row t holds idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)) for every chunk containing t, so
+    scoring a query is a sparse product over just the query terms' rows.
+    """
+
+    def __init__(self, docs: List[DocPostings], k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1, self.b = k1, b
+        doc_len = np.asarray([n for d in docs for n in d.doc_len], dtype=np.float64)
+        self.corpus_size = len(doc_len)
+        self.avgdl = doc_len.sum() / self.corpus_size if self.corpus_size else 0.0
+
+        # Same idf as BM25Okapi._calc_idf, iterating terms in the same order so the average is bit-identical
+        nd: Dict[str, int] = {}
+        for d in docs:
+            for word, (ids, _) in d.postings.items():
+                nd[word] = nd.get(word, 0) + len(ids)
+        self.idf: Dict[str, float] = {}
+        idf_sum = 0
+        negative_idfs = []
+        for word, freq in nd.items():
+            idf = math.log(self.corpus_size - freq + 0.5) - math.log(freq + 0.5)
+            self.idf[word] = idf
+            idf_sum += idf
+            if idf < 0:
+                negative_idfs.append(word)
+        self.average_idf = idf_sum / len(self.idf) if self.idf else 0.0
+        eps = epsilon * self.average_idf
+        for word in negative_idfs:
+            self.idf[word] = eps
+
+        from scipy.sparse import csr_matrix
+        self.vocab = {word: i for i, word in enumerate(self.idf)}
+        rows, cols, tfs = [], [], []
+        offset = 0
+        for d in docs:
+            for word, (ids, tf) in d.postings.items():
+                rows.append(np.full(len(ids), self.vocab[word], dtype=np.int64))
+                cols.append(ids + offset)
+                tfs.append(tf)
+            offset += len(d.doc_len)
+        if rows and self.avgdl:
+            rows, cols, tfs = np.concatenate(rows), np.concatenate(cols), np.concatenate(tfs)
+            idf = np.asarray(list(self.idf.values()), dtype=np.float64)
+            weights = idf[rows] * (tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * doc_len[cols] / self.avgdl)))
+        else:
+            rows = cols = np.zeros(0, dtype=np.int64)
+            weights = np.zeros(0, dtype=np.float64)
+        self.matrix = csr_matrix((weights, (rows, cols)), shape=(len(self.vocab), self.corpus_size))
+
+    def get_scores(self, query: List[str]) -> np.ndarray:
+        """Scores of every chunk, equal to BM25Okapi.get_scores up to float rounding."""
+        counts: Dict[int, int] = {}
+        for q in query:
+            if q in self.vocab:
+                counts[self.vocab[q]] = counts.get(self.vocab[q], 0) + 1
+        if not counts:
+            return np.zeros(self.corpus_size)
+        rows = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        return np.asarray(self.matrix[rows].T @ weights).ravel()
+
+
+def rank_order(scores: np.ndarray, top_k: Optional[int] = None) -> np.ndarray:
+    """Indexes sorted by descending score, ties kept in index order (same as a stable `list.sort(reverse=True)`).
+
+    With top_k only that prefix is computed, using argpartition instead of sorting every score.
+    """
+    n = len(scores)
+    if top_k is None or top_k >= n:
+        return np.argsort(-scores, kind='stable')
+    if top_k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    threshold = scores[np.argpartition(-scores, top_k - 1)[top_k - 1]]
+    above = np.flatnonzero(scores > threshold)
+    ties = np.flatnonzero(scores == threshold)[:top_k - len(above)]
+    candidates = np.concatenate([above, ties])
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
+
+
+class BM25IndexCache:
+    """Loads or builds DocPostings per document and keeps recently used ones (and merged stats) in memory."""
+
+    def __init__(self, root: str = DEFAULT_BM25_CACHE_ROOT, max_docs: int = 64, max_merged: int = 16):
+        self.db = Storage({'storage_root_path': root})
+        self.max_docs = max_docs
+        self.max_merged = max_merged
+        self._docs: 'OrderedDict[str, DocPostings]' = OrderedDict()
+        self._merged: 'OrderedDict[tuple, MergedBM25]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def doc_key(doc: Record) -> str:
+        # The DocParser cache key identifies both the document version and the chunk size it was split with;
+        # only chunks that are not a cached parse (e.g. plain text docs) are identified by hashing their contents
+        if doc.cache_key is not None:
+            return f'bm25_{doc.cache_key}'
+        return f'bm25_{hash_sha256(chr(0).join(chk.content for chk in doc.raw))}'
+
+    def get_doc(self, doc: Record, tokenizer: Callable[[str], List[str]]) -> Tuple[str, DocPostings]:
+        key = self.doc_key(doc)
+        with self._lock:
+            if key in self._docs:
+                self._docs.move_to_end(key)
+                return key, self._docs[key]
+        postings = None
+        try:
+            postings = DocPostings.from_json(self.db.get(key))
+        except KeyNotExistsError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f'Ignore broken BM25 index {key} of {doc.url}.')
+        if postings is None:
+            postings = DocPostings.build([chk.content for chk in doc.raw], tokenizer)
+            self.db.put(key, postings.to_json())
+        with self._lock:
+            self._docs[key] = postings
+            while len(self._docs) > self.max_docs:
+                self._docs.popitem(last=False)
+        return key, postings
+
+    def get_merged(self, docs: List[Record], tokenizer: Callable[[str], List[str]]) -> MergedBM25:
+        keyed = [self.get_doc(doc, tokenizer) for doc in docs]
+        merged_key = tuple(key for key, _ in keyed)
+        with self._lock:
+            if merged_key in self._merged:
+                self._merged.move_to_end(merged_key)
+                return self._merged[merged_key]
+        merged = MergedBM25([postings for _, postings in keyed])
+        with self._lock:
+            self._merged[merged_key] = merged
+            while len(self._merged) > self.max_merged:
+                self._merged.popitem(last=False)
+        return merged
+
+
+_caches: Dict[str, BM25IndexCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_bm25_index_cache(root: str = DEFAULT_BM25_CACHE_ROOT) -> BM25IndexCache:
+    """One cache per root (the DocParser data_root the postings are saved next to) per process"""
+    root = os.path.abspath(root)
+    with _caches_lock:
+        if root not in _caches:
+            _caches[root] = BM25IndexCache(root)
+        return _caches[root]
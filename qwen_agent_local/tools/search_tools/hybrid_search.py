@@ -12,14 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Dict, List, Optional, Tuple
 
-from qwen_agent_local.settings import DEFAULT_RAG_SEARCHERS
+import numpy as np
+
+from qwen_agent_local.log import logger
+from qwen_agent_local.settings import (DEFAULT_RAG_SEARCHER_THREADS, DEFAULT_RAG_SEARCHER_TIMEOUT,
+                                       DEFAULT_RAG_SEARCHERS)
 from qwen_agent_local.tools.base import TOOL_REGISTRY, register_tool
 from qwen_agent_local.tools.doc_parser import Record
 from qwen_agent_local.tools.search_tools.base_search import BaseSearch
+from qwen_agent_local.tools.search_tools.bm25_index import rank_order
 from qwen_agent_local.tools.search_tools.front_page_search import POSITIVE_INFINITY
 
+RRF_RANK_CONSTANT = 60
+
+_searcher_pool: Optional[ThreadPoolExecutor] = None
+_searcher_pool_lock = threading.Lock()
+
+
+def _get_searcher_pool() -> ThreadPoolExecutor:
+    global _searcher_pool
+    with _searcher_pool_lock:
+        if _searcher_pool is None:
+            _searcher_pool = ThreadPoolExecutor(max_workers=DEFAULT_RAG_SEARCHER_THREADS,
+                                                thread_name_prefix='hybrid_search')
+        return _searcher_pool
+
 
 @register_tool('hybrid_search')
 class HybridSearch(BaseSearch):
@@ -27,35 +49,98 @@ class HybridSearch(BaseSearch):
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
         self.rag_searchers = self.cfg.get('rag_searchers', DEFAULT_RAG_SEARCHERS)
+        self.searcher_timeout: float = self.cfg.get('searcher_timeout', DEFAULT_RAG_SEARCHER_TIMEOUT)
 
         if self.name in self.rag_searchers:
             raise ValueError(f'{self.name} can not be in `rag_searchers` = {self.rag_searchers}')
         self.search_objs = [TOOL_REGISTRY[name](cfg) for name in self.rag_searchers]
+        self.last_timings: Dict[str, float] = {}
 
     def sort_by_scores(self, query: str, docs: List[Record], **kwargs) -> List[Tuple[str, int, float]]:
-        chunk_and_score_list = []
-        for s_obj in self.search_objs:
-            chunk_and_score_list.append(s_obj.sort_by_scores(query=query, docs=docs, **kwargs))
+        chunk_and_score_list = self._run_searchers(query=query, docs=docs, **kwargs)
 
-        chunk_score_map = {}
+        # Reciprocal rank fusion over one flat score array: chunk j of docs[d] lives at offsets[d] + j
+        offsets, total = {}, 0
         for doc in docs:
-            chunk_score_map[doc.url] = [0] * len(doc.raw)
-
+            offsets[doc.url] = total
+            total += len(doc.raw)
+        scores = np.zeros(total, dtype=np.float64)
+        pinned = np.zeros(total, dtype=bool)
         for chunk_and_score in chunk_and_score_list:
-            for i in range(len(chunk_and_score)):
-                doc_id = chunk_and_score[i][0]
-                chunk_id = chunk_and_score[i][1]
-                score = chunk_and_score[i][2]
-                if score == POSITIVE_INFINITY:
-                    chunk_score_map[doc_id][chunk_id] = POSITIVE_INFINITY
-                else:
-                    # TODO: This needs to be adjusted for performance
-                    chunk_score_map[doc_id][chunk_id] += 1 / (i + 1 + 60)
+            if not chunk_and_score:
+                continue
+            idx = np.fromiter((offsets[doc_id] + chunk_id for doc_id, chunk_id, _ in chunk_and_score),
+                              dtype=np.int64,
+                              count=len(chunk_and_score))
+            is_inf = np.fromiter((score == POSITIVE_INFINITY for _, _, score in chunk_and_score),
+                                 dtype=bool,
+                                 count=len(chunk_and_score))
+            ranks = np.arange(1 + RRF_RANK_CONSTANT, len(chunk_and_score) + 1 + RRF_RANK_CONSTANT, dtype=np.float64)
+            # Each searcher ranks a chunk at most once, so a fancy-indexed add is enough
+            scores[idx[~is_inf]] += 1 / ranks[~is_inf]
+            pinned[idx[is_inf]] = True
+        scores[pinned] = POSITIVE_INFINITY
 
+        urls = [doc.url for doc in docs]
+        starts = np.fromiter(offsets.values(), dtype=np.int64, count=len(offsets))
         all_chunk_and_score = []
-        for k, v in chunk_score_map.items():
-            for i, x in enumerate(v):
-                all_chunk_and_score.append((k, i, x))
-        all_chunk_and_score.sort(key=lambda item: item[2], reverse=True)
-
+        for i in rank_order(scores):
+            d = int(np.searchsorted(starts, i, side='right')) - 1
+            all_chunk_and_score.append((urls[d], int(i - starts[d]), float(scores[i])))
         return all_chunk_and_score
+
+    def _run_searchers(self, query: str, docs: List[Record], **kwargs) -> List[List[Tuple[str, int, float]]]:
+        """Runs the sub-searchers concurrently and returns the rankings of those that finished in time.
+
+        The searchers run in a thread pool shared by all HybridSearches. Each one gets `searcher_timeout` seconds
+        from when it starts running (or from submission, while it is still queued); one that raises or runs out of
+        time is left out of the fusion with a warning, and finishes in the background with its result dropped.
+        The error is only raised when no searcher produced a ranking at all.
+        """
+        if len(self.search_objs) == 1:
+            return [self.search_objs[0].sort_by_scores(query=query, docs=docs, **kwargs)]
+
+        start = time.time()
+        timings: Dict[str, float] = {}
+        started: Dict[str, float] = {}
+
+        def _run(s_obj):
+            t = started[s_obj.name] = time.time()
+            try:
+                return s_obj.sort_by_scores(query=query, docs=docs, **kwargs)
+            finally:
+                timings[s_obj.name] = time.time() - t
+
+        pool = _get_searcher_pool()
+        futures = [pool.submit(_run, s_obj) for s_obj in self.search_objs]
+        pending = dict(zip(futures, self.search_objs))
+        while pending:
+            now = time.time()
+            for future, s_obj in list(pending.items()):
+                if now >= started.get(s_obj.name, start) + self.searcher_timeout:
+                    del pending[future]
+            if not pending:
+                break
+            next_deadline = min(started.get(s_obj.name, start) for s_obj in pending.values()) + self.searcher_timeout
+            done, _ = wait(pending, timeout=max(next_deadline - now, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+
+        chunk_and_score_list, errors, report = [], [], []
+        for s_obj, future in zip(self.search_objs, futures):
+            if not future.done():
+                logger.warning(f'{s_obj.name} did not finish within {self.searcher_timeout}s, '
+                               f'it is skipped in hybrid search.')
+                report.append(f'{s_obj.name}: timeout')
+            elif future.exception() is not None:
+                logger.warning(f'{s_obj.name} failed, it is skipped in hybrid search: {future.exception()}')
+                errors.append(future.exception())
+                report.append(f'{s_obj.name}: error')
+            else:
+                chunk_and_score_list.append(future.result())
+                report.append(f'{s_obj.name}: {timings[s_obj.name] * 1000:.1f}ms')
+        self.last_timings = dict(timings)
+        logger.info(f'hybrid search legs ({(time.time() - start) * 1000:.1f}ms in total): {", ".join(report)}')
+        if not chunk_and_score_list and errors:
+            raise errors[0]
+        return chunk_and_score_list
@@ -12,9 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 import re
 import string
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import json5
 
@@ -23,14 +24,22 @@ from qwen_agent_local.settings import DEFAULT_MAX_REF_TOKEN
 from qwen_agent_local.tools.base import register_tool
 from qwen_agent_local.tools.doc_parser import Record
 from qwen_agent_local.tools.search_tools.base_search import BaseSearch
+from qwen_agent_local.tools.search_tools.bm25_index import DEFAULT_BM25_CACHE_ROOT, get_bm25_index_cache, rank_order
 from qwen_agent_local.utils.utils import has_chinese_chars
 
 
 @register_tool('keyword_search')
 class KeywordSearch(BaseSearch):
 
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        # BM25 postings are saved next to the chunk cache of the DocParser that produced the docs
+        self.bm25_cache_root: str = self.cfg.get('bm25_cache_root', DEFAULT_BM25_CACHE_ROOT)
+
     def search(self, query: str, docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
-        chunk_and_score = self.sort_by_scores(query=query, docs=docs)
+        chunk_and_score = self.sort_by_scores(query=query,
+                                              docs=docs,
+                                              top_k=self._max_chunks_in_budget(docs, max_ref_token))
         if not chunk_and_score:
             return self._get_the_front_part(docs, max_ref_token)
 
@@ -41,7 +50,21 @@ class KeywordSearch(BaseSearch):
         else:
             return self._get_the_front_part(docs, max_ref_token)
 
+    @staticmethod
+    def _max_chunks_in_budget(docs: List[Record], max_ref_token: int) -> Optional[int]:
+        """An upper bound on how many ranked chunks get_topk can consume before max_ref_token runs out."""
+        tokens = [chk.token for doc in docs for chk in doc.raw]
+        positive = [t for t in tokens if t > 0]
+        if not positive:
+            return None
+        return (len(tokens) - len(positive)) + math.ceil(max_ref_token / min(positive)) + 1
+
     def sort_by_scores(self, query: str, docs: List[Record], **kwargs) -> List[Tuple[str, int, float]]:
+        """
+        Args:
+            top_k: Optional. Only the `top_k` best chunks are ranked and returned (selected with argpartition);
+              by default every chunk is returned, as HybridSearch fuses the full rankings.
+        """
         wordlist = parse_keyword(query)
         logger.debug('wordlist: ' + ','.join(wordlist))
         if not wordlist:
@@ -53,14 +76,12 @@ class KeywordSearch(BaseSearch):
         for doc in docs:
             all_chunks.extend(doc.raw)
 
-        # Using bm25 retrieval
-        from rank_bm25 import BM25Okapi
-        bm25 = BM25Okapi([split_text_into_keywords(x.content) for x in all_chunks])
+        # Using bm25 retrieval. Each doc is tokenized once and its postings are cached on disk;
+        # scores come from a sparse term-document matrix and match rank_bm25.BM25Okapi over all chunks.
+        bm25 = get_bm25_index_cache(self.bm25_cache_root).get_merged(docs, tokenizer=split_text_into_keywords)
         doc_scores = bm25.get_scores(wordlist)
-        chunk_and_score = [
-            (chk.metadata['source'], chk.metadata['chunk_id'], score) for chk, score in zip(all_chunks, doc_scores)
-        ]
-        chunk_and_score.sort(key=lambda item: item[2], reverse=True)
+        chunk_and_score = [(all_chunks[i].metadata['source'], all_chunks[i].metadata['chunk_id'], doc_scores[i])
+                           for i in rank_order(doc_scores, kwargs.get('top_k'))]
         assert len(chunk_and_score) > 0
 
         return chunk_and_score
@@ -14,19 +14,118 @@
 
 import json
 import os
-from typing import List, Tuple
+import threading
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+
+from config import EMBEDDING_DIM, EMBEDDING_MODEL
+from qwen_agent_local.log import logger
+from qwen_agent_local.settings import DEFAULT_VECTOR_SEARCH_BACKEND, DEFAULT_WORKSPACE
 from qwen_agent_local.tools.base import register_tool
 from qwen_agent_local.tools.doc_parser import Record
 from qwen_agent_local.tools.search_tools.base_search import BaseSearch
+from qwen_agent_local.tools.search_tools.bm25_index import rank_order
+from qwen_agent_local.utils.embedding_utils import get_embedding, iter_embeddings
+from qwen_agent_local.utils.utils import hash_sha256
+
+MAX_EMBEDDING_CHARS = 2000  # Only the head of each chunk is embedded
+
+
+class ChunkEmbeddingStore:
+    """Normalized float32 chunk embeddings of each document, saved as .npy files and memory-mapped on load.
+
+    A document's file is keyed by the embedding model, the dimensions and its DocParser cache key (its chunk contents
+    when it has none), so it is computed once per (document version, chunk size, embedding model) and reused across
+    queries and sessions.
+    """
+
+    def __init__(self, root: str, model: str = EMBEDDING_MODEL, dims: int = EMBEDDING_DIM):
+        self.root = root
+        self.model = model
+        self.dims = dims
+        os.makedirs(root, exist_ok=True)
+
+    def path_of(self, doc: Record) -> str:
+        if doc.cache_key is not None:
+            doc_key = doc.cache_key
+        else:
+            doc_key = chr(0).join(chk.content[:MAX_EMBEDDING_CHARS] for chk in doc.raw)
+        key = hash_sha256('\n'.join([self.model, str(self.dims), doc_key]))
+        return os.path.join(self.root, f'{key}.npy')
+
+    def get(self, doc: Record) -> np.ndarray:
+        path = self.path_of(doc)
+        if os.path.exists(path):
+            try:
+                return np.load(path, mmap_mode='r')
+            except ValueError:
+                logger.warning(f'Ignore broken embedding file {path} of {doc.url}.')
+        logger.info(f'Embedding {len(doc.raw)} chunks of {doc.url}...')
+        matrix = np.zeros((len(doc.raw), self.dims), dtype=np.float32)
+        for i, vector in iter_embeddings([chk.content[:MAX_EMBEDDING_CHARS] for chk in doc.raw], dimensions=self.dims):
+            if vector:
+                vector = np.asarray(vector, dtype=np.float32)
+                matrix[i] = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, matrix)
+        os.replace(tmp_path, path)
+        return matrix
 
 
 @register_tool('vector_search')
 class VectorSearch(BaseSearch):
     # TODO: Optimize the accuracy of the embedding retriever.
 
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        # 'store' embeds with config.EMBEDDING_MODEL through embedding_utils and keeps the chunk vectors on disk;
+        # 'langchain' is the previous path: DashScope text-embedding-v1 and a FAISS index rebuilt on every query
+        self.backend = self.cfg.get('vector_search_backend', DEFAULT_VECTOR_SEARCH_BACKEND)
+        if self.backend not in ('store', 'langchain'):
+            raise ValueError(f'Unknown vector search backend: {self.backend}')
+        self.store = ChunkEmbeddingStore(self.cfg.get('embedding_cache_path',
+                                                      os.path.join(DEFAULT_WORKSPACE, 'tools', self.name)))
+
     def sort_by_scores(self, query: str, docs: List[Record], **kwargs) -> List[Tuple[str, int, float]]:
-        # TODO: More types of embedding can be configured
+        """
+        Returns chunks sorted by cosine similarity to the query. Only the query is embedded at search time,
+        the chunk embeddings come from the on-disk store. An optional `top_k` limits the ranking to the best chunks.
+        """
+        # Extract raw query
+        try:
+            query_json = json.loads(query)
+            # This assumes that the user's input will not contain json str with the 'text' attribute
+            if 'text' in query_json:
+                query = query_json['text']
+        except json.decoder.JSONDecodeError:
+            pass
+
+        if self.backend == 'langchain':
+            return self._sort_by_scores_langchain(query, docs)
+
+        query_vector = get_embedding(query, dimensions=self.store.dims)
+        if not query_vector:
+            return []
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+
+        # Plain all chunks from all docs
+        all_chunks = []
+        scores = []
+        for doc in docs:
+            all_chunks.extend(doc.raw)
+            scores.append(self.store.get(doc) @ query_vector)
+        if not all_chunks:
+            return []
+        scores = np.concatenate(scores)
+        return [(all_chunks[i].metadata['source'], all_chunks[i].metadata['chunk_id'], float(scores[i]))
+                for i in rank_order(scores, kwargs.get('top_k'))]
+
+    @staticmethod
+    def _sort_by_scores_langchain(query: str, docs: List[Record]) -> List[Tuple[str, int, float]]:
+        """The previous implementation: FAISS L2 distances (lower is better) over embeddings computed per query."""
         try:
             from langchain.schema import Document
         except ModuleNotFoundError:
@@ -38,20 +137,12 @@ class VectorSearch(BaseSearch):
             raise ModuleNotFoundError(
                 'Please install langchain_community by: `pip install langchain_community`, '
                 'and install faiss by: `pip install faiss-cpu` or `pip install faiss-gpu` (for CUDA supported GPU)')
-        # Extract raw query
-        try:
-            query_json = json.loads(query)
-            # This assumes that the user's input will not contain json str with the 'text' attribute
-            if 'text' in query_json:
-                query = query_json['text']
-        except json.decoder.JSONDecodeError:
-            pass
 
         # Plain all chunks from all docs
         all_chunks = []
         for doc in docs:
             for chk in doc.raw:
-                all_chunks.append(Document(page_content=chk.content[:2000], metadata=chk.metadata))
+                all_chunks.append(Document(page_content=chk.content[:MAX_EMBEDDING_CHARS], metadata=chk.metadata))
 
         embeddings = DashScopeEmbeddings(model='text-embedding-v1',
                                          dashscope_api_key=os.getenv('DASHSCOPE_API_KEY', ''))
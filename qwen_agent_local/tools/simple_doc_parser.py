@@ -12,21 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import bisect
 import os
 import re
+import sys
+import threading
 import time
 from collections import Counter
-from typing import Dict, List, Optional, Union
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterator, List, Optional, Union
 
 from qwen_agent_local.log import logger
-from qwen_agent_local.settings import DEFAULT_WORKSPACE
+from qwen_agent_local.settings import DEFAULT_PARSER_MAX_WORKERS, DEFAULT_WORKSPACE
 from qwen_agent_local.tools.base import BaseTool, register_tool
-from qwen_agent_local.tools.storage import KeyNotExistsError, Storage
+from qwen_agent_local.tools.packed_cache import PackedCache
+from qwen_agent_local.utils.doc_source import DocSource, resolve_doc
+from qwen_agent_local.utils.parallel_executor import get_parse_pool, reset_parse_pool
 from qwen_agent_local.utils.str_processing import rm_cid, rm_continuous_placeholders, rm_hexadecimal
-from qwen_agent_local.utils.tokenization_qwen import count_tokens
-from qwen_agent_local.utils.utils import (get_file_type, hash_sha256, is_http_url, read_text_from_file,
-                                    sanitize_chrome_file_path, save_url_to_local_work_dir)
+from qwen_agent_local.utils.tokenization_qwen import count_tokens_batch
+from qwen_agent_local.utils.utils import get_file_type, is_http_url, read_text_from_file, sanitize_chrome_file_path
 
 
 def clean_paragraph(text):
@@ -237,75 +241,144 @@ def parse_html_bs(path: str, extract_image: bool = False):
     return [{'page_num': 1, 'content': content, 'title': title}]
 
 
+PDF_MIN_PAGES_PER_SHARD = 16
+
+
 def parse_pdf(pdf_path: str, extract_image: bool = False) -> List[dict]:
+    # Long PDFs are split into contiguous page ranges parsed in the shared parse pool, then concatenated in order
+    pool = get_parse_pool()
+    num_pages = count_pdf_pages(pdf_path) if pool is not None else 0
+    num_shards = min(DEFAULT_PARSER_MAX_WORKERS, num_pages // PDF_MIN_PAGES_PER_SHARD)
+    if num_shards <= 1:
+        return list(iter_pdf_pages(pdf_path, extract_image))
+
+    bounds = [num_pages * i // num_shards for i in range(num_shards + 1)]
+    try:
+        futures = [
+            pool.submit(_parse_pdf_range, pdf_path, extract_image, bounds[i], bounds[i + 1]) for i in range(num_shards)
+        ]
+        doc = []
+        for future in futures:
+            doc.extend(future.result())
+        return doc
+    except BrokenProcessPool:
+        reset_parse_pool()
+        logger.warning(f'The parse worker pool is broken, parse {pdf_path} in the current process.')
+        return list(iter_pdf_pages(pdf_path, extract_image))
+
+
+def count_pdf_pages(pdf_path: str) -> int:
+    from pdfminer.pdfpage import PDFPage
+
+    try:
+        with open(pdf_path, 'rb') as fp:
+            return sum(1 for _ in PDFPage.get_pages(fp))
+    except Exception:
+        # Let the serial parse report the problem
+        return 0
+
+
+def _parse_pdf_range(pdf_path: str, extract_image: bool, start: int, end: int) -> List[dict]:
+    return list(iter_pdf_pages(pdf_path, extract_image, start=start, end=end))
+
+
+def iter_pdf_pages(pdf_path: str,
+                   extract_image: bool = False,
+                   start: int = 0,
+                   end: Optional[int] = None) -> Iterator[dict]:
+    """Parse the pages [start, end) of a pdf one by one, lazily.
+
+    The pdfplumber handle used for tables is opened once, and only when a page contains an LTRect.
+    """
     # Todo: header and footer
     from pdfminer.high_level import extract_pages
+
+    pdf = None
+    page_numbers = None if start == 0 and end is None else range(start, sys.maxsize if end is None else end)
+    try:
+        for page_layout in extract_pages(pdf_path, page_numbers=page_numbers):
+            # The pageid counts the pages processed by this call, starting from 1
+            page_index = start + page_layout.pageid - 1
+
+            def _extract_tables():
+                nonlocal pdf
+                if pdf is None:
+                    import pdfplumber
+                    pdf = pdfplumber.open(pdf_path)
+                return extract_tables(pdf, page_index)
+
+            yield parse_pdf_page(page_layout, page_index + 1, _extract_tables, extract_image)
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+
+def parse_pdf_page(page_layout, page_num: int, get_tables: Callable[[], list], extract_image: bool = False) -> dict:
     from pdfminer.layout import LTImage, LTRect, LTTextContainer
 
-    doc = []
-    import pdfplumber
-    pdf = pdfplumber.open(pdf_path)
-    for i, page_layout in enumerate(extract_pages(pdf_path)):
-        page = {'page_num': page_layout.pageid, 'content': []}
-
-        elements = []
-        for element in page_layout:
-            elements.append(element)
-
-        # Init params for table
-        table_num = 0
-        tables = []
-
-        for element in elements:
-            if isinstance(element, LTRect):
-                if not tables:
-                    tables = extract_tables(pdf, i)
-                if table_num < len(tables):
-                    table_string = table_converter(tables[table_num])
-                    table_num += 1
-                    if table_string:
-                        page['content'].append({'table': table_string, 'obj': element})
-            elif isinstance(element, LTTextContainer):
-                # Delete line breaks in the same paragraph
-                text = element.get_text()
-                # Todo: Further analysis using font
-                font = get_font(element)
-                if text.strip():
-                    new_content_item = {'text': text, 'obj': element}
-                    if font:
-                        new_content_item['font-size'] = round(font[1])
-                        # new_content_item['font-name'] = font[0]
-                    page['content'].append(new_content_item)
-            elif extract_image and isinstance(element, LTImage):
-                # Todo: ocr
-                raise ValueError('Currently, extracting images is not supported!')
-            else:
-                pass
+    page = {'page_num': page_num, 'content': []}
+
+    elements = []
+    for element in page_layout:
+        elements.append(element)
+
+    # Init params for table
+    table_num = 0
+    tables = None  # Extracted at the first LTRect, once per page
+
+    for element in elements:
+        if isinstance(element, LTRect):
+            if tables is None:
+                tables = get_tables()
+            if table_num < len(tables):
+                table_string = table_converter(tables[table_num])
+                table_num += 1
+                if table_string:
+                    page['content'].append({'table': table_string, 'obj': element})
+        elif isinstance(element, LTTextContainer):
+            # Delete line breaks in the same paragraph
+            text = element.get_text()
+            # Todo: Further analysis using font
+            font = get_font(element)
+            if text.strip():
+                new_content_item = {'text': text, 'obj': element}
+                if font:
+                    new_content_item['font-size'] = round(font[1])
+                    # new_content_item['font-name'] = font[0]
+                page['content'].append(new_content_item)
+        elif extract_image and isinstance(element, LTImage):
+            # Todo: ocr
+            raise ValueError('Currently, extracting images is not supported!')
+        else:
+            pass
 
-        # merge elements
-        page['content'] = postprocess_page_content(page['content'])
-        doc.append(page)
+    # merge elements
+    page['content'] = postprocess_page_content(page['content'])
+    return page
 
-    return doc
+
+class _TableBoxIndex:
+    """Table bboxes sorted by x0, so a text box is only compared with the tables starting at or left of it."""
+
+    def __init__(self, boxes: List[tuple]):
+        self.boxes = sorted(boxes, key=lambda bbox: bbox[0])
+        self.x0s = [bbox[0] for bbox in self.boxes]
+
+    def is_repetitive(self, bbox: tuple) -> bool:
+        # Same test as before: t.x0 <= x0, y0 <= t.y0, t.x1 <= x1, y1 <= t.y1
+        for t in self.boxes[:bisect.bisect_right(self.x0s, bbox[0])]:
+            if bbox[1] <= t[1] and t[2] <= bbox[2] and bbox[3] <= t[3]:
+                return True
+        return False
 
 
 def postprocess_page_content(page_content: list) -> list:
     # rm repetitive identification for table and text
     # Some documents may repeatedly recognize LTRect and LTTextContainer
-    table_obj = [p['obj'] for p in page_content if 'table' in p]
-    tmp = []
-    for p in page_content:
-        repetitive = False
-        if 'text' in p:
-            for t in table_obj:
-                if t.bbox[0] <= p['obj'].bbox[0] and p['obj'].bbox[1] <= t.bbox[1] and t.bbox[2] <= p['obj'].bbox[
-                        2] and p['obj'].bbox[3] <= t.bbox[3]:
-                    repetitive = True
-                    break
-
-        if not repetitive:
-            tmp.append(p)
-    page_content = tmp
+    table_boxes = [p['obj'].bbox for p in page_content if 'table' in p]
+    if table_boxes:
+        index = _TableBoxIndex(table_boxes)
+        page_content = [p for p in page_content if 'text' not in p or not index.is_repetitive(p['obj'].bbox)]
 
     # merge paragraphs that have been separated by mistake
     new_page_content = []
@@ -348,6 +421,7 @@ def get_font(element):
 def extract_tables(pdf, page_num):
     table_page = pdf.pages[page_num]
     tables = table_page.extract_tables()
+    table_page.flush_cache()  # Drop the page's cached objects, a long pdf would otherwise keep them all
     return tables
 
 
@@ -393,7 +467,7 @@ class SimpleDocParser(BaseTool):
         self.extract_image = self.cfg.get('extract_image', False)
         self.structured_doc = self.cfg.get('structured_doc', False)
 
-        self.db = Storage({'storage_root_path': self.data_root})
+        self.cache = PackedCache(self.data_root)
 
     def call(self, params: Union[str, dict], **kwargs) -> Union[str, list]:
         """Parse pdf by url, and return the formatted content.
@@ -417,66 +491,173 @@ class SimpleDocParser(BaseTool):
 
         params = self._verify_json_format_args(params)
         path = params['url']
-        cached_name_ori = f'{hash_sha256(path)}_ori'
-        try:
-            # Directly load the parsed doc
-            parsed_file = self.db.get(cached_name_ori)
-            parsed_file = json.loads(parsed_file)
+        # A caller that already resolved the doc (DocParser) passes its DocSource, so both use the same version
+        source = kwargs.get('source')
+        if source is None:
+            source = self.resolve(path)
+        cached_name_ori = f'{source.key}_ori'
+        # Directly load the parsed doc
+        parsed_file = self.cache.get(cached_name_ori)
+        if parsed_file is not None:
             logger.info(f'Read parsed {path} from cache.')
-        except KeyNotExistsError:
-            logger.info(f'Start parsing {path}...')
-            time1 = time.time()
-
-            f_type = get_file_type(path)
-            if f_type in PARSER_SUPPORTED_FILE_TYPES:
-                if path.startswith('https://') or path.startswith('http://') or re.match(
-                        r'^[A-Za-z]:\\', path) or re.match(r'^[A-Za-z]:/', path):
-                    path = path
-                else:
-                    path = sanitize_chrome_file_path(path)
-
-            os.makedirs(self.data_root, exist_ok=True)
-            if is_http_url(path):
-                # download online url
-                tmp_file_root = os.path.join(self.data_root, hash_sha256(path))
-                os.makedirs(tmp_file_root, exist_ok=True)
-                path = save_url_to_local_work_dir(path, tmp_file_root)
-            try:
-                if f_type == 'pdf':
-                    parsed_file = parse_pdf(path, self.extract_image)
-                elif f_type == 'docx':
-                    parsed_file = parse_word(path, self.extract_image)
-                elif f_type == 'pptx':
-                    parsed_file = parse_ppt(path, self.extract_image)
-                elif f_type == 'txt':
-                    parsed_file = parse_txt(path)
-                elif f_type == 'html':
-                    parsed_file = parse_html_bs(path, self.extract_image)
-                elif f_type == 'csv':
-                    parsed_file = parse_csv(path, self.extract_image)
-                elif f_type == 'tsv':
-                    parsed_file = parse_tsv(path, self.extract_image)
-                elif f_type in ['xlsx', 'xls']:
-                    parsed_file = parse_excel(path, self.extract_image)
-                else:
-                    raise ValueError(
-                        f'Failed: The current parser does not support this file type! Supported types: {"/".join(PARSER_SUPPORTED_FILE_TYPES)}'
-                    )
-            except Exception as ex:
-                exception_type = type(ex).__name__
-                exception_message = str(ex)
-                raise DocParserError(code=exception_type, message=exception_message)
-
-            for page in parsed_file:
-                for para in page['content']:
-                    # Todo: More attribute types
-                    para['token'] = count_tokens(para.get('text', para.get('table')))
-            time2 = time.time()
-            logger.info(f'Finished parsing {path}. Time spent: {time2 - time1} seconds.')
-            # Cache the parsing doc
-            self.db.put(cached_name_ori, json.dumps(parsed_file, ensure_ascii=False, indent=2))
+        else:
+            lazy_parse = _lazy_parses.get(cached_name_ori)
+            if lazy_parse is not None:
+                # A lazy parse of this doc is running in the background, wait for it instead of parsing twice
+                parsed_file = list(lazy_parse.iter_pages())
+            else:
+                logger.info(f'Start parsing {path}...')
+                time1 = time.time()
+                parsed_file = list(self._iter_parse(path, source.local_path))
+                time2 = time.time()
+                logger.info(f'Finished parsing {path}. Time spent: {time2 - time1} seconds.')
+                # Cache the parsing doc
+                self.cache.put(cached_name_ori, parsed_file)
 
         if not self.structured_doc:
             return get_plain_doc(parsed_file)
         else:
             return parsed_file
+
+    def iter_pages(self, url: str) -> Iterator[dict]:
+        """Yield the structured pages of a doc one by one, the same pages `call` returns with `structured_doc`.
+
+        Pages come from the cache if the doc was parsed before. Otherwise the doc is parsed in a background thread,
+        page by page for pdf, and each page is yielded as soon as it is ready. The consumer may stop early: the
+        parse keeps going in the background and fills the cache when it is done, so later calls reuse it.
+        """
+        source = self.resolve(url)
+        cached_name_ori = f'{source.key}_ori'
+        packed = self.cache.open(cached_name_ori)
+        if packed is None:
+            with _lazy_parses_lock:
+                lazy_parse = _lazy_parses.get(cached_name_ori)
+                if lazy_parse is None:
+                    pages = self._iter_parse(url, source.local_path, lazy=True)
+                    lazy_parse = _LazyParse(cached_name_ori, pages, self.cache)
+                    _lazy_parses[cached_name_ori] = lazy_parse
+                    lazy_parse.start()
+            yield from lazy_parse.iter_pages()
+            return
+        logger.info(f'Read parsed {url} from cache.')
+        with packed:
+            # Pages are decompressed one at a time, as they are consumed
+            yield from packed
+
+    def resolve(self, url: str) -> DocSource:
+        """The cache key of a doc, downloading (or revalidating) it first if it is a URL."""
+        try:
+            return resolve_doc(url, self.data_root)
+        except Exception as ex:
+            raise DocParserError(code=type(ex).__name__, message=str(ex))
+
+    def _iter_parse(self, path: str, local_path: Optional[str] = None, lazy: bool = False) -> Iterator[dict]:
+        f_type = get_file_type(path)
+        if f_type in PARSER_SUPPORTED_FILE_TYPES:
+            if path.startswith('https://') or path.startswith('http://') or re.match(
+                    r'^[A-Za-z]:\\', path) or re.match(r'^[A-Za-z]:/', path):
+                path = path
+            else:
+                path = sanitize_chrome_file_path(path)
+
+        os.makedirs(self.data_root, exist_ok=True)
+        if local_path is not None:
+            # Online url, already downloaded by `resolve`
+            path = local_path
+        elif is_http_url(path):
+            path = self.resolve(path).local_path
+        try:
+            if f_type == 'pdf':
+                if lazy:
+                    # Page by page, so the consumer gets the first pages before the whole doc is parsed
+                    pages = iter_pdf_pages(path, self.extract_image)
+                else:
+                    pages = parse_pdf(path, self.extract_image)
+            elif f_type == 'docx':
+                pages = parse_word(path, self.extract_image)
+            elif f_type == 'pptx':
+                pages = parse_ppt(path, self.extract_image)
+            elif f_type == 'txt':
+                pages = parse_txt(path)
+            elif f_type == 'html':
+                pages = parse_html_bs(path, self.extract_image)
+            elif f_type == 'csv':
+                pages = parse_csv(path, self.extract_image)
+            elif f_type == 'tsv':
+                pages = parse_tsv(path, self.extract_image)
+            elif f_type in ['xlsx', 'xls']:
+                pages = parse_excel(path, self.extract_image)
+            else:
+                raise ValueError(
+                    f'Failed: The current parser does not support this file type! Supported types: {"/".join(PARSER_SUPPORTED_FILE_TYPES)}'
+                )
+            if not lazy:
+                # The whole doc is at hand, so all its paragraphs are counted in one batch
+                pages = list(pages)
+                _count_para_tokens([para for page in pages for para in page['content']])
+                yield from pages
+                return
+            for page in pages:
+                _count_para_tokens(page['content'])
+                yield page
+        except Exception as ex:
+            exception_type = type(ex).__name__
+            exception_message = str(ex)
+            raise DocParserError(code=exception_type, message=exception_message)
+
+
+def _count_para_tokens(paras: List[dict]):
+    # Todo: More attribute types
+    for para, token in zip(paras, count_tokens_batch([para.get('text', para.get('table')) for para in paras])):
+        para['token'] = token
+
+
+_lazy_parses: Dict[str, '_LazyParse'] = {}
+_lazy_parses_lock = threading.Lock()
+
+
+class _LazyParse:
+    """Runs a page generator to the end in a background thread, sharing the pages with any number of readers."""
+
+    def __init__(self, cached_name: str, pages: Iterator[dict], cache: PackedCache):
+        self.cached_name = cached_name
+        self._source = pages
+        self._cache = cache
+        self._pages: List[dict] = []
+        self._done = False
+        self._error: Optional[Exception] = None
+        self._cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'lazy_parse_{self.cached_name[:8]}', daemon=True).start()
+
+    def _run(self):
+        try:
+            for page in self._source:
+                with self._cond:
+                    self._pages.append(page)
+                    self._cond.notify_all()
+            self._cache.put(self.cached_name, self._pages)
+        except Exception as ex:
+            self._error = ex
+        finally:
+            with _lazy_parses_lock:
+                _lazy_parses.pop(self.cached_name, None)
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def iter_pages(self) -> Iterator[dict]:
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self._pages) and not self._done:
+                    self._cond.wait()
+                if i < len(self._pages):
+                    page = self._pages[i]
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
+            yield page
+            i += 1
@@ -13,12 +13,19 @@
 # limitations under the License.
 
 import os
-from typing import Dict, Optional, Union
+import re
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple, Union
 
-from qwen_agent_local.settings import DEFAULT_WORKSPACE
+from qwen_agent_local.log import logger
+from qwen_agent_local.settings import DEFAULT_STORAGE_BACKEND, DEFAULT_WORKSPACE
 from qwen_agent_local.tools.base import BaseTool, register_tool
 from qwen_agent_local.utils.utils import read_text_from_file, save_text_to_file
 
+STORAGE_DB_NAME = 'storage.sqlite3'
+TMP_DIR_NAME = '.tmp'  # Temporary files of the file backend, kept out of the key tree
+
 
 class KeyNotExistsError(ValueError):
     pass
@@ -50,6 +57,10 @@ class Storage(BaseTool):
         super().__init__(cfg)
         self.root = self.cfg.get('storage_root_path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
         os.makedirs(self.root, exist_ok=True)
+        # 'file': one file per key under root; 'sqlite': one SQLite (WAL) database in root
+        self.backend = self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+        if self.backend not in ('file', 'sqlite'):
+            raise ValueError(f'Unknown storage backend: {self.backend}')
 
     def call(self, params: Union[str, dict], **kwargs) -> str:
         params = self._verify_json_format_args(params)
@@ -69,26 +80,44 @@ class Storage(BaseTool):
             return self.scan(key)
 
     def put(self, key: str, value: str, path: Optional[str] = None) -> str:
-        path = path or self.root
+        root = path or self.root
+        if self.backend == 'sqlite':
+            get_sqlite_backend(root).put(key, value)
+            return f'Successfully saved {key}.'
 
         # one file for one key value pair
-        path = os.path.join(path, key)
+        path = os.path.join(root, key)
 
         path_dir = path[:path.rfind('/') + 1]
         if path_dir:
             os.makedirs(path_dir, exist_ok=True)
 
-        save_text_to_file(path, value)
+        # Write to a temporary file first, so readers never see a partially written value. It lives outside the
+        # key tree, so a scan never returns it
+        tmp_dir = os.path.join(root, TMP_DIR_NAME)
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, f'{os.getpid()}.{threading.get_ident()}.tmp')
+        save_text_to_file(tmp_path, value)
+        os.replace(tmp_path, path)
         return f'Successfully saved {key}.'
 
     def get(self, key: str, path: Optional[str] = None) -> str:
         path = path or self.root
+        if self.backend == 'sqlite':
+            value = get_sqlite_backend(path).get(key)
+            if value is None:
+                raise KeyNotExistsError(f'Get Failed: {key} does not exist')
+            return value
         if not os.path.exists(os.path.join(path, key)):
             raise KeyNotExistsError(f'Get Failed: {key} does not exist')
         return read_text_from_file(os.path.join(path, key))
 
     def delete(self, key, path: Optional[str] = None) -> str:
         path = path or self.root
+        if self.backend == 'sqlite':
+            if get_sqlite_backend(path).delete(key):
+                return f'Successfully deleted {key}'
+            return f'Delete Failed: {key} does not exist'
         path = os.path.join(path, key)
         if os.path.exists(path):
             os.remove(path)
@@ -98,6 +127,9 @@ class Storage(BaseTool):
 
     def scan(self, key: str, path: Optional[str] = None) -> str:
         path = path or self.root
+        if self.backend == 'sqlite':
+            return self._scan_sqlite(key, path)
+        tmp_dir = os.path.join(path, TMP_DIR_NAME)
         path = os.path.join(path, key)
         if os.path.exists(path):
             if not os.path.isdir(path):
@@ -105,6 +137,7 @@ class Storage(BaseTool):
             # All key-value pairs
             kvs = {}
             for root, dirs, files in os.walk(path):
+                dirs[:] = [d for d in dirs if os.path.join(root, d) != tmp_dir]
                 for file in files:
                     k = os.path.join(root, file)[len(path):]
                     if not k.startswith('/'):
@@ -114,3 +147,151 @@ class Storage(BaseTool):
             return '\n'.join([f'{k}: {v}' for k, v in kvs.items()])
         else:
             return f'Scan Failed: {key} does not exist.'
+
+    def _scan_sqlite(self, key: str, path: str) -> str:
+        # Keys are paths, so a folder is the range of keys under `folder/`
+        folder = key.strip('/')
+        backend = get_sqlite_backend(path)
+        kvs = backend.scan(f'{folder}/' if folder else '')
+        if not kvs and folder:
+            if backend.get(folder) is not None:
+                return 'Scan Failed: The scan operation requires passing in a folder path as the key.'
+            return f'Scan Failed: {key} does not exist.'
+        return '\n'.join([f'/{k[len(folder):].lstrip("/")}: {v}' for k, v in kvs])
+
+
+class SQLiteStorageBackend:
+    """
+    Key-value pairs of one Storage root in a SQLite database (WAL mode). The primary key index makes a prefix scan
+    a range query, and every write is a transaction, so concurrent writers in several processes are safe.
+    """
+
+    def __init__(self, root: str):
+        self.path = os.path.join(root, STORAGE_DB_NAME)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection must not be shared with forked worker processes, each process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def put(self, key: str, value: str):
+        self.put_many([(key, value)])
+
+    def put_many(self, items: List[Tuple[str, str]]):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', items)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                return conn.execute('DELETE FROM kv WHERE key = ?', (key,)).rowcount > 0
+
+    def scan(self, prefix: str = '') -> List[Tuple[str, str]]:
+        """All (key, value) pairs whose key starts with prefix, in key order"""
+        with self._lock:
+            conn = self._connection()
+            if not prefix:
+                return conn.execute('SELECT key, value FROM kv ORDER BY key').fetchall()
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            return conn.execute('SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key',
+                                (prefix, upper)).fetchall()
+
+
+_sqlite_backends: Dict[str, SQLiteStorageBackend] = {}
+_sqlite_backends_lock = threading.Lock()
+
+
+def get_sqlite_backend(root: str) -> SQLiteStorageBackend:
+    """One backend (and connection) per database per process, shared by every Storage on that root"""
+    os.makedirs(root, exist_ok=True)
+    db_path = os.path.abspath(os.path.join(root, STORAGE_DB_NAME))
+    with _sqlite_backends_lock:
+        if db_path not in _sqlite_backends:
+            _sqlite_backends[db_path] = SQLiteStorageBackend(root)
+        return _sqlite_backends[db_path]
+
+
+# Parse/chunk caches of the old DocParser and SimpleDocParser: written through Storage, but discarded by the packed
+# cache, so they are not imported
+_LEGACY_CACHE_KEY_RE = re.compile(r'^[0-9a-f]{64}_(ori|without_chunking|\d+)$')
+_SHA256_DIR_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _is_storage_key_file(name: str) -> bool:
+    """Whether a file under a Storage root follows the key layout written by Storage.put"""
+    from qwen_agent_local.tools.packed_cache import PACKED_SUFFIX
+    from qwen_agent_local.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
+
+    if name.endswith(('.tmp', PACKED_SUFFIX)) or _LEGACY_CACHE_KEY_RE.match(name):
+        return False
+    ext = os.path.splitext(name)[1][1:].lower()
+    return ext not in PARSER_SUPPORTED_FILE_TYPES
+
+
+def import_file_storage(root: str, remove: bool = False, batch_size: int = 500) -> int:
+    """
+    Import a file-layout Storage root (one file per key) into the SQLite database of the same root.
+    Roots are shared with other tools, so only files in the Storage key layout are imported: downloaded documents
+    (per-URL sha256 directories and document files), packed caches, legacy parse caches, temporary files and non-UTF-8
+    files are left alone. With remove=True only the imported files are deleted. Returns the number of imported keys.
+    """
+    backend = get_sqlite_backend(root)
+    skip = {STORAGE_DB_NAME, f'{STORAGE_DB_NAME}-wal', f'{STORAGE_DB_NAME}-shm'}
+    imported, batch, files = 0, [], []
+    for dir_path, dirs, names in os.walk(root):
+        dirs[:] = [d for d in dirs if d != TMP_DIR_NAME and not _SHA256_DIR_RE.match(d)]
+        for name in names:
+            file_path = os.path.join(dir_path, name)
+            if (dir_path == root and name in skip) or not _is_storage_key_file(name):
+                continue
+            try:
+                with open(file_path, 'rb') as f:
+                    value = f.read().decode('utf-8')
+            except UnicodeDecodeError:
+                logger.info(f'Skip non-text file {file_path}.')
+                continue
+            batch.append((os.path.relpath(file_path, root).replace(os.sep, '/'), value))
+            files.append(file_path)
+            if len(batch) >= batch_size:
+                backend.put_many(batch)
+                imported += len(batch)
+                batch = []
+    if batch:
+        backend.put_many(batch)
+        imported += len(batch)
+    if remove:
+        for file_path in files:
+            os.remove(file_path)
+    return imported
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Import file-layout Storage roots into the SQLite backend.')
+    parser.add_argument('roots', nargs='+')
+    parser.add_argument('--remove', action='store_true', help='delete the imported files afterwards')
+    args = parser.parse_args()
+    for root in args.roots:
+        print(f'{root}: imported {import_file_storage(root, remove=args.remove)} keys')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Copyright 2023 The Qwen team, Alibaba Group. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache keys of the documents given to SimpleDocParser and DocParser.
+
+A local file is keyed by its path, mtime and size, so a file edited in place is parsed again. A URL is downloaded
+into the parser's work dir and revalidated with If-None-Match / If-Modified-Since at most every
+DEFAULT_URL_REVALIDATE_INTERVAL seconds; its key is derived from the downloaded bytes, so it changes only when the
+server sends a different body.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+import requests
+
+from qwen_agent_local.log import logger
+from qwen_agent_local.settings import DEFAULT_URL_REVALIDATE_INTERVAL
+from qwen_agent_local.utils.utils import (DOWNLOAD_HEADERS, DOWNLOAD_TIMEOUT, get_basename_from_url, hash_sha256,
+                                          is_http_url, sanitize_chrome_file_path, save_response_to_file)
+
+URL_STATE_FILE = '.source.json'
+
+
+class DocSource(NamedTuple):
+    key: str  # The prefix of the doc's parse and chunk cache names
+    local_path: Optional[str]  # The downloaded copy of a URL; None for local files
+
+
+def resolve_doc(url: str, work_dir: str) -> DocSource:
+    """The cache key of a local path or URL; a URL is downloaded (or revalidated) into `work_dir` first."""
+    if is_http_url(url):
+        return _resolve_url(url, work_dir)
+    return DocSource(key=local_doc_key(url), local_path=None)
+
+
+def local_doc_key(path: str) -> str:
+    try:
+        stat = os.stat(sanitize_chrome_file_path(path))
+    except OSError:
+        # Missing files fail later, when parsed
+        return hash_sha256(path)
+    return hash_sha256(f'{path}\n{stat.st_mtime_ns}\n{stat.st_size}')
+
+
+_url_locks: Dict[str, threading.Lock] = {}
+_url_locks_lock = threading.Lock()
+
+
+def _resolve_url(url: str, work_dir: str) -> DocSource:
+    url_dir = os.path.join(work_dir, hash_sha256(url))
+    with _url_locks_lock:
+        lock = _url_locks.setdefault(url_dir, threading.Lock())
+    with lock:
+        state = _load_state(url_dir)
+        if state is not None and time.time() - state['checked_at'] < DEFAULT_URL_REVALIDATE_INTERVAL:
+            return DocSource(key=state['key'], local_path=state['path'])
+
+        headers = dict(DOWNLOAD_HEADERS)
+        if state is not None:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+        os.makedirs(url_dir, exist_ok=True)
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 304 and state is not None:
+                    logger.info(f'{url} is not modified, use the downloaded copy.')
+                elif response.status_code == 200:
+                    state = _save_download(url, url_dir, response, state)
+                elif state is None:
+                    raise ValueError('Can not download this file. Please check your network or the file link.')
+                else:
+                    # An error status while revalidating is treated like a network failure
+                    logger.warning(f'Failed to revalidate {url} (HTTP {response.status_code}), '
+                                   f'use the downloaded copy.')
+        except requests.RequestException as ex:
+            if state is None:
+                raise
+            logger.warning(f'Failed to revalidate {url}, use the downloaded copy: {ex}')
+        state['checked_at'] = time.time()
+        _dump_state(url_dir, state)
+        return DocSource(key=state['key'], local_path=state['path'])
+
+
+def _save_download(url: str, url_dir: str, response: requests.Response, state: Optional[dict]) -> dict:
+    logger.info(f'Downloading {url} to {url_dir}...')
+    start_time = time.time()
+    tmp_path = os.path.join(url_dir, f'download.{os.getpid()}.{threading.get_ident()}')
+    digest = save_response_to_file(response, tmp_path)
+    # Each version of the body gets its own dir, so a path handed out for a key never changes its content
+    version_dir = os.path.join(url_dir, digest[:16])
+    os.makedirs(version_dir, exist_ok=True)
+    path = os.path.join(version_dir, get_basename_from_url(url))
+    os.replace(tmp_path, path)
+    if state is not None and os.path.dirname(state['path']) != version_dir:
+        shutil.rmtree(os.path.dirname(state['path']), ignore_errors=True)
+    logger.info(f'Finished downloading {url} to {path}. Time spent: {time.time() - start_time} seconds.')
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'key': hash_sha256(f'{url}\n{digest}'),
+        'path': path,
+    }
+
+
+def _load_state(url_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(url_dir, URL_STATE_FILE), encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or not os.path.isfile(state.get('path', '')):
+        return None
+    return state
+
+
+def _dump_state(url_dir: str, state: dict):
+    # Shared by the parse pool processes, so written atomically
+    path = os.path.join(url_dir, URL_STATE_FILE)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
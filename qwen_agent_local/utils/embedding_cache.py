@@ -0,0 +1,146 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from qwen_agent_local.settings import DEFAULT_EMBEDDING_CACHE_PATH, DEFAULT_EMBEDDING_CACHE_SIZE
+
+# SQLite 单条语句的参数个数有上限，批量查询时按此大小切分
+_SQL_BATCH = 500
+# 命中时只有记录的访问时间早于该秒数才更新，避免每次读取都变成一次写事务；LRU 淘汰的精度也就是这个粒度
+_ACCESS_GRANULARITY = 600
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的持久化 embedding 缓存，键为 (model, dims, sha256(text))，值为 float32 向量。
+    超过 max_entries 条时按最近访问时间（LRU）淘汰；WAL 模式下可被多个进程同时读写。
+    """
+
+    def __init__(self, path: str = DEFAULT_EMBEDDING_CACHE_PATH, max_entries: int = DEFAULT_EMBEDDING_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                           'model TEXT NOT NULL, dims INTEGER NOT NULL, digest TEXT NOT NULL, '
+                           'vector BLOB NOT NULL, last_access REAL NOT NULL, '
+                           'PRIMARY KEY (model, dims, digest))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)')
+        self._conn.commit()
+        self._count = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def get(self, model: str, dims: int, text: str) -> Optional[list]:
+        return self.get_many(model, dims, [text])[0]
+
+    def put(self, model: str, dims: int, text: str, vector: Sequence[float]) -> None:
+        self.put_many(model, dims, [text], [vector])
+
+    def get_many(self, model: str, dims: int, texts: List[str]) -> List[Optional[list]]:
+        """批量查询，返回与 texts 等长的列表，未命中的位置为 None"""
+        digests = [text_digest(t) for t in texts]
+        found = {}
+        now = time.time()
+        stale = []
+        with self._lock:
+            unique = list(set(digests))
+            for start in range(0, len(unique), _SQL_BATCH):
+                part = unique[start:start + _SQL_BATCH]
+                rows = self._conn.execute(
+                    f'SELECT digest, vector, last_access FROM embeddings WHERE model = ? AND dims = ? '
+                    f'AND digest IN ({",".join("?" * len(part))})', [model, dims] + part).fetchall()
+                for digest, blob, last_access in rows:
+                    found[digest] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    if now - last_access >= _ACCESS_GRANULARITY:
+                        stale.append(digest)
+            if stale:
+                self._conn.executemany('UPDATE embeddings SET last_access = ? WHERE model = ? AND dims = ? AND digest = ?',
+                                       [(now, model, dims, d) for d in stale])
+                self._conn.commit()
+            results = [found.get(d) for d in digests]
+            n_hits = sum(1 for r in results if r is not None)
+            self.hits += n_hits
+            self.misses += len(results) - n_hits
+        return results
+
+    def put_many(self, model: str, dims: int, texts: List[str], vectors: List[Sequence[float]]) -> None:
+        """批量写入；空向量不缓存"""
+        now = time.time()
+        rows = {}
+        for t, v in zip(texts, vectors):
+            if v is not None and len(v) > 0:
+                digest = text_digest(t)
+                rows[digest] = (model, dims, digest, np.asarray(v, dtype=np.float32).tobytes(), now)
+        if not rows:
+            return
+        with self._lock:
+            # 只有新键会增加条数，已存在的键被替换
+            existing = 0
+            digests = list(rows)
+            for start in range(0, len(digests), _SQL_BATCH):
+                part = digests[start:start + _SQL_BATCH]
+                existing += self._conn.execute(
+                    f'SELECT COUNT(*) FROM embeddings WHERE model = ? AND dims = ? '
+                    f'AND digest IN ({",".join("?" * len(part))})', [model, dims] + part).fetchone()[0]
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, dims, digest, vector, last_access) VALUES (?, ?, ?, ?, ?)',
+                list(rows.values()))
+            self._conn.commit()
+            self._count += len(rows) - existing
+            if self.max_entries and self._count > self.max_entries:
+                # 其他进程也可能写入，淘汰前重新统计一次真实条数
+                self._count = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+                if self._count > self.max_entries:
+                    self._evict(self._count - self.max_entries)
+
+    def _evict(self, n: int) -> None:
+        self._conn.execute(
+            'DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)', (n,))
+        self._conn.commit()
+        self._count -= n
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM embeddings')
+            self._conn.commit()
+            self._count = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': self._count,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """返回进程内共享的默认缓存；DEFAULT_EMBEDDING_CACHE_SIZE 为 0 时关闭缓存，返回 None"""
+    global _default_cache
+    if DEFAULT_EMBEDDING_CACHE_SIZE <= 0:
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = EmbeddingCache()
+    return _default_cache
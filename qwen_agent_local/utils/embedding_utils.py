@@ -1,20 +1,128 @@
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List, Tuple
+
 from openai import OpenAI
 from config import EMBEDDING_MODEL, DASHSCOPE_API_KEY, DASHSCOPE_BASE_URL, EMBEDDING_DIM
+from qwen_agent_local.settings import DEFAULT_EMBEDDING_BATCH_SIZE, DEFAULT_EMBEDDING_MAX_IN_FLIGHT
+from qwen_agent_local.utils.embedding_cache import get_embedding_cache
 
-def get_embedding(text: str, client=None) -> list:
-    """用 Dashscope/OpenAI 生成 embedding 向量"""
-    if client is None:
-        client = OpenAI(
-            api_key=DASHSCOPE_API_KEY,
-            base_url=DASHSCOPE_BASE_URL
-        )
-    if not text.strip():
-        return []
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_embedding_client():
+    """返回进程内共享的 OpenAI 客户端，复用其连接池，避免每次请求都重新建立 HTTPS 连接"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=DASHSCOPE_API_KEY,
+                    base_url=DASHSCOPE_BASE_URL
+                )
+    return _client
+
+
+def _request_embeddings(texts: List[str], client, dimensions: int = EMBEDDING_DIM) -> List[list]:
     response = client.embeddings.create(
         model=EMBEDDING_MODEL,
-        input=text,
-        dimensions=EMBEDDING_DIM,
+        input=texts,
+        dimensions=dimensions,
         encoding_format="float"
     )
-    return response.data[0].embedding 
\ No newline at end of file
+    results = [[] for _ in texts]
+    for item in response.data:
+        results[item.index] = item.embedding
+    return results
+
+
+def get_embedding(text: str, client=None, use_cache: bool = True, dimensions: int = EMBEDDING_DIM) -> list:
+    """用 Dashscope/OpenAI 生成 embedding 向量"""
+    return get_embeddings([text], client=client, use_cache=use_cache, dimensions=dimensions)[0]
+
+
+def get_embeddings(texts: List[str], client=None, use_cache: bool = True, dimensions: int = EMBEDDING_DIM) -> List[list]:
+    """
+    一次请求为多段文本生成 embedding，返回顺序与输入一致；空文本对应 []。已缓存的文本不再请求
+    :param dimensions: 向量维度，可小于模型默认维度（Matryoshka 式截断，由 embedding 服务端完成）
+    """
+    results = [[] for _ in texts]
+    todo = [i for i, text in enumerate(texts) if text.strip()]
+    cache = get_embedding_cache() if use_cache else None
+    if cache is not None and todo:
+        cached = cache.get_many(EMBEDDING_MODEL, dimensions, [texts[i] for i in todo])
+        for i, vector in zip(todo, cached):
+            if vector is not None:
+                results[i] = vector
+        todo = [i for i, vector in zip(todo, cached) if vector is None]
+    if not todo:
+        return results
+    if client is None:
+        client = get_embedding_client()
+    vectors = []
+    for start in range(0, len(todo), DEFAULT_EMBEDDING_BATCH_SIZE):
+        # 单个请求的输入条数有上限（DashScope 为 10）
+        batch = todo[start:start + DEFAULT_EMBEDDING_BATCH_SIZE]
+        vectors.extend(_request_embeddings([texts[i] for i in batch], client, dimensions))
+    for i, vector in zip(todo, vectors):
+        results[i] = vector
+    if cache is not None:
+        cache.put_many(EMBEDDING_MODEL, dimensions, [texts[i] for i in todo], vectors)
+    return results
+
+
+def iter_embeddings(texts: List[str],
+                    client=None,
+                    batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+                    max_in_flight: int = DEFAULT_EMBEDDING_MAX_IN_FLIGHT,
+                    use_cache: bool = True,
+                    dimensions: int = EMBEDDING_DIM) -> Iterator[Tuple[int, list]]:
+    """
+    按批并发生成 embedding，并在每批完成时立即产出结果
+    :param texts: 待向量化的文本列表
+    :param batch_size: 每个请求携带的文本条数
+    :param max_in_flight: 同时在途的请求数上限
+    :param use_cache: 是否先一次性查询 embedding 缓存，命中的文本直接产出、不再请求
+    :param dimensions: 向量维度
+    :return: 迭代器，元素为 (文本下标, embedding)，按完成顺序而非输入顺序产出
+    """
+    batch_size = max(1, batch_size)
+    max_in_flight = max(1, max_in_flight)
+    todo = []
+    for i, text in enumerate(texts):
+        if text.strip():
+            todo.append(i)
+        else:
+            yield i, []
+    cache = get_embedding_cache() if use_cache else None
+    if cache is not None and todo:
+        cached = cache.get_many(EMBEDDING_MODEL, dimensions, [texts[i] for i in todo])
+        for i, vector in zip(todo, cached):
+            if vector is not None:
+                yield i, vector
+        todo = [i for i, vector in zip(todo, cached) if vector is None]
+    batches = [todo[start:start + batch_size] for start in range(0, len(todo), batch_size)]
+    if not batches:
+        return
+    if client is None:
+        client = get_embedding_client()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = {}
+        next_batch = 0
+        while next_batch < len(batches) or pending:
+            # 保持在途请求数不超过 max_in_flight，避免一次性把所有批次压给服务端
+            while next_batch < len(batches) and len(pending) < max_in_flight:
+                ids = batches[next_batch]
+                future = executor.submit(_request_embeddings, [texts[i] for i in ids], client, dimensions)
+                pending[future] = ids
+                next_batch += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                ids = pending.pop(future)
+                vectors = future.result()
+                if cache is not None:
+                    cache.put_many(EMBEDDING_MODEL, dimensions, [texts[i] for i in ids], vectors)
+                for i, embedding in zip(ids, vectors):
+                    yield i, embedding
@@ -12,11 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import multiprocessing
 import random
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import Any, Callable, List, Optional
 
+from qwen_agent_local.settings import DEFAULT_PARSER_MAX_WORKERS
+
 
 def parallel_exec(
     fn: Callable,
@@ -61,3 +65,32 @@ def serial_exec(fn: Callable, list_of_kwargs: List[dict]) -> List[Any]:
         result = fn(**kwargs)
         results.append(result)
     return results
+
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    The process pool shared by all document parsing in this process (whole files and PDF page ranges).
+    Its size, DEFAULT_PARSER_MAX_WORKERS, caps the total concurrent parse work however many sessions parse at once.
+    Returns None when parsing should stay in the current process: the pool is disabled (size <= 1),
+    or this process is itself a pool worker.
+    """
+    global _parse_pool
+    if DEFAULT_PARSER_MAX_WORKERS <= 1 or multiprocessing.parent_process() is not None:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=DEFAULT_PARSER_MAX_WORKERS)
+        return _parse_pool
+
+
+def reset_parse_pool():
+    """Drops a broken parse pool; the next get_parse_pool() starts a new one."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False)
+            _parse_pool = None
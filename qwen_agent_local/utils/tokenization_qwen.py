@@ -15,13 +15,18 @@
 """Tokenization classes for QWen."""
 
 import base64
+import hashlib
+import threading
 import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Collection, Dict, List, Set, Union
+from typing import Collection, Dict, List, Optional, Set, Union
 
 import tiktoken
 
 from qwen_agent_local.log import logger
+from qwen_agent_local.settings import DEFAULT_TOKENIZER_THREADS
 
 VOCAB_FILES_NAMES = {'vocab_file': 'qwen.tiktoken'}
 
@@ -44,6 +49,11 @@ SPECIAL_TOKENS = tuple(enumerate(
     start=SPECIAL_START_ID,
 ))
 SPECIAL_TOKENS_SET = set(t for i, t in SPECIAL_TOKENS)
+SPECIAL_TOKEN_PREFIX = '<|'  # Shared by the surface forms of all special tokens
+
+COUNT_CACHE_MIN_CHARS = 256  # Shorter texts are encoded faster than hashed and looked up
+COUNT_CACHE_SIZE = 1024
+BATCH_MIN_TEXTS = 64  # Smaller batches are encoded in the calling thread
 
 
 def _load_tiktoken_bpe(tiktoken_bpe_file: str) -> Dict[bytes, int]:
@@ -104,6 +114,7 @@ class QWenTokenizer:
         self.decoder.update({v: k for k, v in self.special_tokens.items()})
 
         self.tokenizer = enc  # type: tiktoken.Encoding
+        self._init_count_cache()
 
         self.eod_id = self.tokenizer.eot_token
         self.im_start_id = self.special_tokens[IMSTART]
@@ -113,6 +124,7 @@ class QWenTokenizer:
         # for pickle lovers
         state = self.__dict__.copy()
         del state['tokenizer']
+        del state['_count_cache'], state['_count_cache_lock']
         return state
 
     def __setstate__(self, state):
@@ -125,6 +137,11 @@ class QWenTokenizer:
             special_tokens=self.special_tokens,
         )
         self.tokenizer = enc
+        self._init_count_cache()
+
+    def _init_count_cache(self):
+        self._count_cache = OrderedDict()  # type: OrderedDict[bytes, int]
+        self._count_cache_lock = threading.Lock()
 
     def __len__(self) -> int:
         return self.tokenizer.n_vocab
@@ -168,6 +185,9 @@ class QWenTokenizer:
         Returns:
             `List[bytes|str]`: The list of tokens.
         """
+        if allowed_special == 'all' and not disallowed_special:
+            return [self.decoder[t] for t in self.encode(text)]
+
         tokens = []
         text = unicodedata.normalize('NFC', text)
 
@@ -213,10 +233,52 @@ class QWenTokenizer:
         return self.tokenizer.decode(token_ids, errors=errors or self.errors)
 
     def encode(self, text: str) -> List[int]:
-        return self.convert_tokens_to_ids(self.tokenize(text))
+        # Same ids as convert_tokens_to_ids(tokenize(text)), without the detour through the token surface forms
+        text = unicodedata.normalize('NFC', text)
+        if SPECIAL_TOKEN_PREFIX not in text:
+            # No special token can occur, and encode_ordinary skips setting up the allowed special tokens per call
+            return self.tokenizer.encode_ordinary(text)
+        return self.tokenizer.encode(text, allowed_special='all', disallowed_special=())
+
+    def convert_ids_to_string(self, token_ids: List[int]) -> str:
+        """Same as convert_tokens_to_string on the tokens of these ids."""
+        return self.convert_tokens_to_string([self.decoder[t] for t in token_ids])
+
+    def encode_batch(self, texts: List[str], num_threads: int = DEFAULT_TOKENIZER_THREADS) -> List[List[int]]:
+        """`encode` of every text, spread over a shared thread pool (tiktoken releases the GIL while encoding).
+
+        The pool has DEFAULT_TOKENIZER_THREADS threads, so `num_threads` is capped at that.
+        """
+        num_threads = min(num_threads, DEFAULT_TOKENIZER_THREADS)
+        if num_threads <= 1 or len(texts) < BATCH_MIN_TEXTS:
+            return [self.encode(text) for text in texts]
+        step = -(-len(texts) // num_threads)
+        pool = _get_encode_pool()
+        futures = [
+            pool.submit(lambda part: [self.encode(text) for text in part], texts[i:i + step])
+            for i in range(0, len(texts), step)
+        ]
+        return [ids for future in futures for ids in future.result()]
 
     def count_tokens(self, text: str) -> int:
-        return len(self.tokenize(text))
+        if len(text) < COUNT_CACHE_MIN_CHARS:
+            return len(self.encode(text))
+        # Long texts that come back again and again (system prompts, templates) are counted once
+        key = hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+        with self._count_cache_lock:
+            if key in self._count_cache:
+                self._count_cache.move_to_end(key)
+                return self._count_cache[key]
+        count = len(self.encode(text))
+        with self._count_cache_lock:
+            self._count_cache[key] = count
+            while len(self._count_cache) > COUNT_CACHE_SIZE:
+                self._count_cache.popitem(last=False)
+        return count
+
+    def count_tokens_batch(self, texts: List[str], num_threads: int = DEFAULT_TOKENIZER_THREADS) -> List[int]:
+        """Token counts of many texts, e.g. every paragraph of a doc; these bypass the count cache."""
+        return [len(ids) for ids in self.encode_batch(texts, num_threads=num_threads)]
 
     def truncate(self, text: str, max_token: int, start_token: int = 0, keep_both_sides: bool = False) -> str:
         token_list = self.tokenize(text)[start_token:]
@@ -239,8 +301,24 @@ class QWenTokenizer:
         return self.convert_tokens_to_string(token_list)
 
 
+_encode_pool: Optional[ThreadPoolExecutor] = None
+_encode_pool_lock = threading.Lock()
+
+
+def _get_encode_pool() -> ThreadPoolExecutor:
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            _encode_pool = ThreadPoolExecutor(max_workers=DEFAULT_TOKENIZER_THREADS, thread_name_prefix='tokenizer')
+        return _encode_pool
+
+
 tokenizer = QWenTokenizer(Path(__file__).resolve().parent / 'qwen.tiktoken')
 
 
 def count_tokens(text: str) -> int:
     return tokenizer.count_tokens(text)
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    return tokenizer.count_tokens_batch(texts)
@@ -22,9 +22,11 @@ import shutil
 import signal
 import socket
 import sys
+import threading
 import time
 import traceback
 import urllib.parse
+from collections import OrderedDict
 from io import BytesIO
 from typing import Any, List, Literal, Optional, Tuple, Union
 
@@ -34,6 +36,7 @@ from pydantic import BaseModel
 
 from qwen_agent_local.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, FUNCTION, SYSTEM, USER, ContentItem, Message
 from qwen_agent_local.log import logger
+from qwen_agent_local.settings import DEFAULT_URL_REVALIDATE_INTERVAL
 
 
 def append_signal_handler(sig, handler):
@@ -191,21 +194,40 @@ def save_url_to_local_work_dir(url: str, save_dir: str, save_filename: str = '')
         url = sanitize_chrome_file_path(url)
         shutil.copy(url, new_path)
     else:
-        headers = {
-            'User-Agent':
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            with open(new_path, 'wb') as file:
-                file.write(response.content)
-        else:
-            raise ValueError('Can not download this file. Please check your network or the file link.')
+        with requests.get(url, headers=DOWNLOAD_HEADERS, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 200:
+                save_response_to_file(response, new_path)
+            else:
+                raise ValueError('Can not download this file. Please check your network or the file link.')
     end_time = time.time()
     logger.info(f'Finished downloading {url} to {new_path}. Time spent: {end_time - start_time} seconds.')
     return new_path
 
 
+DOWNLOAD_HEADERS = {
+    'User-Agent':
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+DOWNLOAD_TIMEOUT = (10, 60)  # (connect, read) seconds; the read timeout applies to each chunk, not the whole body
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def save_response_to_file(response: requests.Response, path: str) -> str:
+    """Stream a `stream=True` response body to path in chunks, returning the sha256 hex digest of the body"""
+    digest = hashlib.sha256()
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                digest.update(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return digest.hexdigest()
+
+
 def save_text_to_file(path: str, text: str) -> None:
     with open(path, 'w', encoding='utf-8') as fp:
         fp.write(text)
@@ -229,12 +251,18 @@ def contains_html_tags(text: str) -> bool:
 
 
 def get_content_type_by_head_request(path: str) -> str:
+    # Memoized for a while (see DEFAULT_URL_REVALIDATE_INTERVAL); failed requests are not remembered
+    with _content_type_memo_lock:
+        memo = _content_type_memo.get(path)
+        if memo is not None and time.time() - memo[1] < DEFAULT_URL_REVALIDATE_INTERVAL:
+            return memo[0]
     try:
         response = requests.head(path, timeout=5)
         content_type = response.headers.get('Content-Type', '')
-        return content_type
     except requests.RequestException:
         return 'unk'
+    _remember(_content_type_memo, _content_type_memo_lock, path, (content_type, time.time()))
+    return content_type
 
 
 def get_file_type(path: str) -> Literal['pdf', 'docx', 'pptx', 'txt', 'html', 'csv', 'tsv', 'xlsx', 'xls', 'unk']:
@@ -256,17 +284,36 @@ def get_file_type(path: str) -> Literal['pdf', 'docx', 'pptx', 'txt', 'html', 'c
         # because the file downloaded by the request may contain html tags
         return 'html'
     else:
-        # Determine by reading local HTML file
+        # Determine by reading local HTML file; memoized as long as the file's mtime and size do not change
         try:
+            stat = os.stat(path)
+            memo_key = (path, stat.st_mtime_ns, stat.st_size)
+            with _file_type_memo_lock:
+                if memo_key in _file_type_memo:
+                    return _file_type_memo[memo_key]
             content = read_text_from_file(path)
         except Exception:
             print_traceback()
             return 'unk'
 
-        if contains_html_tags(content):
-            return 'html'
-        else:
-            return 'txt'
+        f_type = 'html' if contains_html_tags(content) else 'txt'
+        _remember(_file_type_memo, _file_type_memo_lock, memo_key, f_type)
+        return f_type
+
+
+_MEMO_SIZE = 4096
+_content_type_memo: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+_content_type_memo_lock = threading.Lock()
+_file_type_memo: 'OrderedDict[tuple, str]' = OrderedDict()
+_file_type_memo_lock = threading.Lock()
+
+
+def _remember(memo: OrderedDict, lock: threading.Lock, key, value):
+    with lock:
+        memo[key] = value
+        memo.move_to_end(key)
+        while len(memo) > _MEMO_SIZE:
+            memo.popitem(last=False)
 
 
 def extract_urls(text: str) -> List[str]: